@@ -4,6 +4,7 @@ import signal
 import sys
 import time
 
+import openai
 from slack_bolt.adapter.socket_mode import SocketModeHandler
 
 from config import (
@@ -11,16 +12,27 @@ from config import (
     OPENAI_MODEL,
     app,
     openai_client,
-    mrkdwn_converter,
     logger,
 )
 import datetime
 
+from context_builder import context_builder, token_budget
+from conversation_state import StateLookup, conversation_state, estimate_tokens
+from dispatcher import dispatcher
 from event_log import event_log
+from history_cache import history_cache
+from idempotency import event_keys, idempotency
 from memory import read_memory
-from prompts import SYSTEM_PROMPT_TEMPLATE
+from notifier import notifier
+from prompts import DYNAMIC_CONTEXT_TEMPLATE, SYSTEM_PROMPT_PREFIX
+from router import RouteDecision, full_route, route
 from session_manager import session_manager
-from tools import TOOLS, handle_function_calls
+from streaming import STREAM_REPLIES, SlackReplyStream, to_mrkdwn
+from tools import handle_function_calls
+from user_directory import user_directory
+
+# Most recent converted messages kept as context for a linear DM.
+DM_HISTORY_LIMIT = 200
 
 # Cache bot user ID once at startup instead of calling auth_test() per message.
 BOT_USER_ID: str = ""
@@ -32,42 +44,58 @@ def _init_bot_user_id():
     logger.info("Bot user ID: %s", BOT_USER_ID)
 
 
-@functools.lru_cache(maxsize=128)
 def get_user_first_name(user_id: str) -> str:
     """Look up a Slack user's first name and return it lowercased."""
-    result = app.client.users_info(user=user_id)
-    first_name = result["user"]["profile"].get("first_name", "").strip()
-    if not first_name:
-        # Fall back to display name or real name if first_name is empty
-        first_name = (
-            result["user"]["profile"].get("display_name")
-            or result["user"]["profile"].get("real_name")
-            or user_id
-        )
-    return first_name.lower()
+    return user_directory.first_name(user_id)
 
 
-def get_thread_messages(channel: str, thread_ts: str) -> list[dict]:
-    """Fetch all messages in a Slack thread to use as conversation history."""
-    result = app.client.conversations_replies(channel=channel, ts=thread_ts)
-    return result["messages"]
+def get_thread_messages(channel: str, thread_ts: str, oldest: str | None = None) -> list[dict]:
+    """Fetch messages in a Slack thread to use as conversation history.
 
+    With `oldest`, only messages after that ts are returned (plus the
+    thread parent, which Slack always includes).
+    """
+    messages = []
+    cursor = None
+    while True:
+        result = app.client.conversations_replies(
+            channel=channel, ts=thread_ts, oldest=oldest, cursor=cursor,
+        )
+        messages.extend(result["messages"])
+        cursor = (result.get("response_metadata") or {}).get("next_cursor")
+        if not cursor:
+            return messages
 
-def get_channel_history(channel: str) -> list[dict]:
+
+def get_channel_history(channel: str, oldest: str | None = None) -> list[dict]:
     """Fetch recent messages from a channel (for unthreaded DM conversations).
 
-    Pulls up to 200 messages (Slack default). The OpenAI Responses API
-    handles context truncation if needed — we don't limit artificially.
+    Without `oldest`, pulls one page of the most recent messages. With
+    `oldest`, pages through everything newer than that ts.
     """
-    result = app.client.conversations_history(channel=channel)
+    messages = []
+    cursor = None
+    while True:
+        result = app.client.conversations_history(
+            channel=channel, oldest=oldest, cursor=cursor,
+        )
+        messages.extend(result.get("messages", []))
+        cursor = (result.get("response_metadata") or {}).get("next_cursor")
+        if not cursor or not oldest:
+            break
     # conversations_history returns newest first, reverse for chronological order
-    messages = result.get("messages", [])
     messages.reverse()
     return messages
 
 
 def build_openai_messages(thread_messages: list[dict], bot_user_id: str) -> list[dict]:
     """Convert Slack thread messages into OpenAI chat messages."""
+    # Resolve every not-yet-known author in one concurrent batch up front.
+    user_directory.resolve_many(
+        msg.get("user") for msg in thread_messages
+        if not msg.get("subtype") and not msg.get("bot_id") and msg.get("user") != bot_user_id
+    )
+
     openai_messages = []
 
     for msg in thread_messages:
@@ -91,34 +119,142 @@ def build_openai_messages(thread_messages: list[dict], bot_user_id: str) -> list
     return openai_messages
 
 
+def load_thread_history(channel: str, thread_ts: str) -> list[dict]:
+    """Converted history for a channel thread, served from the history cache."""
+    return history_cache.get(
+        (channel, thread_ts),
+        fetch=lambda oldest: get_thread_messages(channel, thread_ts, oldest),
+        convert=lambda raw: build_openai_messages(raw, BOT_USER_ID),
+    )
+
+
+def load_dm_history(channel: str) -> list[dict]:
+    """Converted history for a linear DM, served from the history cache."""
+    return history_cache.get(
+        (channel, None),
+        fetch=lambda oldest: get_channel_history(channel, oldest),
+        convert=lambda raw: build_openai_messages(raw, BOT_USER_ID),
+        max_messages=DM_HISTORY_LIMIT,
+    )
+
+
 def _get_session_summary() -> str:
-    """One-liner summary of tracked sessions so the model knows they exist."""
-    sessions = session_manager.list_sessions()
-    if not sessions:
+    """One-liner summary of tracked sessions so the model knows they exist.
+
+    Names only the sessions still in flight; finished ones are just counted,
+    so the prompt stays the same size as history grows.
+    """
+    counts = session_manager.status_counts()
+    if not any(counts.values()):
         return ""
-    parts = [f"{s['id']}({s['status']})" for s in sessions]
-    return "Active sessions: " + ", ".join(parts)
+    active = (session_manager.list_sessions(status="running", limit=5)
+              + session_manager.list_sessions(status="queued", limit=5))
+    summary = "Sessions: " + ", ".join(f"{n} {status}" for status, n in counts.items() if n)
+    if active:
+        summary += ". In flight: " + ", ".join(f"{s['id']}({s['status']})" for s in active)
+    return summary
+
+
+@functools.lru_cache(maxsize=256)
+def _render_dynamic_context(today: str, user_memory: str, session_summary: str) -> str:
+    """Render the per-call suffix; memoized until one of its inputs changes."""
+    return DYNAMIC_CONTEXT_TEMPLATE.render(
+        today=today,
+        user_memory=user_memory,
+        session_summary=session_summary,
+    )
 
 
 def _build_instructions(user_id: str) -> str:
-    """Build the system instructions, injecting user memory if available."""
-    return SYSTEM_PROMPT_TEMPLATE.render(
-        today=datetime.date.today().isoformat(),
-        user_memory=read_memory(user_id),
-        session_summary=_get_session_summary(),
+    """Build the system instructions, injecting user memory if available.
+
+    The static prefix comes first and never changes, so the provider can
+    cache it; everything dynamic goes in the suffix.
+    """
+    return SYSTEM_PROMPT_PREFIX + "\n" + _render_dynamic_context(
+        datetime.date.today().isoformat(),
+        read_memory(user_id),
+        _get_session_summary(),
     )
 
 
-def chat(messages: list[dict], user_id: str, thread_id: str = None) -> str:
+def _usage_tokens(response) -> tuple[int, int, int]:
+    """(input, cached input, output) token counts of a response."""
+    usage = getattr(response, "usage", None)
+    if not usage:
+        return 0, 0, 0
+    details = getattr(usage, "input_tokens_details", None)
+    cached = getattr(details, "cached_tokens", 0) or 0
+    return usage.input_tokens, cached, usage.output_tokens
+
+
+def _create_response(kwargs: dict, decision: RouteDecision,
+                     stream: SlackReplyStream | None = None):
+    """Run one model turn. With `stream`, text deltas are forwarded to Slack."""
+    if stream is None:
+        return openai_client.responses.create(
+            model=decision.model,
+            tools=decision.tools,
+            reasoning={"effort": decision.effort},
+            **kwargs,
+        )
+
+    # We can't know in advance which turn is the final one, so every turn is
+    # streamed; tool-calling turns simply produce no text deltas.
+    stream.reset()
+    response = None
+    for event in openai_client.responses.create(
+        model=decision.model,
+        tools=decision.tools,
+        reasoning={"effort": decision.effort},
+        stream=True,
+        **kwargs,
+    ):
+        if event.type == "response.output_text.delta":
+            stream.append(event.delta)
+        elif event.type in ("response.completed", "response.incomplete"):
+            response = event.response
+        elif event.type in ("response.failed", "error"):
+            raise RuntimeError(f"Streaming response failed: {event}")
+    if response is None:
+        raise RuntimeError("Stream ended without a completed response")
+    return response
+
+
+def chat(
+    messages: list[dict],
+    user_id: str,
+    thread_id: str = None,
+    stream: SlackReplyStream | None = None,
+    origin: tuple[str, str | None] | None = None,
+) -> str:
     """Send messages to OpenAI and return the response.
 
     Uses the Responses API with web search so the model can look up
     current information from the internet when the question needs it.
     The model can also save facts about the user to long-term memory.
+
+    When `thread_id` is given and the history only adds turns to what was
+    sent last time, the call chains onto the stored response instead of
+    resending the whole conversation.
+
+    With `stream`, the reply is shown progressively in Slack as it is
+    generated; the caller still finalizes it with `stream.finish()`.
+
+    `origin` is the Slack (channel, thread_ts) being answered; computer
+    tasks dispatched from this call post their result there when done.
+
+    A routing step picks the model, reasoning effort and tools first.
+    Fast routes escalate to the full configuration if the model asks for
+    a tool it wasn't given.
     """
+    decision = route(messages)
     event_log.emit("orchestrator", "chat_start",
                    user_id=user_id, thread_id=thread_id,
                    message_count=len(messages),
+                   route=decision.route, model=decision.model,
+                   effort=decision.effort, route_reason=decision.reason,
+                   router_latency_s=decision.latency_s,
                    last_user_message=messages[-1]["content"][:200] if messages else "")
 
     # The system prompt moves to the top-level `instructions` param.
@@ -130,21 +266,52 @@ def chat(messages: list[dict], user_id: str, thread_id: str = None) -> str:
 
     instructions = _build_instructions(user_id)
 
-    kwargs = dict(instructions=instructions, input=input_messages)
+    # If this history extends what we sent last time, chain onto the stored
+    # response and send only the new turns.
+    # Otherwise send the full history, compacted to the model's token budget.
+    if thread_id:
+        state = conversation_state.lookup(thread_id, input_messages,
+                                          max_chain_tokens=token_budget(decision.model))
+    else:
+        state = StateLookup(previous_response_id=None, input_messages=input_messages,
+                            reason="no_thread")
+    if state.hit:
+        kwargs = dict(instructions=instructions, input=state.input_messages,
+                      previous_response_id=state.previous_response_id)
+    else:
+        kwargs = dict(instructions=instructions,
+                      input=context_builder.build(thread_id, input_messages, decision.model))
+
+    first_turn_kwargs = kwargs
+    tool_output_tokens = 0
 
     # Handle function calls in a loop until the model produces a final text reply.
     MAX_TURNS = 20
     turn_count = 0
+    total_input_tokens = 0
+    total_cached_tokens = 0
     chat_start = time.time()
     for turn_count in range(1, MAX_TURNS + 1):
         turn_start = time.time()
-        response = openai_client.responses.create(
-            model=OPENAI_MODEL,
-            tools=TOOLS,
-            reasoning={"effort": "medium"},
-            **kwargs,
-        )
+        try:
+            response = _create_response(kwargs, decision, stream)
+        except (openai.NotFoundError, openai.BadRequestError) as e:
+            if not (state.hit and turn_count == 1):
+                raise
+            # Stored response expired or was deleted — resend the full history.
+            logger.warning("Stored response %s rejected, rebuilding: %s",
+                           state.previous_response_id, e)
+            conversation_state.reject(thread_id)
+            state = StateLookup(previous_response_id=None, input_messages=input_messages,
+                                reason="rejected")
+            kwargs = first_turn_kwargs = dict(
+                instructions=instructions,
+                input=context_builder.build(thread_id, input_messages, decision.model))
+            response = _create_response(kwargs, decision, stream)
         turn_latency = time.time() - turn_start
+        input_tokens, cached_tokens, output_tokens = _usage_tokens(response)
+        total_input_tokens += input_tokens
+        total_cached_tokens += cached_tokens
 
         # Classify what's in this turn
         item_types = [item.type for item in response.output]
@@ -156,6 +323,8 @@ def chat(messages: list[dict], user_id: str, thread_id: str = None) -> str:
         event_log.emit("orchestrator", "agent_turn",
                        turn=turn_count, latency_s=round(turn_latency, 2),
                        item_types=item_types, function_calls=fn_calls,
+                       input_tokens=input_tokens, cached_tokens=cached_tokens,
+                       output_tokens=output_tokens,
                        user_id=user_id, thread_id=thread_id)
 
         # Log non-function-call items (e.g. web searches)
@@ -171,7 +340,30 @@ def chat(messages: list[dict], user_id: str, thread_id: str = None) -> str:
         if not any(item.type == "function_call" for item in response.output):
             break
 
-        tool_outputs = handle_function_calls(response, user_id)
+        # The fast path wants something it wasn't given — redo the first
+        # turn with the full configuration.
+        escalation = next(
+            (item for item in response.output
+             if item.type == "function_call" and (
+                 item.name == "escalate_to_full_agent" or not decision.allows(item.name))),
+            None,
+        )
+        if escalation and decision.route != "full":
+            event_log.emit("orchestrator", "route_escalated",
+                           from_route=decision.route, from_model=decision.model,
+                           trigger=escalation.name, arguments=escalation.arguments[:200],
+                           user_id=user_id, thread_id=thread_id)
+            decision = full_route(f"escalated from {decision.route}")
+            if not state.hit:
+                # The input was compacted to the fast model's budget.
+                first_turn_kwargs = dict(
+                    instructions=instructions,
+                    input=context_builder.build(thread_id, input_messages, decision.model))
+            kwargs = first_turn_kwargs
+            tool_output_tokens = 0
+            continue
+
+        tool_outputs = handle_function_calls(response, user_id, origin)
 
         # Log each tool result
         for output in tool_outputs:
@@ -181,17 +373,37 @@ def chat(messages: list[dict], user_id: str, thread_id: str = None) -> str:
                            user_id=user_id)
 
         kwargs = dict(previous_response_id=response.id, input=tool_outputs)
+        tool_output_tokens += sum(len(o["output"]) for o in tool_outputs) // 4
 
     total_latency = time.time() - chat_start
+    ttft = None
+    if stream and stream.first_visible_at:
+        ttft = round(stream.first_visible_at - chat_start, 2)
 
     text = response.output_text
     if not text:
         logger.warning("Agent loop ended with no text output (likely hit MAX_TURNS while still calling tools)")
         text = "Sorry, I wasn't able to finish processing that in time. Could you try again?"
-
+    elif thread_id:
+        # Measured like the budget it's checked against: an estimate of the
+        # conversation the chain carries, without instructions or tool schemas.
+        chain_tokens = (state.chain_tokens + estimate_tokens(first_turn_kwargs["input"])
+                        + tool_output_tokens + len(text) // 4)
+        conversation_state.save(thread_id, input_messages, response.id, chain_tokens)
+
+    state_stats = conversation_state.stats()
     event_log.emit("orchestrator", "chat_end",
                    user_id=user_id, thread_id=thread_id,
+                   route=decision.route, model=decision.model,
                    turns=turn_count, total_latency_s=round(total_latency, 2),
+                   time_to_first_token_s=ttft,
+                   input_tokens=total_input_tokens, cached_tokens=total_cached_tokens,
+                   cache_hit_rate=(round(total_cached_tokens / total_input_tokens, 2)
+                                   if total_input_tokens else None),
+                   state_hit=state.hit, state_reason=state.reason,
+                   state_skipped_messages=state.skipped_messages,
+                   tokens_saved_est=state.tokens_saved_est,
+                   state_hits=state_stats["hits"], state_misses=state_stats["misses"],
                    response_preview=text[:300])
 
     return text
@@ -202,21 +414,78 @@ def chat(messages: list[dict], user_id: str, thread_id: str = None) -> str:
 def _shutdown(signum=None, frame=None):
     """Clean up running sessions and close event log on exit."""
     logger.info("Shutting down...")
-    for sid in list(session_manager.sessions):
-        session = session_manager.sessions[sid]
-        if session.status == "running":
-            logger.info("Terminating session %s", sid)
-            session.process.terminate()
+    dispatcher.shutdown()
+    session_manager.shutdown()
+    notifier.shutdown()
     event_log.emit("system", "bot_stop")
     event_log.close()
+    idempotency.close()
     sys.exit(0)
 
 
 # --- Event Handlers ---
 
+def _start_reply_stream(channel: str, thread_ts: str | None = None) -> SlackReplyStream | None:
+    """Post a placeholder reply to stream into, if streaming is enabled.
+
+    Must be called after the history fetch so the placeholder never ends
+    up in the cached history.
+    """
+    if not STREAM_REPLIES:
+        return None
+    stream = SlackReplyStream(channel, thread_ts)
+    stream.start()
+    return stream
+
+
+def _chat_with_reply(messages: list[dict], username: str, thread_id: str,
+                     stream: SlackReplyStream | None,
+                     origin: tuple[str, str | None]) -> str:
+    """Run chat(), finalizing the streamed message (even on failure)."""
+    try:
+        reply = chat(messages, username, thread_id=thread_id, stream=stream, origin=origin)
+    except Exception:
+        if stream:
+            stream.finish("Sorry, something went wrong while answering that.")
+        raise
+    if stream:
+        stream.finish(reply)
+    return reply
+
+
+def _submit_once(body, event, queue_key: str, fn, say):
+    """Queue an event for processing unless it's a redelivery."""
+    keys = event_keys(body, event)
+    if idempotency.begin(keys):
+        logger.info("Dropping duplicate delivery of %s", keys)
+        return
+    if not dispatcher.submit(queue_key, _run_once, keys, fn, event, say):
+        idempotency.release(keys)
+
+
+def _run_once(keys: list[str], fn, event, say):
+    try:
+        fn(event, say)
+    except Exception:
+        # Let a retry of this event through, since we didn't answer it.
+        idempotency.release(keys)
+        raise
+    idempotency.complete(keys)
+
+
 @app.event("app_mention")
-def handle_mention(event, say):
-    """Respond when the bot is @mentioned in a channel."""
+def handle_mention(body, event, say):
+    """Respond when the bot is @mentioned in a channel.
+
+    Work is handed to the dispatcher so the Slack event is acked right
+    away; mentions in the same thread are processed in order.
+    """
+    # thread_ts values are only unique within a channel.
+    thread_ts = event.get("thread_ts", event["ts"])
+    _submit_once(body, event, f"{event['channel']}:{thread_ts}", _process_mention, say)
+
+
+def _process_mention(event, say):
     channel = event["channel"]
     thread_ts = event.get("thread_ts", event["ts"])
     username = get_user_first_name(event["user"])
@@ -226,12 +495,13 @@ def handle_mention(event, say):
                    source="mention",
                    text=event.get("text", "")[:200])
 
-    # Fetch thread history for context
-    thread_messages = get_thread_messages(channel, thread_ts)
-    openai_messages = build_openai_messages(thread_messages, BOT_USER_ID)
+    # Fetch thread history for context (only new messages hit the Slack API)
+    openai_messages = load_thread_history(channel, thread_ts)
 
-    reply = chat(openai_messages, username, thread_id=thread_ts)
-    say(text=mrkdwn_converter.convert(reply), thread_ts=thread_ts)
+    stream = _start_reply_stream(channel, thread_ts)
+    reply = _chat_with_reply(openai_messages, username, thread_ts, stream, (channel, thread_ts))
+    if not stream:
+        say(text=to_mrkdwn(reply), thread_ts=thread_ts)
 
     event_log.emit("system", "bot_reply",
                    user=username, thread_ts=thread_ts, source="mention",
@@ -239,12 +509,20 @@ def handle_mention(event, say):
 
 
 @app.event("message")
-def handle_dm(event, say):
+def handle_dm(body, event, say):
     """Respond to direct messages.
 
     DMs use a linear conversation model (no threads). The bot pulls
     recent channel history as context, like a Telegram-style chat.
+    Messages in the same DM channel are processed in order.
+
+    Edits and deletions (in any channel the bot can see) invalidate the
+    cached history for that conversation.
     """
+    if event.get("subtype") in ("message_changed", "message_deleted"):
+        _invalidate_history(event)
+        return
+
     # Only handle DMs (channel type 'im'), ignore other message subtypes
     if event.get("channel_type") != "im" or event.get("subtype"):
         return
@@ -253,6 +531,22 @@ def handle_dm(event, say):
     if event.get("user") == BOT_USER_ID:
         return
 
+    _submit_once(body, event, event["channel"], _process_dm, say)
+
+
+def _invalidate_history(event):
+    """Drop cached history for the conversation an edit/delete belongs to."""
+    if event["subtype"] == "message_changed":
+        msg = event.get("message", {})
+        if msg.get("user") == BOT_USER_ID:
+            # Our own streaming updates; the cache never holds the placeholder.
+            return
+    else:
+        msg = event.get("previous_message", {})
+    history_cache.invalidate(event["channel"], msg.get("thread_ts"))
+
+
+def _process_dm(event, say):
     channel = event["channel"]
     username = get_user_first_name(event["user"])
 
@@ -262,24 +556,42 @@ def handle_dm(event, say):
                    text=event.get("text", "")[:200])
 
     # Pull recent channel history (linear, no threading)
-    dm_messages = get_channel_history(channel)
-    openai_messages = build_openai_messages(dm_messages, BOT_USER_ID)
+    openai_messages = load_dm_history(channel)
 
-    reply = chat(openai_messages, username, thread_id=channel)
     # Reply at top level — no thread_ts, keeps the DM linear
-    say(text=mrkdwn_converter.convert(reply))
+    stream = _start_reply_stream(channel)
+    reply = _chat_with_reply(openai_messages, username, channel, stream, (channel, None))
+    if not stream:
+        say(text=to_mrkdwn(reply))
 
     event_log.emit("system", "bot_reply",
                    user=username, source="dm",
                    text=reply[:200])
 
 
+@app.event("user_change")
+def handle_user_change(event):
+    """Keep the user directory current when someone edits their profile."""
+    user_directory.update_from_user(event["user"])
+
+
+@app.event("team_join")
+def handle_team_join(event):
+    user_directory.update_from_user(event["user"])
+
+
 if __name__ == "__main__":
     signal.signal(signal.SIGINT, _shutdown)
     signal.signal(signal.SIGTERM, _shutdown)
     atexit.register(event_log.close)
 
     _init_bot_user_id()
+    user_directory.warm_async()
+    dispatcher.start()
+    session_manager.restore()
+    session_manager.add_completion_listener(notifier.notify)
+    notifier.start()
+    session_manager.warm_up()
     event_log.emit("system", "bot_start", model=OPENAI_MODEL)
     logger.info("Starting bot...")
     handler = SocketModeHandler(app, SLACK_APP_TOKEN)
@@ -0,0 +1,173 @@
+"""Token-budgeted context for long conversations.
+
+When a conversation's history exceeds the model's input budget, the most
+recent messages are kept verbatim and everything older collapses into a
+rolling summary. Summaries are cached per conversation and only extended
+with the messages that newly fell out of the verbatim window, so a long
+DM costs one small summarization call per message at most.
+
+Where the summary ends is always worked out with the main model's budget,
+so a conversation routed to different models keeps one summary. A model
+with a smaller budget sees the summary and only as much of the verbatim
+window as fits its own budget.
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+from config import OPENAI_MODEL, logger, openai_client
+from conversation_state import estimate_tokens
+from event_log import event_log
+from prompts import SUMMARY_INSTRUCTIONS
+
+SUMMARY_MODEL = os.environ.get("SUMMARY_MODEL", "gpt-5-mini")
+CONTEXT_KEEP_MESSAGES = int(os.environ.get("CONTEXT_KEEP_MESSAGES", "20"))
+SUMMARY_CACHE_MAX_ENTRIES = int(os.environ.get("SUMMARY_CACHE_MAX_ENTRIES", "500"))
+DEFAULT_CONTEXT_TOKEN_BUDGET = int(os.environ.get("DEFAULT_CONTEXT_TOKEN_BUDGET", "30000"))
+
+# Input-token budget for conversation history, per model. Override or
+# extend with CONTEXT_TOKEN_BUDGETS="gpt-5.2=40000,gpt-5-mini=16000".
+CONTEXT_TOKEN_BUDGETS: dict[str, int] = {
+    "gpt-5.2": 40000,
+    "gpt-5-mini": 16000,
+    "gpt-5-nano": 8000,
+}
+for _pair in filter(None, os.environ.get("CONTEXT_TOKEN_BUDGETS", "").split(",")):
+    _model, _, _budget = _pair.partition("=")
+    CONTEXT_TOKEN_BUDGETS[_model.strip()] = int(_budget)
+
+# Share of the budget the verbatim window may use; the rest is left for
+# the summary.
+_WINDOW_SHARE = 0.75
+
+
+def token_budget(model: str) -> int:
+    """History token budget for `model`."""
+    return CONTEXT_TOKEN_BUDGETS.get(model, DEFAULT_CONTEXT_TOKEN_BUDGET)
+
+
+def _fingerprint(msg: dict) -> str:
+    return hashlib.sha1(f"{msg['role']}\0{msg['content']}".encode()).hexdigest()
+
+
+def summarize(previous_summary: str, messages: list[dict]) -> str:
+    """Fold `messages` into `previous_summary` with the summary model."""
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    prompt = (
+        f"Existing summary:\n{previous_summary or '(none)'}\n\n"
+        f"New messages to fold in:\n{transcript}"
+    )
+    response = openai_client.responses.create(
+        model=SUMMARY_MODEL,
+        instructions=SUMMARY_INSTRUCTIONS,
+        input=[{"role": "user", "content": prompt}],
+    )
+    return response.output_text.strip()
+
+
+@dataclass
+class _Summary:
+    text: str = ""
+    covered: list[str] = field(default_factory=list)  # fingerprints, oldest first
+
+
+class ContextBuilder:
+    """Builds budget-bounded input messages, caching rolling summaries."""
+
+    def __init__(self, keep_messages: int = CONTEXT_KEEP_MESSAGES,
+                 max_entries: int = SUMMARY_CACHE_MAX_ENTRIES):
+        self.keep_messages = keep_messages
+        self.max_entries = max_entries
+        self._summaries: OrderedDict[str, _Summary] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def build(self, key: str | None, messages: list[dict], model: str) -> list[dict]:
+        """Return `messages`, compacted to fit `model`'s budget if needed.
+
+        `key` identifies the conversation whose summary is cached; with no
+        key the summary is built from scratch and not kept.
+        """
+        budget = token_budget(model)
+        total = estimate_tokens(messages)
+        if total <= budget:
+            return messages
+
+        split = self._window_start(messages, token_budget(OPENAI_MODEL))
+        older, kept = messages[:split], messages[split:]
+        summary = self._extend_summary(key, older)
+        kept = kept[self._window_start(kept, budget):]
+
+        compacted = list(kept)
+        if summary:
+            compacted.insert(0, {
+                "role": "developer",
+                "content": f"Summary of the earlier conversation (older messages omitted):\n{summary}",
+            })
+
+        event_log.emit("orchestrator", "context_compaction",
+                       thread_id=key, model=model, budget_tokens=budget,
+                       kept_messages=len(kept), kept_tokens=estimate_tokens(kept),
+                       summarized_messages=len(older),
+                       summarized_tokens=estimate_tokens(older),
+                       summary_tokens=len(summary) // 4)
+        return compacted
+
+    def _window_start(self, messages: list[dict], budget: int) -> int:
+        """Index of the first message kept verbatim."""
+        limit = int(budget * _WINDOW_SHARE)
+        start = max(0, len(messages) - self.keep_messages)
+        # Always keep the latest message, even if it alone is over the limit.
+        while start < len(messages) - 1 and estimate_tokens(messages[start:]) > limit:
+            start += 1
+        return start
+
+    def _extend_summary(self, key: str, older: list[dict]) -> str:
+        """Summary covering `older`, reusing and extending the cached one."""
+        fingerprints = [_fingerprint(m) for m in older]
+        with self._lock:
+            cached = self._summaries.get(key) or _Summary()
+            self._summaries.pop(key, None)
+
+        new_start = self._covered_upto(cached.covered, fingerprints)
+        if new_start is None:
+            cached = _Summary()  # history diverged (edit/delete) — start over
+            new_start = 0
+
+        text = cached.text
+        if new_start < len(older):
+            try:
+                text = summarize(cached.text, older[new_start:])
+            except Exception as e:
+                logger.warning("History summarization failed for %s: %s", key, e)
+                fingerprints = fingerprints[:new_start]
+
+        if key is None:
+            return text
+        with self._lock:
+            self._summaries[key] = _Summary(text=text, covered=fingerprints)
+            while len(self._summaries) > self.max_entries:
+                self._summaries.popitem(last=False)
+        return text
+
+    @staticmethod
+    def _covered_upto(covered: list[str], fingerprints: list[str]) -> int | None:
+        """How many of `fingerprints` the cached summary already covers.
+
+        The cached run may have lost messages off the front (a capped DM
+        window), so it's matched against the start of `fingerprints` at
+        any shift. Returns None if it doesn't line up at all.
+        """
+        if not covered:
+            return 0
+        for shift in range(len(covered)):
+            overlap = covered[shift:]
+            if fingerprints[:len(overlap)] == overlap:
+                return len(overlap)
+        return None
+
+
+# Module-level singleton
+context_builder = ContextBuilder()
@@ -0,0 +1,150 @@
+"""Reuse OpenAI conversation state across Slack messages.
+
+After each reply we remember, per conversation (thread_ts or DM channel),
+the final `response.id` and the input messages it covered. When the next
+Slack history is a strict extension of that — the same messages, then our
+reply, then new turns — only the new turns are sent, chained with
+`previous_response_id`. Anything else (edits, deletes, expiry) is a miss
+and the caller falls back to sending the full history.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+CONVERSATION_STATE_TTL_S = float(os.environ.get("CONVERSATION_STATE_TTL_S", "86400"))
+CONVERSATION_STATE_MAX_ENTRIES = int(os.environ.get("CONVERSATION_STATE_MAX_ENTRIES", "1000"))
+
+
+def estimate_tokens(messages: list[dict]) -> int:
+    """Cheap token estimate (~4 characters per token)."""
+    return sum(len(m.get("content", "")) for m in messages) // 4
+
+
+@dataclass
+class _State:
+    response_id: str
+    sent: list[dict]  # history covered by response_id (excluding our reply)
+    chain_tokens: int = 0  # estimate_tokens() of the conversation the chain carries
+    updated_at: float = field(default_factory=time.monotonic)
+
+
+@dataclass
+class StateLookup:
+    """Result of matching a Slack history against the stored state."""
+
+    previous_response_id: str | None
+    input_messages: list[dict]  # what to send as `input`
+    reason: str  # "hit" | "no_state" | "expired" | "diverged" | "over_budget" | "rejected"
+    skipped_messages: int = 0
+    tokens_saved_est: int = 0
+    chain_tokens: int = 0  # size of the chain being extended, on a hit
+
+    @property
+    def hit(self) -> bool:
+        return self.previous_response_id is not None
+
+
+class ConversationStateStore:
+    """Thread-safe LRU/TTL map of conversation -> last response id."""
+
+    def __init__(
+        self,
+        ttl_s: float = CONVERSATION_STATE_TTL_S,
+        max_entries: int = CONVERSATION_STATE_MAX_ENTRIES,
+    ):
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._states: OrderedDict[str, _State] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, key: str, messages: list[dict],
+               max_chain_tokens: int | None = None) -> StateLookup:
+        """Decide whether `messages` can be sent as a delta on stored state.
+
+        With `max_chain_tokens`, a delta that would grow the stored chain
+        past that size is a miss, so the caller can rebuild a compacted
+        context instead.
+        """
+        with self._lock:
+            state = self._states.get(key)
+            if state is None:
+                reason = "no_state"
+            elif time.monotonic() - state.updated_at > self.ttl_s:
+                del self._states[key]
+                reason = "expired"
+            else:
+                new_start = self._match(state.sent, messages)
+                over_budget = (
+                    new_start is not None and max_chain_tokens is not None
+                    and state.chain_tokens + estimate_tokens(messages[new_start:]) > max_chain_tokens
+                )
+                if new_start is not None and not over_budget:
+                    self.hits += 1
+                    skipped = messages[:new_start]
+                    return StateLookup(
+                        previous_response_id=state.response_id,
+                        input_messages=messages[new_start:],
+                        reason="hit",
+                        skipped_messages=len(skipped),
+                        tokens_saved_est=estimate_tokens(skipped),
+                        chain_tokens=state.chain_tokens,
+                    )
+                reason = "over_budget" if over_budget else "diverged"
+            self.misses += 1
+        return StateLookup(previous_response_id=None, input_messages=messages, reason=reason)
+
+    def save(self, key: str, messages: list[dict], response_id: str, chain_tokens: int = 0):
+        """Record that `response_id` covers `messages` (plus its own reply)."""
+        with self._lock:
+            self._states[key] = _State(response_id=response_id, sent=list(messages),
+                                       chain_tokens=chain_tokens)
+            self._states.move_to_end(key)
+            while len(self._states) > self.max_entries:
+                self._states.popitem(last=False)
+
+    def discard(self, key: str):
+        with self._lock:
+            self._states.pop(key, None)
+
+    def reject(self, key: str):
+        """The API refused a stored response id; count the hit as a miss."""
+        with self._lock:
+            self._states.pop(key, None)
+            self.hits -= 1
+            self.misses += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._states), "hits": self.hits, "misses": self.misses}
+
+    @staticmethod
+    def _match(sent: list[dict], messages: list[dict]) -> int | None:
+        """Index in `messages` where new turns start, or None if it diverged.
+
+        Expected shape: sent[shift:] + [our reply] + new turns, where
+        `shift` > 0 only when the history window dropped messages off the
+        front. At least half of `sent` must still overlap.
+        """
+        n = len(sent)
+        for shift in range(0, n // 2 + 1):
+            overlap = n - shift
+            reply_idx = overlap
+            if reply_idx + 1 >= len(messages):
+                continue
+            if messages[reply_idx]["role"] != "assistant":
+                continue
+            if messages[:overlap] != sent[shift:]:
+                continue
+            new = messages[reply_idx + 1:]
+            if any(m["role"] == "user" for m in new):
+                return reply_idx + 1
+        return None
+
+
+# Module-level singleton
+conversation_state = ConversationStateStore()
@@ -103,7 +103,8 @@ class SessionPanel(Static):
         self.lines: list[str] = []
 
     def update_display(self):
-        status_colors = {"running": "yellow", "done": "green", "failed": "red"}
+        status_colors = {"queued": "blue", "running": "yellow", "done": "green", "failed": "red",
+                         "timeout": "magenta", "budget_exceeded": "magenta"}
         color = status_colors.get(self.status, "white")
 
         # Header line: session ID, status, cost
@@ -258,7 +259,9 @@ class Dashboard(App):
             fn_calls = data.get("function_calls", [])
             item_types = data.get("item_types", [])
 
-            orch_log.write(f"[dim]{ts}[/] Turn {turn} [dim]({latency}s)[/]")
+            cached = data.get("cached_tokens")
+            tokens = f", {cached}/{data.get('input_tokens')} cached" if cached is not None else ""
+            orch_log.write(f"[dim]{ts}[/] Turn {turn} [dim]({latency}s{tokens})[/]")
 
             for fn in fn_calls:
                 name = fn.get("name", "?")
@@ -279,6 +282,9 @@ class Dashboard(App):
             if search_count:
                 orch_log.write(f"  [blue]web search[/] [dim]({search_count} queries)[/]")
 
+        elif event_type == "route_escalated":
+            orch_log.write(f"  [magenta]escalated[/] [dim]{data.get('from_route', '?')} → full[/]")
+
         elif event_type == "web_search":
             # Compact: show queries on one line
             queries = data.get("queries", [])
@@ -296,16 +302,28 @@ class Dashboard(App):
         elif event_type == "chat_end":
             turns = data.get("turns", "?")
             latency = data.get("total_latency_s", 0)
-            orch_log.write(f"[bold green]{ts}[/] Done in {turns} turns ({latency}s)")
+            ttft = data.get("time_to_first_token_s")
+            timing = f"{latency}s, first token {ttft}s" if ttft is not None else f"{latency}s"
+            orch_log.write(f"[bold green]{ts}[/] Done in {turns} turns ({timing})")
 
     def _handle_session_event(self, ts: str, event_type: str, data: dict):
         sid = data.get("session_id", "?")
 
-        if event_type == "session_dispatch":
+        if event_type == "session_dispatch" and sid in self.session_panels:
+            panel = self.session_panels[sid]
+            panel.status = "running"
+            panel.lines.append(f"[dim]{ts}[/] Started after {data.get('queue_wait_s', 0)}s in queue")
+            panel.update_display()
+
+        elif event_type in ("session_dispatch", "session_queued"):
             panel = SessionPanel(sid, id=f"panel-{sid}")
             panel.task_desc = data.get("task", "")
-            panel.status = "running"
-            panel.lines.append(f"[dim]{ts}[/] Dispatched")
+            if event_type == "session_queued":
+                panel.status = "queued"
+                panel.lines.append(f"[dim]{ts}[/] Queued (position {data.get('position', '?')})")
+            else:
+                panel.status = "running"
+                panel.lines.append(f"[dim]{ts}[/] Dispatched")
             if data.get("use_browser"):
                 panel.lines.append(f"[dim]{ts}[/] [yellow]Browser enabled[/]")
             self.session_panels[sid] = panel
@@ -328,12 +346,34 @@ class Dashboard(App):
                 text = data.get("text", "")[:80]
                 panel.lines.append(f"[dim]{ts}[/] {text}")
 
+            elif event_type == "worktree_lease":
+                name = data.get("path", "?").rsplit("/", 1)[-1]
+                panel.lines.append(f"[dim]{ts}[/] Worktree {name} leased ({data.get('idle', '?')} idle)")
+
+            elif event_type == "worktree_reset":
+                saved = f" (saved to {data.get('branch')})" if data.get("committed") else ""
+                panel.lines.append(f"[dim]{ts}[/] Worktree reset in {data.get('reset_s', '?')}s{saved}")
+
+            elif event_type == "dispatch_deduplicated":
+                panel.lines.append(f"[dim]{ts}[/] Duplicate dispatch reused this session "
+                                   f"({data.get('hits', 1)}x)")
+
+            elif event_type == "session_ready":
+                mode = data.get("start_mode", "cold")
+                panel.lines.append(f"[dim]{ts}[/] Ready ({mode} start, {data.get('startup_s', '?')}s)")
+
+            elif event_type == "session_limit":
+                panel.lines.append(f"[dim]{ts}[/] [magenta]Stopping: {data.get('reason', '')}[/]")
+
             elif event_type == "session_end":
                 panel.status = data.get("status", "done")
                 panel.cost = data.get("cost", 0.0)
                 panel.duration = data.get("duration_s", 0)
                 panel.lines.append(f"[dim]{ts}[/] [bold]Finished[/]")
 
+            elif event_type == "completion_notified":
+                panel.lines.append(f"[dim]{ts}[/] Result posted to Slack")
+
             elif event_type == "session_followup":
                 panel.status = "running"
                 msg = data.get("message", "")[:60]
@@ -357,6 +397,20 @@ class Dashboard(App):
             model = data.get("model", "?")
             orch_log.write(f"[bold]{ts}[/] Bot started [dim](model: {model})[/]")
 
+        elif event_type == "group_dispatch":
+            ids = ", ".join(data.get("session_ids", []))
+            orch_log.write(f"[dim]{ts}[/] [blue]Batch {data.get('group_id')}[/] {ids} "
+                           f"[dim](quorum {data.get('quorum')})[/]")
+
+        elif event_type == "group_quorum":
+            orch_log.write(f"[dim]{ts}[/] [green]Batch {data.get('group_id')} complete[/] "
+                           f"[dim]({data.get('finished')}/{data.get('total')} finished)[/]")
+
+        elif event_type == "concurrency_adjust":
+            orch_log.write(f"[dim]{ts}[/] [magenta]Session slots {data.get('old')} → {data.get('new')}[/] "
+                           f"[dim]({data.get('reason')}, load {data.get('load_per_cpu')}/cpu, "
+                           f"{data.get('mem_available_mb')} MB free)[/]")
+
     def action_clear_log(self):
         orch_log = self.query_one("#orchestrator-log", RichLog)
         orch_log.clear()
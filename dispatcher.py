@@ -0,0 +1,172 @@
+"""Bounded worker pool for Slack event handling.
+
+Slack listeners hand their work to `dispatcher.submit(key, fn, ...)` and
+return immediately. Jobs that share a key (a channel:thread_ts or DM
+channel) run strictly in submission order; jobs with different keys run in
+parallel on a fixed number of worker threads.
+
+Queue depth, worker utilisation and per-key wait time are emitted through
+event_log so the pool can be sized under load.
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+from config import logger
+from event_log import event_log
+
+EVENT_WORKERS = int(os.environ.get("EVENT_WORKERS", "4"))
+EVENT_QUEUE_MAX = int(os.environ.get("EVENT_QUEUE_MAX", "100"))
+
+
+@dataclass
+class _Job:
+    """A unit of work waiting for a worker."""
+
+    key: str
+    fn: Callable[..., Any]
+    args: tuple
+    kwargs: dict
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+
+class EventDispatcher:
+    """Runs jobs on a bounded pool, serialized per key."""
+
+    def __init__(self, workers: int = EVENT_WORKERS, max_queued: int = EVENT_QUEUE_MAX):
+        self.workers = workers
+        self.max_queued = max_queued
+        self._pending: dict[str, deque[_Job]] = {}  # key -> jobs not yet started
+        self._ready: deque[str] = deque()  # keys with pending jobs and no job running
+        self._active_keys: set[str] = set()  # keys with a job currently running
+        self._queued = 0
+        self._busy = 0
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._threads: list[threading.Thread] = []
+
+    def start(self):
+        """Start the worker threads. Safe to call more than once."""
+        with self._cond:
+            if self._threads:
+                return
+            self._stopping = False
+            for i in range(self.workers):
+                t = threading.Thread(
+                    target=self._worker, name=f"event-worker-{i}", daemon=True
+                )
+                t.start()
+                self._threads.append(t)
+
+    def submit(self, key: str, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> bool:
+        """Queue `fn(*args, **kwargs)` behind any earlier jobs for `key`.
+
+        Returns False (and drops the job) if the queue is full.
+        """
+        self.start()
+        with self._cond:
+            if self._queued >= self.max_queued:
+                queue_depth = self._queued
+                accepted = False
+            else:
+                job = _Job(key=key, fn=fn, args=args, kwargs=kwargs)
+                jobs = self._pending.setdefault(key, deque())
+                jobs.append(job)
+                if len(jobs) == 1 and key not in self._active_keys:
+                    self._ready.append(key)
+                self._queued += 1
+                queue_depth = self._queued
+                key_backlog = len(jobs)
+                accepted = True
+                self._cond.notify()
+
+        if not accepted:
+            logger.warning("Event queue full (%d jobs), dropping job for %s", queue_depth, key)
+            event_log.emit("system", "dispatch_dropped",
+                           key=key, queue_depth=queue_depth)
+            return False
+
+        event_log.emit("system", "dispatch_enqueue",
+                       key=key, queue_depth=queue_depth,
+                       key_backlog=key_backlog)
+        return True
+
+    def stats(self) -> dict:
+        """Snapshot of queue depth and worker utilisation."""
+        with self._cond:
+            return {
+                "queue_depth": self._queued,
+                "busy_workers": self._busy,
+                "workers": self.workers,
+                "utilisation": round(self._busy / self.workers, 2) if self.workers else 0.0,
+                "active_keys": len(self._active_keys),
+            }
+
+    def shutdown(self, timeout: float = 5.0):
+        """Stop accepting work and wait briefly for running jobs to finish."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            threads = list(self._threads)
+            self._threads = []
+        deadline = time.monotonic() + timeout
+        for t in threads:
+            t.join(timeout=max(0.0, deadline - time.monotonic()))
+
+    def _next_job(self) -> _Job | None:
+        """Block until a job for an idle key is available."""
+        with self._cond:
+            while not self._ready and not self._stopping:
+                self._cond.wait()
+            if self._stopping:
+                return None
+            key = self._ready.popleft()
+            job = self._pending[key].popleft()
+            self._active_keys.add(key)
+            self._queued -= 1
+            self._busy += 1
+            return job
+
+    def _finish_job(self, key: str):
+        """Release `key` and schedule its next job, if any."""
+        with self._cond:
+            self._active_keys.discard(key)
+            self._busy -= 1
+            if self._pending.get(key):
+                self._ready.append(key)
+                self._cond.notify()
+            else:
+                self._pending.pop(key, None)
+
+    def _worker(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+
+            wait_s = time.monotonic() - job.enqueued_at
+            stats = self.stats()
+            event_log.emit("system", "dispatch_start",
+                           key=job.key, wait_s=round(wait_s, 3),
+                           queue_depth=stats["queue_depth"],
+                           busy_workers=stats["busy_workers"],
+                           utilisation=stats["utilisation"])
+
+            start = time.monotonic()
+            try:
+                job.fn(*job.args, **job.kwargs)
+            except Exception:
+                logger.exception("Event job for %s failed", job.key)
+            finally:
+                self._finish_job(job.key)
+                event_log.emit("system", "dispatch_end",
+                               key=job.key,
+                               duration_s=round(time.monotonic() - start, 2))
+
+
+# Module-level singleton
+dispatcher = EventDispatcher()
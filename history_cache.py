@@ -0,0 +1,161 @@
+"""Per-conversation cache of converted Slack history.
+
+Each conversation (a channel thread, or a DM channel) keeps the messages
+already converted for OpenAI plus the newest Slack `ts` seen. On the next
+message only the newer part of the history is fetched (via `oldest`) and
+converted, instead of pulling and rebuilding the whole thread.
+
+Entries are dropped when a message in the conversation is edited or
+deleted, and evicted LRU-first when idle past a TTL or when the cache
+grows past its entry/byte caps.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Callable
+
+from event_log import event_log
+
+HISTORY_CACHE_TTL_S = float(os.environ.get("HISTORY_CACHE_TTL_S", "3600"))
+HISTORY_CACHE_MAX_ENTRIES = int(os.environ.get("HISTORY_CACHE_MAX_ENTRIES", "500"))
+HISTORY_CACHE_MAX_BYTES = int(os.environ.get("HISTORY_CACHE_MAX_BYTES", str(20 * 1024 * 1024)))
+
+# Rough per-message overhead (dict + role string) added to the content length.
+_MESSAGE_OVERHEAD_BYTES = 100
+
+# A conversation key: (channel, thread_ts). thread_ts is None for linear DMs.
+HistoryKey = tuple[str, str | None]
+
+
+def _ts(value: str) -> float:
+    return float(value) if value else 0.0
+
+
+def _message_size(msg: dict) -> int:
+    return len(msg.get("content", "")) + _MESSAGE_OVERHEAD_BYTES
+
+
+@dataclass
+class _Entry:
+    """Converted history for one conversation."""
+
+    messages: list[dict] = field(default_factory=list)
+    latest_ts: str | None = None
+    size: int = 0
+    last_access: float = field(default_factory=time.monotonic)
+
+
+class HistoryCache:
+    """Thread-safe LRU/TTL cache of converted conversation histories."""
+
+    def __init__(
+        self,
+        ttl_s: float = HISTORY_CACHE_TTL_S,
+        max_entries: int = HISTORY_CACHE_MAX_ENTRIES,
+        max_bytes: int = HISTORY_CACHE_MAX_BYTES,
+    ):
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[HistoryKey, _Entry] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(
+        self,
+        key: HistoryKey,
+        fetch: Callable[[str | None], list[dict]],
+        convert: Callable[[list[dict]], list[dict]],
+        max_messages: int | None = None,
+    ) -> list[dict]:
+        """Return the converted history for `key`, fetching only what's new.
+
+        `fetch(oldest)` returns raw Slack messages in chronological order,
+        newer than `oldest` when it is set (all of them when it's None).
+        `convert(raw)` turns raw messages into OpenAI messages.
+        `max_messages` keeps only the most recent N converted messages.
+        """
+        with self._lock:
+            self._evict_expired()
+            entry = self._entries.get(key)
+            oldest = entry.latest_ts if entry else None
+
+        start = time.time()
+        raw = fetch(oldest)
+        if oldest:
+            # `oldest` is exclusive, but conversations.replies always
+            # includes the thread parent — drop anything already seen.
+            raw = [m for m in raw if _ts(m.get("ts")) > _ts(oldest)]
+        converted = convert(raw)
+        fetch_latency = time.time() - start
+
+        with self._lock:
+            entry = self._entries.get(key)
+            # Invalidated or replaced while we were fetching: the delta no
+            # longer applies, so fall through to a full rebuild below.
+            stale = oldest is not None and (entry is None or entry.latest_ts != oldest)
+            if not stale:
+                if entry is None:
+                    entry = _Entry()
+                    self._entries[key] = entry
+                entry.messages.extend(converted)
+                if raw:
+                    entry.latest_ts = max((m.get("ts") for m in raw), key=_ts)
+                if max_messages is not None and len(entry.messages) > max_messages:
+                    del entry.messages[:-max_messages]
+
+                new_size = sum(_message_size(m) for m in entry.messages)
+                self._bytes += new_size - entry.size
+                entry.size = new_size
+                entry.last_access = time.monotonic()
+                self._entries.move_to_end(key)
+                messages = list(entry.messages)
+                self._evict_over_capacity()
+
+        if stale:
+            return self.get(key, fetch, convert, max_messages)
+
+        event_log.emit("system", "history_fetch",
+                       channel=key[0], thread_ts=key[1],
+                       cached=oldest is not None,
+                       new_messages=len(raw),
+                       total_messages=len(messages),
+                       latency_s=round(fetch_latency, 3))
+        return messages
+
+    def invalidate(self, channel: str, thread_ts: str | None = None):
+        """Drop cached history for a thread (and the channel's linear DM history)."""
+        with self._lock:
+            self._drop((channel, thread_ts))
+            self._drop((channel, None))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes}
+
+    def _drop(self, key: HistoryKey):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self._bytes -= entry.size
+
+    def _evict_expired(self):
+        now = time.monotonic()
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if now - entry.last_access < self.ttl_s:
+                break
+            self._drop(key)
+
+    def _evict_over_capacity(self):
+        while self._entries and (
+            len(self._entries) > self.max_entries or self._bytes > self.max_bytes
+        ):
+            key = next(iter(self._entries))
+            self._drop(key)
+
+
+# Module-level singleton
+history_cache = HistoryCache()
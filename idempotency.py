@@ -0,0 +1,172 @@
+"""Drop redelivered Slack events.
+
+Slack redelivers events it thinks we didn't handle in time, which would
+otherwise run the whole chat() pipeline (and post a reply) twice. Each
+event is identified by several keys — the envelope's event_id, the
+message's client_msg_id, and channel:ts — and a delivery whose keys were
+already seen (still in flight, or completed) is dropped.
+
+Seen keys live in a bounded, TTL'd in-memory map and are appended to a
+small log file so a restart doesn't forget them: `+` when an event is
+claimed, `=` when it was handled, `-` when it was released. On load only
+completed keys are kept; an event that was still in flight when the
+process died wasn't answered, so its redelivery must run. The file is
+compacted on load and whenever it grows well past the in-memory cap.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from config import logger
+from event_log import LOG_DIR, event_log
+
+DEDUP_TTL_S = float(os.environ.get("DEDUP_TTL_S", "3600"))
+DEDUP_MAX_KEYS = int(os.environ.get("DEDUP_MAX_KEYS", "10000"))
+DEDUP_PATH = Path(os.environ.get("DEDUP_PATH", str(LOG_DIR / "seen_events.log")))
+
+_IN_FLIGHT = "in_flight"
+_COMPLETED = "completed"
+
+
+class IdempotencyCache:
+    """Thread-safe seen-key map with cheap append-only persistence."""
+
+    def __init__(self, path: Path | None = DEDUP_PATH, ttl_s: float = DEDUP_TTL_S,
+                 max_keys: int = DEDUP_MAX_KEYS):
+        self.path = path
+        self.ttl_s = ttl_s
+        self.max_keys = max_keys
+        self.duplicates = 0
+        self._keys: OrderedDict[str, tuple[str, float]] = OrderedDict()  # key -> (state, seen_at epoch)
+        self._lock = threading.Lock()
+        self._file = None
+        self._lines_written = 0
+        if path is not None:
+            self._load()
+
+    def begin(self, keys: list[str]) -> str | None:
+        """Claim an event. Returns None if it's new, else why it's a duplicate."""
+        keys = [k for k in keys if k]
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            for key in keys:
+                seen = self._keys.get(key)
+                if seen:
+                    self.duplicates += 1
+                    reason, duplicates = seen[0], self.duplicates
+                    break
+            else:
+                for key in keys:
+                    self._keys[key] = (_IN_FLIGHT, now)
+                    self._keys.move_to_end(key)
+                    self._append("+", key, now)
+                while len(self._keys) > self.max_keys:
+                    self._keys.popitem(last=False)
+                return None
+
+        event_log.emit("system", "event_deduplicated",
+                       key=key, reason=reason, duplicates_total=duplicates)
+        return reason
+
+    def complete(self, keys: list[str]):
+        """Mark a claimed event as handled."""
+        with self._lock:
+            for key in keys:
+                if key in self._keys:
+                    seen_at = self._keys[key][1]
+                    self._keys[key] = (_COMPLETED, seen_at)
+                    self._append("=", key, seen_at)
+
+    def release(self, keys: list[str]):
+        """Forget a claimed event (handling failed), so a retry can run."""
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                if key and self._keys.pop(key, None):
+                    self._append("-", key, now)
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+    def _expire(self, now: float):
+        while self._keys:
+            key, (_, seen_at) = next(iter(self._keys.items()))
+            if now - seen_at < self.ttl_s:
+                break
+            self._keys.popitem(last=False)
+
+    def _append(self, op: str, key: str, now: float):
+        if self._file is None:
+            return
+        try:
+            self._file.write(f"{now:.0f} {op} {key}\n")
+            self._file.flush()
+            self._lines_written += 1
+            if self._lines_written > 2 * self.max_keys:
+                self._compact()
+        except OSError as e:
+            logger.warning("Could not persist dedup key: %s", e)
+
+    def _load(self):
+        """Read surviving keys from disk, then rewrite the file compactly."""
+        now = time.time()
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    parts = line.rstrip("\n").split(" ", 2)
+                    if len(parts) != 3:
+                        continue
+                    seen_at, op, key = float(parts[0]), parts[1], parts[2]
+                    if op == "-":
+                        self._keys.pop(key, None)
+                    elif now - seen_at < self.ttl_s:
+                        self._keys[key] = (_COMPLETED if op == "=" else _IN_FLIGHT, seen_at)
+                        self._keys.move_to_end(key)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable dedup log %s: %s", self.path, e)
+        for key in [k for k, (state, _) in self._keys.items() if state == _IN_FLIGHT]:
+            del self._keys[key]  # never completed: let the redelivery through
+        while len(self._keys) > self.max_keys:
+            self._keys.popitem(last=False)
+        self._compact()
+
+    def _compact(self):
+        """Rewrite the log with only the keys still held in memory."""
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix(".tmp")
+            with open(tmp, "w") as f:
+                for key, (state, seen_at) in self._keys.items():
+                    f.write(f"{seen_at:.0f} {'=' if state == _COMPLETED else '+'} {key}\n")
+            os.replace(tmp, self.path)
+            if self._file:
+                self._file.close()
+            self._file = open(self.path, "a")
+            self._lines_written = len(self._keys)
+        except OSError as e:
+            logger.warning("Could not compact dedup log %s: %s", self.path, e)
+
+
+def event_keys(body: dict, event: dict) -> list[str]:
+    """Every identifier a redelivery of this event could share."""
+    keys = []
+    if body.get("event_id"):
+        keys.append(f"event:{body['event_id']}")
+    if event.get("client_msg_id"):
+        keys.append(f"msg:{event['client_msg_id']}")
+    if event.get("channel") and event.get("ts"):
+        keys.append(f"ts:{event['channel']}:{event['ts']}")
+    return keys
+
+
+# Module-level singleton
+idempotency = IdempotencyCache()
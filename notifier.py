@@ -0,0 +1,108 @@
+"""Post a completion notice to Slack when a dispatched session finishes.
+
+SessionManager calls `notify()` from its status-transition hook (on the
+session I/O thread), so it only formats the message and queues it. A
+background thread posts queued notices into the thread (or DM) the task
+was dispatched from. It spaces posts per channel by NOTIFY_MIN_INTERVAL_S
+and backs off when Slack rate-limits.
+"""
+
+import os
+import queue
+import threading
+import time
+
+from slack_sdk.errors import SlackApiError
+
+from config import app, logger
+from event_log import event_log
+from streaming import to_mrkdwn
+
+NOTIFY_ON_COMPLETION = os.environ.get("NOTIFY_ON_COMPLETION", "true").lower() in ("1", "true", "yes")
+NOTIFY_MIN_INTERVAL_S = float(os.environ.get("NOTIFY_MIN_INTERVAL_S", "1.0"))
+NOTIFY_QUEUE_MAX = int(os.environ.get("NOTIFY_QUEUE_MAX", "100"))
+RESULT_PREVIEW_CHARS = 600
+
+
+def _format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(round(seconds), 60)
+    return f"{minutes}m {seconds}s" if minutes else f"{seconds}s"
+
+
+def format_completion(session) -> str:
+    """Compact Slack message summarizing a finished session."""
+    icon = ":white_check_mark:" if session.status == "done" else ":x:"
+    header = (f"{icon} *{session.internal_id}* {session.status} — "
+              f"${session.cost:.2f}, {_format_duration(session.age_seconds())}")
+    lines = [header, f"_{session.task[:150]}_"]
+    if session.result:
+        preview = session.result.strip()
+        if len(preview) > RESULT_PREVIEW_CHARS:
+            preview = preview[:RESULT_PREVIEW_CHARS].rstrip() + "…"
+        lines.append(to_mrkdwn(preview))
+    return "\n".join(lines)
+
+
+class CompletionNotifier:
+    """Rate-limited background poster for session completion notices."""
+
+    def __init__(self, client, min_interval_s: float = NOTIFY_MIN_INTERVAL_S,
+                 max_queued: int = NOTIFY_QUEUE_MAX):
+        self.client = client
+        self.min_interval_s = min_interval_s
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queued)
+        self._last_post: dict[str, float] = {}  # channel -> monotonic time of last post
+        self._thread: threading.Thread | None = None
+
+    def notify(self, session):
+        """Queue a notice for `session` if it was dispatched from Slack."""
+        if not NOTIFY_ON_COMPLETION or session.origin is None:
+            return
+        channel, thread_ts = session.origin
+        try:
+            self._queue.put_nowait((session.internal_id, channel, thread_ts,
+                                    format_completion(session)))
+        except queue.Full:
+            logger.warning("Notifier queue full, dropping notice for %s", session.internal_id)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="notifier", daemon=True)
+        self._thread.start()
+
+    def shutdown(self):
+        if self._thread:
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            try:
+                self._post(*item)
+            except Exception:
+                # A network error or a bad Retry-After must not end the thread.
+                logger.exception("Failed to post completion notice for %s", item[0])
+
+    def _post(self, internal_id: str, channel: str, thread_ts: str | None, text: str):
+        wait = self._last_post.get(channel, 0) + self.min_interval_s - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        for attempt in range(3):
+            try:
+                self.client.chat_postMessage(channel=channel, thread_ts=thread_ts, text=text)
+                break
+            except SlackApiError as e:
+                if e.response.status_code == 429 and attempt < 2:
+                    time.sleep(float(e.response.headers.get("Retry-After", 1)))
+                    continue
+                logger.error("Failed to post completion notice for %s: %s", internal_id, e)
+                return
+        self._last_post[channel] = time.monotonic()
+        event_log.emit("session", "completion_notified",
+                       session_id=internal_id, channel=channel, thread_ts=thread_ts)
+
+
+# Module-level singleton
+notifier = CompletionNotifier(app.client)
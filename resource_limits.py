@@ -0,0 +1,224 @@
+"""OS-level limits for session processes, and load-adaptive concurrency.
+
+`spawn()` starts a Claude Code process with per-process rlimits (address
+space, CPU seconds, open files) and, when SESSION_CGROUP_ROOT points at a
+delegated cgroup v2 directory, in its own child cgroup with memory, pids
+and CPU limits. `release()` kills anything left in that cgroup once the
+session exits and removes it.
+
+The limits are applied by a small /bin/sh wrapper that sets them on
+itself and then execs the command (same pid). preexec_fn isn't safe in a
+threaded process, and setting them from the parent after Popen would
+leave a window in which claude's first children start unlimited or
+outside the cgroup.
+
+ConcurrencyController lowers the effective number of session slots below
+MAX_CONCURRENT_SESSIONS while the machine is loaded (1-minute load average
+per CPU, MemAvailable) and raises it back as load falls and there is a
+backlog, holding off while recent sessions run much slower than usual.
+Every change is emitted as a `concurrency_adjust` event.
+"""
+
+import os
+import shlex
+import subprocess
+import threading
+import uuid
+from pathlib import Path
+from typing import Callable
+
+from config import logger
+from event_log import event_log
+
+# Per-process rlimits (0 = leave unlimited)
+SESSION_RLIMIT_AS_MB = int(os.environ.get("SESSION_RLIMIT_AS_MB", "0"))
+SESSION_RLIMIT_CPU_S = int(os.environ.get("SESSION_RLIMIT_CPU_S", "0"))
+SESSION_RLIMIT_NOFILE = int(os.environ.get("SESSION_RLIMIT_NOFILE", "0"))
+
+# cgroup v2 (off unless SESSION_CGROUP_ROOT is a directory the bot may write to)
+SESSION_CGROUP_ROOT = os.environ.get("SESSION_CGROUP_ROOT", "")
+SESSION_CGROUP_MEMORY_MAX = os.environ.get("SESSION_CGROUP_MEMORY_MAX", "4G")
+SESSION_CGROUP_PIDS_MAX = os.environ.get("SESSION_CGROUP_PIDS_MAX", "256")
+SESSION_CGROUP_CPU_MAX = os.environ.get("SESSION_CGROUP_CPU_MAX", "max")  # e.g. "200000 100000" = 2 CPUs
+
+ADAPTIVE_CONCURRENCY = os.environ.get("ADAPTIVE_CONCURRENCY", "false").lower() in ("1", "true", "yes")
+ADAPTIVE_MIN_SESSIONS = int(os.environ.get("ADAPTIVE_MIN_SESSIONS", "1"))
+ADAPTIVE_INTERVAL_S = float(os.environ.get("ADAPTIVE_INTERVAL_S", "15"))
+ADAPTIVE_MAX_LOAD = float(os.environ.get("ADAPTIVE_MAX_LOAD", "1.0"))  # load average per CPU
+ADAPTIVE_MIN_FREE_MB = int(os.environ.get("ADAPTIVE_MIN_FREE_MB", "1024"))
+ADAPTIVE_SLOWDOWN = float(os.environ.get("ADAPTIVE_SLOWDOWN", "1.5"))  # recent/typical duration
+
+_cgroups: dict[int, Path] = {}  # pid -> its cgroup directory
+_cgroups_lock = threading.Lock()
+
+
+def _wrap(cmd: list[str], cgroup: Path | None) -> list[str]:
+    """`cmd` behind a shell that applies the rlimits and joins `cgroup` first."""
+    script = " && ".join([*(f"ulimit {flag} {value}"
+                            for flag, value in (("-v", SESSION_RLIMIT_AS_MB * 1024),  # KiB
+                                                ("-t", SESSION_RLIMIT_CPU_S),
+                                                ("-n", SESSION_RLIMIT_NOFILE))
+                            if value),
+                          'exec "$@"'])  # a limit that can't be set stops the run
+    if cgroup:
+        # Best effort: spawn() checks the move and cleans up if it failed.
+        procs = shlex.quote(str(cgroup / "cgroup.procs"))
+        script = f"{{ echo $$ > {procs}; }} 2>/dev/null; {script}"
+    return ["/bin/sh", "-c", script, "sh", *cmd]
+
+
+def _create_cgroup() -> Path | None:
+    path = Path(SESSION_CGROUP_ROOT) / f"session-{uuid.uuid4().hex[:8]}"
+    try:
+        path.mkdir()
+        for name, value in (("memory.max", SESSION_CGROUP_MEMORY_MAX),
+                            ("pids.max", SESSION_CGROUP_PIDS_MAX),
+                            ("cpu.max", SESSION_CGROUP_CPU_MAX)):
+            if value and (path / name).exists():
+                (path / name).write_text(value)
+    except OSError as e:
+        logger.warning("cgroup limits unavailable under %s: %s", SESSION_CGROUP_ROOT, e)
+        _remove_cgroup(path)
+        return None
+    return path
+
+
+def _remove_cgroup(path: Path):
+    try:
+        if (path / "cgroup.kill").exists():
+            (path / "cgroup.kill").write_text("1")  # stragglers the session left behind
+        path.rmdir()
+    except OSError as e:
+        logger.debug("Could not remove cgroup %s: %s", path, e)
+
+
+def spawn(cmd: list[str], **kwargs) -> subprocess.Popen:
+    """subprocess.Popen with the configured rlimits and cgroup applied."""
+    rlimits = os.name == "posix" and (SESSION_RLIMIT_AS_MB or SESSION_RLIMIT_CPU_S
+                                      or SESSION_RLIMIT_NOFILE)
+    cgroup = _create_cgroup() if SESSION_CGROUP_ROOT else None
+    try:
+        process = subprocess.Popen(_wrap(cmd, cgroup) if rlimits or cgroup else cmd, **kwargs)
+    except OSError:
+        if cgroup:
+            _remove_cgroup(cgroup)
+        raise
+    if cgroup:
+        # The wrapper joined the cgroup before exec'ing claude. Writing the
+        # pid again is a no-op then, and otherwise surfaces why it failed.
+        try:
+            (cgroup / "cgroup.procs").write_text(str(process.pid))
+        except OSError as e:
+            logger.warning("Could not move pid %d into %s: %s", process.pid, cgroup, e)
+            _remove_cgroup(cgroup)
+            return process
+        with _cgroups_lock:
+            _cgroups[process.pid] = cgroup
+    return process
+
+
+def release(process: subprocess.Popen):
+    """Clean up the cgroup of an exited process, if it had one."""
+    with _cgroups_lock:
+        cgroup = _cgroups.pop(process.pid, None)
+    if cgroup:
+        _remove_cgroup(cgroup)
+
+
+def _load_per_cpu() -> float | None:
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except OSError:
+        return None
+
+
+def _mem_available_mb() -> int | None:
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    return None
+
+
+class ConcurrencyController:
+    """Adjusts the session slot count to what the machine can take."""
+
+    def __init__(self, enabled: bool = ADAPTIVE_CONCURRENCY,
+                 min_slots: int = ADAPTIVE_MIN_SESSIONS,
+                 interval_s: float = ADAPTIVE_INTERVAL_S):
+        self.enabled = enabled
+        self.min_slots = min_slots
+        self.interval_s = interval_s
+        self.limit: int | None = None  # None until the first adjustment
+        self.recent_s: float | None = None  # fast EWMA of session durations
+        self.typical_s: float | None = None  # slow EWMA
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def slots(self, ceiling: int) -> int:
+        """Effective slot count, never above `ceiling` (MAX_CONCURRENT_SESSIONS)."""
+        if not self.enabled or self.limit is None:
+            return ceiling
+        return min(self.limit, ceiling)
+
+    def record_duration(self, seconds: float):
+        with self._lock:
+            if self.recent_s is None:
+                self.recent_s = self.typical_s = seconds
+            else:
+                self.recent_s += 0.3 * (seconds - self.recent_s)
+                self.typical_s += 0.05 * (seconds - self.typical_s)
+
+    def evaluate(self, ceiling: int, running: int, backlog: bool,
+                 load: float | None = None, mem_mb: int | None = None) -> int:
+        """Take one step up or down based on current conditions; returns the new limit."""
+        load = _load_per_cpu() if load is None else load
+        mem_mb = _mem_available_mb() if mem_mb is None else mem_mb
+        with self._lock:
+            current = self.slots(ceiling)
+            slow = (self.recent_s is not None
+                    and self.recent_s > self.typical_s * ADAPTIVE_SLOWDOWN)
+            new, reason = current, None
+            if load is not None and load > ADAPTIVE_MAX_LOAD:
+                new, reason = max(self.min_slots, current - 1), "high_load"
+            elif mem_mb is not None and mem_mb < ADAPTIVE_MIN_FREE_MB:
+                new, reason = max(self.min_slots, current - 1), "low_memory"
+            elif (current < ceiling and backlog and running >= current and not slow
+                  and (load is None or load < ADAPTIVE_MAX_LOAD * 0.75)
+                  and (mem_mb is None or mem_mb > ADAPTIVE_MIN_FREE_MB * 2)):
+                new, reason = current + 1, "headroom"
+            self.limit = new
+            recent_s, typical_s = self.recent_s, self.typical_s
+        if new != current:
+            logger.info("Session slots %d -> %d (%s)", current, new, reason)
+            event_log.emit("system", "concurrency_adjust",
+                           old=current, new=new, reason=reason, ceiling=ceiling,
+                           running=running,
+                           load_per_cpu=None if load is None else round(load, 2),
+                           mem_available_mb=mem_mb,
+                           recent_duration_s=None if recent_s is None else round(recent_s, 1),
+                           typical_duration_s=None if typical_s is None else round(typical_s, 1))
+        return new
+
+    def start(self, tick: Callable[[], None]):
+        """Call `tick` every interval on a background thread (if enabled)."""
+        with self._lock:
+            if not self.enabled or self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, args=(tick,),
+                                            name="concurrency", daemon=True)
+            self._thread.start()
+
+    def _run(self, tick: Callable[[], None]):
+        while not self._stop.wait(self.interval_s):
+            try:
+                tick()
+            except Exception:
+                logger.exception("Concurrency controller tick failed")
+
+    def close(self):
+        self._stop.set()
@@ -0,0 +1,130 @@
+"""Pick a model, reasoning effort and tool subset for each request.
+
+Most Slack messages don't need the full agent: "thanks!" or a quick
+factual question can go to a small model with low effort and few tools.
+Routing is heuristic first; when ROUTER_CLASSIFIER_MODEL is set, messages
+the heuristics can't place are classified by that (small) model.
+
+Fast routes always include the escalation tool. If the fast model calls
+it — or any tool it wasn't given — chat() restarts the turn with the full
+configuration.
+"""
+
+import os
+import re
+import time
+from dataclasses import dataclass
+
+from config import OPENAI_MODEL, logger, openai_client
+from prompts import ROUTER_INSTRUCTIONS
+from tool_schemas import ESCALATE_TOOL, TOOLS, WEB_SEARCH_TOOL
+
+ROUTING_ENABLED = os.environ.get("ROUTING_ENABLED", "true").lower() in ("1", "true", "yes")
+ROUTER_FAST_MODEL = os.environ.get("ROUTER_FAST_MODEL", "gpt-5-mini")
+ROUTER_CLASSIFIER_MODEL = os.environ.get("ROUTER_CLASSIFIER_MODEL", "")  # empty = heuristics only
+FULL_REASONING_EFFORT = "medium"
+
+# Thanks, laughter and greetings: they need no tools and no reasoning.
+# Nothing that can answer a question ("yes", "ok", "sounds good", 👍) is
+# here, since it may confirm something the assistant proposed, and that
+# goes through the normal routing.
+_ACK_RE = re.compile(
+    r"^(thanks?( you)?|thx|ty|lol|haha|bye|hi|hello|hey|gm|gn)[\s!.,:)]*$",
+    re.IGNORECASE,
+)
+
+# Words that point at tools only the full agent has (computer tasks,
+# memory) or at dispatched sessions.
+_FULL_AGENT_RE = re.compile(
+    r"\b(computer|file|files|folder|note|notes|list|document|sandbox|run|"
+    r"script|command|terminal|browser|website|log ?in|click|form|screenshot|"
+    r"create|edit|write|save|remember|forget|task|tasks|session|dispatch|"
+    r"status|progress|check|done|finish|finished|wait|result|open)\b"
+    r"|\b(i am|i'm|i live|my name|i work|i like|i hate|i love)\b",
+    re.IGNORECASE,
+)
+
+_SPEAKER_RE = re.compile(r"^\[[^\]]*\]:\s*")
+_FAST_MAX_WORDS = 30
+
+
+@dataclass
+class RouteDecision:
+    """Model configuration chosen for one chat() call."""
+
+    route: str  # "ack" | "fast" | "full"
+    model: str
+    effort: str
+    tools: list[dict]
+    reason: str
+    latency_s: float = 0.0
+
+    @property
+    def tool_names(self) -> list[str]:
+        return [t.get("name", t["type"]) for t in self.tools]
+
+    def allows(self, tool_name: str) -> bool:
+        return tool_name in self.tool_names
+
+
+def full_route(reason: str) -> RouteDecision:
+    return RouteDecision(route="full", model=OPENAI_MODEL, effort=FULL_REASONING_EFFORT,
+                         tools=TOOLS, reason=reason)
+
+
+def _fast_route(reason: str) -> RouteDecision:
+    return RouteDecision(route="fast", model=ROUTER_FAST_MODEL, effort="low",
+                         tools=[WEB_SEARCH_TOOL, ESCALATE_TOOL], reason=reason)
+
+
+def _ack_route(reason: str) -> RouteDecision:
+    return RouteDecision(route="ack", model=ROUTER_FAST_MODEL, effort="low",
+                         tools=[ESCALATE_TOOL], reason=reason)
+
+
+def _classify(text: str) -> str | None:
+    """Ask the classifier model for "simple" or "complex"; None on failure."""
+    try:
+        response = openai_client.responses.create(
+            model=ROUTER_CLASSIFIER_MODEL,
+            instructions=ROUTER_INSTRUCTIONS,
+            input=[{"role": "user", "content": text[:2000]}],
+        )
+    except Exception as e:
+        logger.warning("Router classification failed: %s", e)
+        return None
+    label = response.output_text.strip().lower()
+    return label if label in ("simple", "complex") else None
+
+
+def route(messages: list[dict]) -> RouteDecision:
+    """Choose the configuration for answering the latest user message."""
+    start = time.time()
+    decision = _route(messages)
+    decision.latency_s = round(time.time() - start, 3)
+    return decision
+
+
+def _route(messages: list[dict]) -> RouteDecision:
+    if not ROUTING_ENABLED:
+        return full_route("routing disabled")
+
+    last_user = next((m for m in reversed(messages) if m["role"] == "user"), None)
+    if last_user is None:
+        return full_route("no user message")
+    text = _SPEAKER_RE.sub("", last_user["content"]).strip()
+
+    if _ACK_RE.match(text):
+        return _ack_route("acknowledgement")
+    if "```" in text or _FULL_AGENT_RE.search(text):
+        return full_route("needs agent tools")
+    if len(text.split()) <= _FAST_MAX_WORDS:
+        return _fast_route("short message")
+
+    if ROUTER_CLASSIFIER_MODEL:
+        label = _classify(text)
+        if label == "simple":
+            return _fast_route("classifier: simple")
+        if label == "complex":
+            return full_route("classifier: complex")
+    return full_route("default")
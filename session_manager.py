@@ -5,26 +5,119 @@ read their output passively, and send follow-ups when needed.
 
 Sandbox enforcement uses Claude Code's native sandbox (macOS Seatbelt /
 Linux bubblewrap) via --settings, which blocks file writes at the OS level.
+
+All session stdout/stderr is read by a single I/O thread (_SessionIOLoop)
+that multiplexes every pipe with a selector, so the thread count stays
+fixed no matter how many sessions are running.
+
+Dispatches beyond MAX_CONCURRENT_SESSIONS wait in a queue (status
+"queued") and start as slots free up: interactive before background, then
+the user with the fewest running sessions, then first come first served.
+Browser tasks additionally share MAX_BROWSER_SESSIONS slots.
+
+With WARM_POOL_SIZE > 0, idle `claude` processes are kept waiting for a
+stream-json prompt on stdin, so plain (non-browser, non-isolated) tasks
+skip CLI startup; see _WarmPool.
+
+Session stdout is kept in a Transcript (see transcripts.py): the full
+stream on disk, only a bounded tail in memory. Session metadata is
+persisted in a SessionRegistry (see session_registry.py) and restored on
+startup.
+
+Finished sessions are archived (dropped from memory, kept in the registry)
+after ARCHIVE_AFTER_S or beyond MAX_FINISHED_SESSIONS; read_output and
+send_followup still find them by id.
+
+Each run is held to a SessionBudget (wall clock, estimated cost, output
+bytes). The I/O thread checks budgets as output arrives and about once a
+second, and stops offenders with SIGTERM, then SIGKILL after KILL_GRACE_S.
+They end with status "timeout" or "budget_exceeded".
+
+Dispatching a task identical to one already queued, running or recently
+done (same normalized text and flags, from the same user and Slack
+thread) returns that session instead of starting another; see
+_task_fingerprint.
+
+dispatch_group() starts several tasks under one group id. read_group()
+merges their results into a single size-bounded report, and wait_for_group()
+blocks until a quorum of them has finished.
+
+Isolated sessions run in a git worktree leased from a WorktreePool; a
+queued isolated session waits until one is free.
+
+Processes are started through resource_limits.spawn (rlimits, optional
+cgroup v2), and the number of running slots may be lowered below
+MAX_CONCURRENT_SESSIONS by its ConcurrencyController when the machine is
+loaded.
 """
 
+import hashlib
 import json
 import os
+import re
+import selectors
+import signal
 import subprocess
 import threading
 import time
+from collections import deque
+from itertools import islice
 from dataclasses import dataclass, field
+from typing import Callable
 from datetime import datetime, timezone
 
 from config import logger
 from event_log import event_log
+import resource_limits
+from resource_limits import ConcurrencyController
+from session_registry import SessionRegistry
+from transcripts import Transcript, transcript_store
+from worktree_pool import WORKTREE_POOL_SIZE, WorktreePool
 
 CLAUDE_CODE_PATH = os.environ.get("CLAUDE_CODE_PATH", "claude")
 MAX_CONCURRENT_SESSIONS = int(os.environ.get("MAX_CONCURRENT_SESSIONS", "3"))
+MAX_BROWSER_SESSIONS = int(os.environ.get("MAX_BROWSER_SESSIONS", "1"))  # there is one Chrome
+MAX_QUEUED_SESSIONS = int(os.environ.get("MAX_QUEUED_SESSIONS", "50"))
+SESSION_READY_TIMEOUT_S = float(os.environ.get("SESSION_READY_TIMEOUT_S", "10"))
+ARCHIVE_AFTER_S = float(os.environ.get("ARCHIVE_AFTER_S", "86400"))  # finished sessions leave memory after this
+MAX_FINISHED_SESSIONS = int(os.environ.get("MAX_FINISHED_SESSIONS", "50"))  # ...or beyond this many
+WAIT_FOR_TASKS_MAX_S = float(os.environ.get("WAIT_FOR_TASKS_MAX_S", "120"))
+# A repeat of a queued/running task, or of one that finished successfully
+# within this window, returns the existing session (0 = never coalesce).
+DISPATCH_DEDUP_WINDOW_S = float(os.environ.get("DISPATCH_DEDUP_WINDOW_S", "600"))
+
+# Default per-session budgets (0 = unlimited); dispatch() can override them.
+SESSION_TIMEOUT_S = float(os.environ.get("SESSION_TIMEOUT_S", "1800"))
+SESSION_MAX_COST_USD = float(os.environ.get("SESSION_MAX_COST_USD", "2.0"))
+# Highest limits a dispatch may ask for (the model can't lift them past these)
+SESSION_TIMEOUT_CAP_S = float(os.environ.get("SESSION_TIMEOUT_CAP_S", "7200"))
+SESSION_MAX_COST_CAP_USD = float(os.environ.get("SESSION_MAX_COST_CAP_USD", "10.0"))
+SESSION_MAX_OUTPUT_BYTES = int(os.environ.get("SESSION_MAX_OUTPUT_BYTES", str(50 * 1024 * 1024)))
+KILL_GRACE_S = float(os.environ.get("KILL_GRACE_S", "10"))  # SIGTERM -> SIGKILL
+
+# USD per million tokens, for estimating cost from streamed usage before
+# the final result reports the real total. Override with
+# SESSION_TOKEN_PRICES="input=3,output=15,cache_read=0.3,cache_write=3.75".
+SESSION_TOKEN_PRICES: dict[str, float] = {
+    "input": 3.0,
+    "output": 15.0,
+    "cache_read": 0.3,
+    "cache_write": 3.75,
+}
+for _pair in filter(None, os.environ.get("SESSION_TOKEN_PRICES", "").split(",")):
+    _kind, _, _price = _pair.partition("=")
+    SESSION_TOKEN_PRICES[_kind.strip()] = float(_price)
+WARM_POOL_SIZE = int(os.environ.get("WARM_POOL_SIZE", "0"))  # 0 = always cold-start
 DEFAULT_MAX_TURNS = int(os.environ.get("DEFAULT_MAX_TURNS", "10"))
 DEFAULT_ALLOWED_TOOLS = os.environ.get(
     "DEFAULT_ALLOWED_TOOLS", "Bash,Read,Edit,Write,Glob,Grep"
 )
 SANDBOX_DIR = os.path.abspath(os.environ.get("SANDBOX_DIR", "sandbox"))
+STDERR_TAIL_LINES = 50  # stderr lines kept per session for diagnostics
+SESSION_EVENTS_MAX = int(os.environ.get("SESSION_EVENTS_MAX", "2000"))
+READ_OUTPUT_MAX_CHARS = int(os.environ.get("READ_OUTPUT_MAX_CHARS", "4000"))
+MAX_GROUP_SIZE = int(os.environ.get("MAX_GROUP_SIZE", "10"))  # tasks per dispatch_group()
+GROUP_RESULT_MAX_CHARS = int(os.environ.get("GROUP_RESULT_MAX_CHARS", "8000"))
 
 # Settings JSON for Claude Code's native sandbox.
 # sandbox.filesystem rules are enforced at the OS level (Seatbelt/bubblewrap),
@@ -68,117 +161,811 @@ def _ensure_sandbox_dir():
             )
 
 
+class _LineFramer:
+    """Splits a byte stream read in arbitrary chunks into text lines."""
+
+    def __init__(self):
+        self._buf = bytearray()
+
+    def feed(self, chunk: bytes) -> list[str]:
+        self._buf.extend(chunk)
+        *lines, rest = self._buf.split(b"\n")
+        self._buf = bytearray(rest)
+        return [line.decode("utf-8", errors="replace") for line in lines]
+
+    def flush(self) -> list[str]:
+        """Return whatever is left after EOF (a final unterminated line)."""
+        rest, self._buf = self._buf, bytearray()
+        return [rest.decode("utf-8", errors="replace")] if rest else []
+
+
+class _SessionIOLoop:
+    """One thread that reads stdout and stderr of every session process.
+
+    Pipes are non-blocking and multiplexed with a selector; complete lines
+    are handed to the owning Session. When both pipes of a process hit EOF,
+    the process is reaped and the session's status finalized.
+    """
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        os.set_blocking(self._wake_w, False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ, None)
+        self._pending: list["Session"] = []
+        self._open_streams: dict[int, int] = {}  # id(process) -> pipes still open
+        self._reaping: list[tuple["Session", subprocess.Popen]] = []
+        # id(process) -> (session, process), for budget checks
+        self._watched: dict[int, tuple["Session", subprocess.Popen]] = {}
+        self._last_sweep = 0.0
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+
+    def register(self, session: "Session"):
+        """Start reading the current process of `session`."""
+        with self._lock:
+            self._pending.append(session)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="session-io", daemon=True
+                )
+                self._thread.start()
+        self._wake()
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w, b"\0")
+        except BlockingIOError:
+            pass  # already has a wake-up pending
+
+    def _add_pending(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for session in pending:
+            process = session.process
+            self._open_streams[id(process)] = 2
+            self._watched[id(process)] = (session, process)
+            for stream, is_stderr in ((process.stdout, False), (process.stderr, True)):
+                os.set_blocking(stream.fileno(), False)
+                self._selector.register(
+                    stream, selectors.EVENT_READ,
+                    (session, process, is_stderr, _LineFramer()),
+                )
+
+    def _run(self):
+        while True:
+            self._add_pending()
+            timeout = 0.2 if self._reaping else (1.0 if self._watched else None)
+            for key, _ in self._selector.select(timeout):
+                if key.data is None:
+                    try:
+                        while os.read(self._wake_r, 4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                # One misbehaving session must not take down the only I/O thread.
+                try:
+                    self._read(key)
+                except Exception:
+                    logger.exception("Error reading output of %s", key.data[0].internal_id)
+            self._reap()
+            now = time.monotonic()
+            if now - self._last_sweep >= 1.0:
+                self._last_sweep = now
+                for session, process in list(self._watched.values()):
+                    try:
+                        session._check_limits(process, now)
+                    except Exception:
+                        logger.exception("Error checking limits of %s", session.internal_id)
+
+    def _read(self, key: selectors.SelectorKey):
+        session, process, is_stderr, framer = key.data
+        try:
+            chunk = os.read(key.fd, 65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            chunk = b""
+        lines = framer.feed(chunk) if chunk else framer.flush()
+        for line in lines:
+            try:
+                session._handle_output(process, line, is_stderr)
+            except Exception:
+                # Keep going so an EOF below still unregisters the pipe.
+                logger.exception("Error handling output of %s", session.internal_id)
+        if chunk:
+            if process is session.process:
+                session.output_bytes += len(chunk)
+                if session.output_bytes > session.budget.max_output_bytes > 0:
+                    session._check_limits(process, time.monotonic())
+            return
+
+        # EOF on this pipe.
+        self._selector.unregister(key.fileobj)
+        key.fileobj.close()
+        self._open_streams[id(process)] -= 1
+        if self._open_streams[id(process)] == 0:
+            del self._open_streams[id(process)]
+            self._reaping.append((session, process))
+
+    def _reap(self):
+        still_running = []
+        for session, process in self._reaping:
+            if process.poll() is None:
+                still_running.append((session, process))
+            else:
+                self._watched.pop(id(process), None)
+                try:
+                    resource_limits.release(process)
+                    session._on_process_exit(process)
+                except Exception:
+                    logger.exception("Error finishing session %s", session.internal_id)
+        self._reaping = still_running
+
+
+_io_loop = _SessionIOLoop()
+
+
+_EVENT_LABELS = {
+    "assistant": "Assistant",
+    "tool_call": "Tool call",
+    "tool_result": "Tool result",
+    "followup": "Follow-up sent",
+}
+
+
+def _stream_json_prompt(text: str) -> bytes:
+    """A user message in Claude Code's --input-format stream-json."""
+    message = {"type": "user", "message": {"role": "user", "content": text}}
+    return (json.dumps(message) + "\n").encode("utf-8")
+
+
+class _WarmPool:
+    """Idle `claude` workers, pre-started in SANDBOX_DIR with the sandbox
+    settings, each waiting for one stream-json prompt on stdin.
+
+    take() hands out a live worker (or None); the pool refills itself on a
+    background thread.
+    """
+
+    def __init__(self, size: int = WARM_POOL_SIZE):
+        self.size = size
+        self._idle: list[subprocess.Popen] = []
+        self._lock = threading.Lock()
+        self._filling = False
+        self._closed = False
+
+    def fill_async(self):
+        with self._lock:
+            if self._filling or self._closed or len(self._idle) >= self.size:
+                return
+            self._filling = True
+        threading.Thread(target=self._fill, name="warm-pool", daemon=True).start()
+
+    def _fill(self):
+        try:
+            while True:
+                with self._lock:
+                    if self._closed or len(self._idle) >= self.size:
+                        return
+                try:
+                    process = self._spawn()
+                except OSError as e:
+                    logger.error("Failed to start warm worker: %s", e)
+                    return
+                with self._lock:
+                    if self._closed:
+                        process.kill()
+                        return
+                    self._idle.append(process)
+        finally:
+            with self._lock:
+                self._filling = False
+
+    @staticmethod
+    def _spawn() -> subprocess.Popen:
+        _ensure_sandbox_dir()
+        cmd = [
+            CLAUDE_CODE_PATH,
+            "-p",
+            "--input-format", "stream-json",
+            "--output-format", "stream-json",
+            "--verbose",
+            "--max-turns", str(DEFAULT_MAX_TURNS),
+            "--allowedTools", DEFAULT_ALLOWED_TOOLS,
+            "--settings", _SANDBOX_SETTINGS,
+        ]
+        return resource_limits.spawn(
+            cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=SANDBOX_DIR,
+        )
+
+    def take(self) -> subprocess.Popen | None:
+        """An idle worker that's still alive, or None if the pool is empty."""
+        with self._lock:
+            while self._idle:
+                process = self._idle.pop(0)
+                if process.poll() is None:
+                    return process
+        return None
+
+    def idle_count(self) -> int:
+        with self._lock:
+            return len(self._idle)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for process in idle:
+            process.kill()
+            process.wait()
+            resource_limits.release(process)
+
+
+def _reap_orphan(pid: int) -> bool:
+    """Terminate a session process left over from a previous bot run.
+
+    Only signals the pid if it still looks like a claude process, since
+    the pid may have been reused since.
+    """
+    try:
+        with open(f"/proc/{pid}/cmdline", "rb") as f:
+            cmdline = f.read()
+    except OSError:
+        return False  # gone (or no /proc to verify it with)
+    if os.path.basename(CLAUDE_CODE_PATH).encode() not in cmdline:
+        return False
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except OSError:
+        return False
+    logger.info("Terminated orphaned session process %d", pid)
+    return True
+
+
+def _task_fingerprint(task: str, use_browser: bool, isolate: bool, user: str | None = None,
+                      origin: tuple[str, str | None] | None = None) -> str:
+    """Identity of a dispatch, ignoring case, whitespace and trailing punctuation.
+
+    The requesting user and Slack thread are part of it: a session's output
+    and completion notice belong to whoever asked, so the same text from
+    someone else (or another thread) starts its own session.
+    """
+    normalized = re.sub(r"\s+", " ", task).strip().rstrip(".!?").lower()
+    channel, thread_ts = origin or (None, None)
+    key = f"{normalized}\0{int(use_browser)}\0{int(isolate)}\0{user}\0{channel}\0{thread_ts}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+
+_PRIORITY_RANK = {"interactive": 0, "background": 1}
+STATUSES = ("queued", "running", "done", "failed", "timeout", "budget_exceeded")
+_FINISHED = ("done", "failed", "timeout", "budget_exceeded")
+
+
+@dataclass
+class SessionBudget:
+    """Limits for one run of a session; 0 means unlimited."""
+
+    timeout_s: float = SESSION_TIMEOUT_S
+    max_cost_usd: float = SESSION_MAX_COST_USD
+    max_output_bytes: int = SESSION_MAX_OUTPUT_BYTES
+
+
+def _usage_cost(usage: dict) -> float:
+    """Estimated USD cost of one assistant message's token usage."""
+    return (
+        usage.get("input_tokens", 0) * SESSION_TOKEN_PRICES["input"]
+        + usage.get("output_tokens", 0) * SESSION_TOKEN_PRICES["output"]
+        + usage.get("cache_read_input_tokens", 0) * SESSION_TOKEN_PRICES["cache_read"]
+        + usage.get("cache_creation_input_tokens", 0) * SESSION_TOKEN_PRICES["cache_write"]
+    ) / 1_000_000
+
+
+def _parse_activity(data: dict) -> list[tuple[str, str]]:
+    """(kind, text) SessionEvents for one parsed stream-json message."""
+    activity = []
+    msg_type = data.get("type")
+    if msg_type == "assistant":
+        for block in data.get("message", {}).get("content", []):
+            if block.get("type") == "tool_use":
+                input_preview = json.dumps(block.get("input", {}))[:200]
+                activity.append(("tool_call", f"{block.get('name', '?')} ({input_preview})"))
+            elif block.get("type") == "text" and block.get("text"):
+                activity.append(("assistant", block["text"][:500]))
+    elif msg_type == "user":
+        # Tool results come back as user messages
+        for block in data.get("message", {}).get("content", []):
+            if isinstance(block, dict) and block.get("type") == "tool_result":
+                content = block.get("content", "")
+                if isinstance(content, list):
+                    content = " ".join(c.get("text", "") for c in content if isinstance(c, dict))
+                if content:
+                    activity.append(("tool_result", content[:300]))
+    return activity
+
+
+@dataclass
+class SessionEvent:
+    """One step of session activity, parsed once as its line arrives."""
+
+    kind: str  # assistant | tool_call | tool_result | followup
+    text: str
+
+    def render(self) -> str:
+        return f"{_EVENT_LABELS[self.kind]}: {self.text}"
+
+
 @dataclass
 class Session:
     """A single Claude Code subprocess session."""
 
     internal_id: str  # Our tracking ID (assigned before claude starts)
     task: str
-    process: subprocess.Popen
+    process: subprocess.Popen | None  # None while queued
     use_browser: bool = False
     worktree: str | None = None
     session_id: str | None = None  # Claude Code's UUID, parsed from output
-    status: str = "running"  # running | done | failed
+    status: str = "running"  # queued | running | done | failed | timeout | budget_exceeded
     result: str | None = None
     cost: float = 0.0
     started_at: datetime = field(default_factory=lambda: datetime.now(timezone.utc))
-    _output_lines: list[str] = field(default_factory=list)
+    priority: str = "interactive"  # interactive | background
+    user: str | None = None  # who dispatched it, for queue fairness
+    queued_at: datetime = field(default_factory=lambda: datetime.now(timezone.utc))
+    queue_wait_s: float = 0.0
+    finished_at: datetime | None = None
+    archived: bool = False
+    origin: tuple[str, str | None] | None = None  # Slack (channel, thread_ts) it was dispatched from
+    budget: SessionBudget = field(default_factory=SessionBudget)
+    fingerprint: str | None = None  # see _task_fingerprint
+    _worktree_path: str | None = None  # worktree leased for the current/last run
+    group_id: str | None = None  # TaskGroup it was dispatched in
+    dedup_hits: int = 0  # duplicate dispatches coalesced into this session
+    # Per-run budget accounting, reset by attach()
+    output_bytes: int = 0
+    cost_estimate: float = 0.0
+    _usage_costs: dict = field(default_factory=dict)  # message id -> estimated cost
+    _run_started: float = 0.0  # time.monotonic()
+    _limit: tuple[str, str] | None = None  # (status, reason) once a budget was exceeded
+    _kill_at: float | None = None
+    on_exit: Callable[["Session"], None] | None = None  # scheduler hook
+    on_status: Callable[["Session", str], None] | None = None  # (session, old status)
+    start_mode: str = "cold"  # cold | warm (handed to a pre-started worker)
+    startup_s: float | None = None  # start -> system/init, first run only
+    _cmd: list[str] = field(default_factory=list)
+    _prompt: str | None = None  # set if a warm worker may run this task
+    registry: SessionRegistry | None = None
+    transcript: Transcript | None = None
+    _transcript_path: str | None = None
+    _restored: bool = False  # loaded from the registry; transcript not read yet
+    _run_start: int = 0  # transcript line where the current process's output begins
+    _stderr_tail: deque = field(default_factory=lambda: deque(maxlen=STDERR_TAIL_LINES))
+    # Parsed activity across all runs; _event_count is the absolute index
+    # read_output cursors refer to, even after old events fall off.
+    _events: deque = field(default_factory=lambda: deque(maxlen=SESSION_EVENTS_MAX))
+    _event_count: int = 0
     _lock: threading.Lock = field(default_factory=threading.Lock)
+    # Set once the I/O loop has seen EOF on both pipes of the current process.
+    _streams_closed: threading.Event = field(default_factory=threading.Event)
+    # Set once the current process reported its session_id, or exited (or
+    # failed to start) without one. See wait_ready().
+    _ready: threading.Event = field(default_factory=threading.Event)
 
-    def __post_init__(self):
-        self._reader_thread = threading.Thread(
-            target=self._read_stdout, daemon=True
+    def attach(self, process: subprocess.Popen):
+        """Start (or restart, for a follow-up) reading `process`."""
+        self._load_transcript()
+        self._run_start = len(self.transcript)
+        self.process = process
+        self.output_bytes = 0
+        self.cost_estimate = 0.0
+        self._usage_costs = {}
+        self._run_started = time.monotonic()
+        self._limit = None
+        self._kill_at = None
+        self._streams_closed.clear()
+        self._ready.clear()
+        self._save()
+        _io_loop.register(self)
+
+    def _load_transcript(self):
+        """Open the transcript; for a restored session, index and replay it."""
+        if self.transcript is not None:
+            return
+        self.transcript = transcript_store.open(
+            self.internal_id, path=self._transcript_path, resume=self._restored
         )
-        self._reader_thread.start()
+        self._transcript_path = str(self.transcript.path)
+        if self._restored:
+            self._restored = False
+            for line in self.transcript.read():
+                try:
+                    data = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                for kind, text in _parse_activity(data):
+                    self.add_event(kind, text)
 
-    def _read_stdout(self):
-        """Continuously read stdout lines from the subprocess."""
-        for raw_line in self.process.stdout:
-            line = raw_line.strip()
-            if not line:
-                continue
+    def _save(self):
+        if self.registry:
+            self.registry.record(self.to_record())
+
+    def to_record(self) -> dict:
+        """This session as a SessionRegistry row."""
+        return {
+            "internal_id": self.internal_id,
+            "seq": int(self.internal_id.rsplit("-", 1)[-1]),
+            "task": self.task,
+            "session_id": self.session_id,
+            "status": self.status,
+            "result": self.result,
+            "cost": self.cost,
+            "use_browser": int(self.use_browser),
+            "worktree": self.worktree,
+            "priority": self.priority,
+            "user": self.user,
+            "pid": self.process.pid if self.process else None,
+            "started_at": self.started_at.isoformat(),
+            "queued_at": self.queued_at.isoformat(),
+            "transcript_path": self._transcript_path,
+            "archived": int(self.archived),
+            "origin_channel": self.origin[0] if self.origin else None,
+            "origin_thread_ts": self.origin[1] if self.origin else None,
+            "fingerprint": self.fingerprint,
+            "dedup_hits": self.dedup_hits,
+            "group_id": self.group_id,
+        }
+
+    @classmethod
+    def from_record(cls, row: dict, registry: SessionRegistry | None = None) -> "Session":
+        """Rebuild a session (without a process) from a registry row."""
+        session = cls(
+            internal_id=row["internal_id"],
+            task=row["task"],
+            process=None,
+            use_browser=bool(row["use_browser"]),
+            worktree=row["worktree"],
+            session_id=row["session_id"],
+            status=row["status"],
+            result=row["result"],
+            cost=row["cost"] or 0.0,
+            priority=row["priority"] or "interactive",
+            user=row["user"],
+            registry=registry,
+            _transcript_path=row["transcript_path"],
+            _restored=bool(row["transcript_path"]),
+            archived=bool(row["archived"]),
+            origin=(row["origin_channel"], row["origin_thread_ts"]) if row["origin_channel"] else None,
+            fingerprint=row["fingerprint"],
+            dedup_hits=row["dedup_hits"] or 0,
+            group_id=row["group_id"],
+        )
+        if row["started_at"]:
+            session.started_at = datetime.fromisoformat(row["started_at"])
+        if row["queued_at"]:
+            session.queued_at = datetime.fromisoformat(row["queued_at"])
+        session._ready.set()
+        return session
+
+    def _handle_output(self, process: subprocess.Popen, line: str, is_stderr: bool):
+        """Called by the I/O loop for every complete line of output."""
+        if process is not self.process:
+            return  # leftover output from a process a follow-up replaced
+        line = line.strip()
+        if not line:
+            return
+        if is_stderr:
             with self._lock:
-                self._output_lines.append(line)
-            try:
-                data = json.loads(line)
-                msg_type = data.get("type")
-
-                if msg_type == "system" and data.get("subtype") == "init":
-                    self.session_id = data.get("session_id")
-
-                elif msg_type == "assistant":
-                    # Log tool calls and text from the session
-                    for block in data.get("message", {}).get("content", []):
-                        if block.get("type") == "tool_use":
-                            event_log.emit("session", "tool_call",
-                                           session_id=self.internal_id,
-                                           tool=block.get("name", "?"),
-                                           input_preview=json.dumps(block.get("input", {}))[:200])
-                        elif block.get("type") == "text" and block.get("text"):
-                            event_log.emit("session", "assistant_text",
-                                           session_id=self.internal_id,
-                                           text=block["text"][:300])
-
-                elif msg_type == "result":
-                    self.result = data.get("result")
-                    self.cost = data.get("total_cost_usd", 0.0)
-                    self.status = "done" if not data.get("is_error") else "failed"
-                    event_log.emit("session", "session_end",
+                self._stderr_tail.append(line)
+            return
+        self.transcript.append(line)
+        try:
+            data = json.loads(line)
+        except json.JSONDecodeError:
+            return
+        if not isinstance(data, dict):
+            return  # valid JSON, but not a stream-json message
+        msg_type = data.get("type")
+
+        for kind, text in _parse_activity(data):
+            self.add_event(kind, text)
+
+        if msg_type == "system" and data.get("subtype") == "init":
+            self.session_id = data.get("session_id")
+            self._ready.set()
+            self._save()
+            if self.startup_s is None:
+                self.startup_s = round(self.age_seconds(), 3)
+                event_log.emit("session", "session_ready",
+                               session_id=self.internal_id,
+                               start_mode=self.start_mode,
+                               startup_s=self.startup_s)
+
+        elif msg_type == "assistant":
+            # A message streamed in several parts repeats its usage; count it once.
+            message = data.get("message", {})
+            if message.get("usage"):
+                self._usage_costs[message.get("id")] = _usage_cost(message["usage"])
+                self.cost_estimate = sum(self._usage_costs.values())
+                if self.cost_estimate > self.budget.max_cost_usd > 0:
+                    self._check_limits(process, time.monotonic())
+            # Log tool calls and text from the session
+            for block in data.get("message", {}).get("content", []):
+                if block.get("type") == "tool_use":
+                    event_log.emit("session", "tool_call",
+                                   session_id=self.internal_id,
+                                   tool=block.get("name", "?"),
+                                   input_preview=json.dumps(block.get("input", {}))[:200])
+                elif block.get("type") == "text" and block.get("text"):
+                    event_log.emit("session", "assistant_text",
                                    session_id=self.internal_id,
-                                   status=self.status,
-                                   cost=self.cost,
-                                   result_preview=(self.result or "")[:300],
-                                   duration_s=round(self.age_seconds()))
+                                   text=block["text"][:300])
+
+        elif msg_type == "result":
+            self.result = data.get("result")
+            self.cost = data.get("total_cost_usd", 0.0)
+            self._set_status("done" if not data.get("is_error") else "failed")
+            event_log.emit("session", "session_end",
+                           session_id=self.internal_id,
+                           status=self.status,
+                           cost=self.cost,
+                           result_preview=(self.result or "")[:300],
+                           duration_s=round(self.age_seconds()),
+                           queue_wait_s=self.queue_wait_s)
 
-            except json.JSONDecodeError:
-                pass
+    def _on_process_exit(self, process: subprocess.Popen):
+        """Called by the I/O loop once `process` closed its pipes and exited."""
+        if process is not self.process:
+            return
+        self.transcript.close()
+        self._streams_closed.set()
+        self._ready.set()
+        self.poll()
+        if self.on_exit:
+            self.on_exit(self)
 
     def poll(self):
         """Update status by checking if the subprocess is still alive."""
-        if self.status == "running" and self.process.poll() is not None:
-            self._reader_thread.join(timeout=2)
+        if self.status == "running" and self.process and self.process.poll() is not None:
+            # Give the I/O loop a moment to drain the final output lines.
+            self._streams_closed.wait(timeout=2)
             if self.status == "running":
-                self.status = "failed" if self.process.returncode != 0 else "done"
+                # No result message, so no reported cost: use the usage estimate.
+                self.cost = self.cost_estimate
+            if self.status == "running" and self._limit:
+                status, reason = self._limit
+                self.result = f"Stopped: {reason}."
+                self._set_status(status)
+                event_log.emit("session", "session_end",
+                               session_id=self.internal_id,
+                               status=status,
+                               reason=reason,
+                               cost=self.cost_estimate,
+                               result_preview=self.result,
+                               duration_s=round(self.age_seconds()),
+                               queue_wait_s=self.queue_wait_s)
+            elif self.status == "running":
+                self._set_status("failed" if self.process.returncode != 0 else "done")
+
+    def _check_limits(self, process: subprocess.Popen, now: float):
+        """Stop `process` if this run is over budget (called on the I/O thread)."""
+        if process is not self.process or process.poll() is not None:
+            return
+        if self._limit:
+            # Already asked to stop; escalate if it ignored SIGTERM.
+            if self._kill_at is not None and now >= self._kill_at:
+                logger.warning("Session %s ignored SIGTERM, killing it", self.internal_id)
+                process.kill()
+                self._kill_at = None
+            return
+        budget = self.budget
+        if budget.timeout_s and now - self._run_started > budget.timeout_s:
+            self._stop("timeout", f"ran longer than {budget.timeout_s:g}s")
+        elif budget.max_cost_usd and self.cost_estimate > budget.max_cost_usd:
+            self._stop("budget_exceeded",
+                       f"estimated cost ${self.cost_estimate:.2f} over the ${budget.max_cost_usd:.2f} limit")
+        elif budget.max_output_bytes and self.output_bytes > budget.max_output_bytes:
+            self._stop("budget_exceeded",
+                       f"output over the {budget.max_output_bytes} byte limit")
+
+    def _stop(self, status: str, reason: str):
+        logger.warning("Stopping session %s: %s", self.internal_id, reason)
+        self._limit = (status, reason)
+        self._kill_at = time.monotonic() + KILL_GRACE_S
+        event_log.emit("session", "session_limit",
+                       session_id=self.internal_id, status=status, reason=reason)
+        self.process.terminate()
+
+    def _set_status(self, status: str):
+        """Change status, keeping the manager's index and the registry in step."""
+        old, self.status = self.status, status
+        if status in _FINISHED:
+            self.finished_at = datetime.now(timezone.utc)
+        if self.on_status and old != status:
+            self.on_status(self, old)
+        self._save()
 
-    def get_output_lines(self) -> list[str]:
+    def wait_ready(self, timeout: float | None = None) -> bool:
+        """Block until the session has its session_id or has exited.
+
+        Returns False on timeout. Queued sessions aren't ready until they
+        start and report in.
+        """
+        return self._ready.wait(timeout)
+
+    def get_output_lines(self, start: int = 0, limit: int | None = None) -> list[str]:
+        """Output lines of the current run, from `start`; older ones come from disk."""
+        if self._restored:
+            self._load_transcript()
+        if self.transcript is None:
+            return []
+        return self.transcript.read(self._run_start + start, limit)
+
+    def add_event(self, kind: str, text: str):
+        with self._lock:
+            self._events.append(SessionEvent(kind, text))
+            self._event_count += 1
+
+    def get_events(self, since: int = 0) -> tuple[list[SessionEvent], int, int]:
+        """Events from index `since` on, as (events, first_index, next_cursor).
+
+        first_index is greater than `since` if older events were dropped.
+        """
+        if self._restored:
+            self._load_transcript()
+        with self._lock:
+            total = self._event_count
+            first = total - len(self._events)
+            start = min(max(since, first), total)
+            return list(islice(self._events, start - first, None)), start, total
+
+    def get_stderr_tail(self) -> list[str]:
         with self._lock:
-            return list(self._output_lines)
+            return list(self._stderr_tail)
 
     def age_seconds(self) -> float:
         return (datetime.now(timezone.utc) - self.started_at).total_seconds()
 
 
+@dataclass
+class TaskGroup:
+    """Sessions dispatched together by dispatch_group()."""
+
+    group_id: str
+    session_ids: list[str] = field(default_factory=list)
+    quorum: int | None = None  # finished sessions that satisfy the group; None = all
+    quorum_reached: bool = False
+
+    def needed(self) -> int:
+        return self.quorum or len(self.session_ids)
+
+
+def _fair_share(texts: list[str], budget: int) -> list[str]:
+    """Truncate `texts` to fit `budget` in total, short ones first.
+
+    Texts shorter than an even split keep their length and give the rest
+    to the longer ones.
+    """
+    limits = [0] * len(texts)
+    remaining = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+    while remaining:
+        share = max(0, budget) // len(remaining)
+        i = remaining.pop(0)
+        limits[i] = min(len(texts[i]), share)
+        budget -= limits[i]
+    return [t if len(t) <= n else t[:n] + "… [truncated]" for t, n in zip(texts, limits)]
+
+
 class SessionManager:
     """Tracks and manages Claude Code subprocess sessions."""
 
-    def __init__(self):
+    def __init__(self, registry: SessionRegistry | None = None):
         self.sessions: dict[str, Session] = {}
+        self.registry = registry if registry is not None else SessionRegistry()
         self._counter = 0
+        # Guards the slot check, id assignment and `sessions` registration;
+        # dispatch can be called from several Slack worker threads at once.
+        self._lock = threading.Lock()
+        self._queue: list[Session] = []  # queued sessions, in arrival order
+        # status -> ids of in-memory sessions, updated on every transition
+        self._by_status: dict[str, set[str]] = {status: set() for status in STATUSES}
+        self._index_lock = threading.Lock()
+        # Notified whenever a session finishes; see wait_for_tasks().
+        self._finished = threading.Condition()
+        self._completion_listeners: list[Callable[[Session], None]] = []
+        self._shutting_down = False
+        self.warm_pool = _WarmPool()
+        self.concurrency = ConcurrencyController()
+        self._fingerprints: dict[str, str] = {}  # fingerprint -> latest internal_id
+        self.worktrees = WorktreePool(SANDBOX_DIR)
+        self.groups: dict[str, TaskGroup] = {}
+        self._group_counter = 0
+        self.worktrees.on_available = self._on_worktree_available
+        self.dedup_hits = 0
+
+    def restore(self):
+        """Load sessions saved before a restart.
+
+        Their processes can't be reattached (their pipes belonged to the
+        old bot process), so any that are still alive are terminated, and
+        unfinished sessions are marked failed. Those that reported a
+        session_id can still be resumed with a follow-up.
+        """
+        rows = self.registry.load()
+        counter = self.registry.load_counter()
+        interrupted = reaped = 0
+        with self._lock:
+            for row in rows:
+                if row["internal_id"] in self.sessions:
+                    continue
+                if row["archived"]:
+                    continue
+                session = Session.from_record(row, registry=self.registry)
+                self._register_locked(session)
+                if session.status in ("queued", "running"):
+                    interrupted += 1
+                    if row["pid"] and _reap_orphan(row["pid"]):
+                        reaped += 1
+                    session.result = "Interrupted by a bot restart."
+                    session._set_status("failed")
+            self._counter = max(self._counter, counter)
+            self._archive_locked()
+        event_log.emit("system", "session_registry_restore",
+                       sessions=len(rows), interrupted=interrupted, reaped=reaped)
+
+    def warm_up(self):
+        """Start filling the warm pool (no-op when WARM_POOL_SIZE is 0) and the worktree pool."""
+        self.warm_pool.fill_async()
+        _ensure_sandbox_dir()
+        self.worktrees.start()
 
     def _next_id(self) -> str:
         self._counter += 1
+        self.registry.record_counter(self._counter)
         return f"task-{self._counter}"
 
-    def dispatch(
+    def dispatch(self, task: str, use_browser: bool = False, isolate: bool = False,
+                 **kwargs) -> Session:
+        """Like find_or_dispatch, returning just the session."""
+        return self.find_or_dispatch(task, use_browser, isolate, **kwargs)[0]
+
+    def find_or_dispatch(
         self,
         task: str,
         use_browser: bool = False,
         isolate: bool = False,
-    ) -> Session:
-        """Spawn a new Claude Code session as a background subprocess."""
-        running = [s for s in self.sessions.values() if s.status == "running"]
-        if len(running) >= MAX_CONCURRENT_SESSIONS:
-            raise RuntimeError(
-                f"Already running {len(running)} sessions "
-                f"(max {MAX_CONCURRENT_SESSIONS}). "
-                "Wait for one to finish or check existing tasks."
-            )
+        priority: str = "interactive",
+        user: str | None = None,
+        origin: tuple[str, str | None] | None = None,
+        timeout_s: float | None = None,
+        max_cost_usd: float | None = None,
+        max_output_bytes: int | None = None,
+    ) -> tuple[Session, bool]:
+        """Spawn a new Claude Code session as a background subprocess.
 
+        Returns (session, created). A duplicate (from the same user and
+        thread) of a session that is still queued or running, or that
+        finished successfully within DISPATCH_DEDUP_WINDOW_S, returns that
+        session with created=False.
+        If no slot is free the session is queued and starts automatically
+        later. Raises RuntimeError only when the queue itself is full.
+        `origin` is the Slack (channel, thread_ts) to report completion to.
+        Budget arguments left as None use the SESSION_* defaults.
+        """
+        if priority not in _PRIORITY_RANK:
+            raise ValueError(f"priority must be one of {', '.join(_PRIORITY_RANK)}")
         _ensure_sandbox_dir()
 
+        workspace = (f"an isolated git worktree of the sandboxed workspace at {SANDBOX_DIR}"
+                     if isolate else f"a sandboxed workspace at {SANDBOX_DIR}")
         sandboxed_task = (
-            f"You are in a sandboxed workspace at {SANDBOX_DIR}. "
-            f"All file operations must stay in this directory. "
+            f"You are in {workspace}. "
+            f"All file operations must stay in the current directory. "
             f"Use relative paths.\n\n"
             f"Task: {task}"
         )
@@ -194,106 +981,612 @@ class SessionManager:
         ]
         if use_browser:
             cmd.append("--chrome")
-        if isolate:
-            cmd.extend(["--worktree", f"task-{self._counter + 1}"])
 
-        internal_id = self._next_id()
-        logger.info("Dispatching session %s: %s", internal_id, task[:100])
+        fingerprint = _task_fingerprint(task, use_browser, isolate, user, origin)
+        with self._lock:
+            existing = self._find_duplicate_locked(fingerprint)
+            if existing:
+                existing.dedup_hits += 1
+                self.dedup_hits += 1
+                existing._save()
+        if existing:
+            logger.info("Coalesced duplicate dispatch into %s: %s", existing.internal_id, task[:100])
+            event_log.emit("session", "dispatch_deduplicated",
+                           session_id=existing.internal_id,
+                           status=existing.status,
+                           hits=existing.dedup_hits,
+                           total_hits=self.dedup_hits)
+            return existing, False
 
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            cwd=SANDBOX_DIR,
-        )
+        with self._lock:
+            if len(self._queue) >= MAX_QUEUED_SESSIONS:
+                raise RuntimeError(
+                    f"{len(self._queue)} tasks are already queued "
+                    f"(max {MAX_QUEUED_SESSIONS}). "
+                    "Wait for some to finish or check existing tasks."
+                )
 
-        session = Session(
-            internal_id=internal_id,
-            task=task,
-            process=process,
-            use_browser=use_browser,
-            worktree=f"task-{self._counter}" if isolate else None,
-        )
-        self.sessions[internal_id] = session
+            internal_id = self._next_id()
+            worktree = internal_id if isolate else None
+
+            session = Session(
+                internal_id=internal_id,
+                task=task,
+                process=None,
+                use_browser=use_browser,
+                worktree=worktree,
+                status="queued",
+                priority=priority,
+                user=user,
+                on_exit=self._on_session_exit,
+                _cmd=cmd,
+                _prompt=sandboxed_task if not (use_browser or isolate) else None,
+                registry=self.registry,
+                origin=origin,
+                fingerprint=fingerprint,
+                budget=SessionBudget(
+                    timeout_s=SESSION_TIMEOUT_S if timeout_s is None else timeout_s,
+                    max_cost_usd=SESSION_MAX_COST_USD if max_cost_usd is None else max_cost_usd,
+                    max_output_bytes=(SESSION_MAX_OUTPUT_BYTES if max_output_bytes is None
+                                      else max_output_bytes),
+                ),
+            )
+            self._register_locked(session)
+            session._save()
+            self._queue.append(session)
+            started = self._schedule_locked()
+            position = None if session in started else self._queue.index(session) + 1
+        self.concurrency.start(self._adapt_concurrency)
+
+        if position is not None:
+            logger.info("Queued session %s at position %d: %s", internal_id, position, task[:100])
+            event_log.emit("session", "session_queued",
+                           session_id=internal_id,
+                           task=task[:200],
+                           priority=priority,
+                           position=position,
+                           use_browser=use_browser)
+        self._emit_started(started)
+        return session, True
+
+    def dispatch_group(
+        self,
+        tasks: list[dict],
+        quorum: int | None = None,
+        priority: str = "interactive",
+        user: str | None = None,
+        origin: tuple[str, str | None] | None = None,
+        timeout_s: float | None = None,
+        max_cost_usd: float | None = None,
+    ) -> TaskGroup:
+        """Dispatch several tasks under one group id.
+
+        Each item of `tasks` is {"task": str, "use_browser"?: bool,
+        "isolate"?: bool}. `quorum` is how many must finish for the group to
+        count as complete (default: all). Duplicates of existing tasks join
+        the group as the existing session, as with dispatch(). If that leaves
+        fewer members than `quorum`, the quorum is lowered to all of them;
+        callers compare group.needed() with what they asked for.
+        """
+        if not tasks:
+            raise ValueError("tasks must not be empty")
+        if len(tasks) > MAX_GROUP_SIZE:
+            raise ValueError(f"at most {MAX_GROUP_SIZE} tasks per batch")
+        if quorum is not None and not 1 <= quorum <= len(tasks):
+            raise ValueError(f"quorum must be between 1 and {len(tasks)}")
+        with self._lock:
+            if len(self._queue) + len(tasks) > MAX_QUEUED_SESSIONS:
+                raise RuntimeError(
+                    f"{len(self._queue)} tasks are already queued (max {MAX_QUEUED_SESSIONS}), "
+                    f"so a batch of {len(tasks)} won't fit. Wait for some to finish."
+                )
+            self._group_counter += 1
+            group = TaskGroup(group_id=f"group-{self._group_counter}", quorum=quorum)
+            self.groups[group.group_id] = group
+
+        for item in tasks:
+            session, created = self.find_or_dispatch(
+                item["task"],
+                use_browser=item.get("use_browser", False),
+                isolate=item.get("isolate", False),
+                priority=priority,
+                user=user,
+                origin=origin,
+                timeout_s=timeout_s,
+                max_cost_usd=max_cost_usd,
+            )
+            if session.internal_id in group.session_ids:
+                continue  # the same task twice in one batch
+            if created:
+                session.group_id = group.group_id
+                session._save()
+            with self._finished:
+                group.session_ids.append(session.internal_id)
+        if quorum is not None:
+            group.quorum = min(quorum, len(group.session_ids))
+
+        logger.info("Dispatched group %s: %s", group.group_id, ", ".join(group.session_ids))
+        event_log.emit("system", "group_dispatch",
+                       group_id=group.group_id,
+                       session_ids=group.session_ids,
+                       quorum=group.needed())
+        self._check_group(group)
+        return group
+
+    def _check_group(self, group: TaskGroup):
+        """Emit group_quorum the first time enough of the group has finished.
+
+        Called from the status hook, possibly under _lock, so it only looks at
+        in-memory sessions; a member that isn't loaded was archived, which
+        means it finished.
+        """
+        finished = 0
+        for internal_id in list(group.session_ids):
+            session = self.sessions.get(internal_id)
+            finished += session is None or session.status in _FINISHED
+        with self._finished:
+            if group.quorum_reached or finished < group.needed():
+                return
+            group.quorum_reached = True
+        event_log.emit("system", "group_quorum",
+                       group_id=group.group_id, finished=finished,
+                       total=len(group.session_ids))
 
-        event_log.emit("session", "session_dispatch",
-                       session_id=internal_id,
-                       task=task[:200],
-                       use_browser=use_browser,
-                       isolate=isolate)
+    def group_progress(self, group_id: str) -> dict:
+        """Aggregate status of a group's sessions."""
+        group = self.groups.get(group_id)
+        if group is None:
+            raise ValueError(f"No task group found with id '{group_id}'.")
+        counts: dict[str, int] = {}
+        cost = 0.0
+        for internal_id in list(group.session_ids):
+            session = self.get_session(internal_id)
+            status = session.status if session else "failed"
+            counts[status] = counts.get(status, 0) + 1
+            cost += session.cost if session else 0.0
+        finished = sum(counts.get(status, 0) for status in _FINISHED)
+        return {
+            "group_id": group_id,
+            "total": len(group.session_ids),
+            "finished": finished,
+            "quorum": group.needed(),
+            "quorum_met": finished >= group.needed(),
+            "counts": counts,
+            "cost": round(cost, 4),
+        }
 
-        time.sleep(0.5)
+    def wait_for_group(self, group_id: str, timeout: float = 60) -> dict:
+        """Block until the group's quorum has finished, or `timeout`."""
+        group = self.groups.get(group_id)
+        if group is None:
+            raise ValueError(f"No task group found with id '{group_id}'.")
+        return self.wait_for_tasks(group.session_ids, timeout=timeout, quorum=group.needed())
+
+    def read_group(self, group_id: str, max_chars: int = GROUP_RESULT_MAX_CHARS) -> str:
+        """One merged report of a group's results, capped at about `max_chars`.
+
+        Unfinished sessions get a one-line status; finished ones share the
+        remaining space, shorter results first.
+        """
+        progress = self.group_progress(group_id)
+        quorum = "met" if progress["quorum_met"] else "not met yet"
+        header = (f"Group {group_id} — {progress['finished']}/{progress['total']} finished "
+                  f"(quorum {progress['quorum']} {quorum}) — ${progress['cost']:.2f}")
+        headings, bodies = [], []
+        for internal_id in self.groups[group_id].session_ids:
+            session = self.get_session(internal_id)
+            if session is None:
+                headings.append(f"### {internal_id} — missing")
+                bodies.append("")
+                continue
+            session.poll()
+            headings.append(f"### {internal_id} — {session.status} — ${session.cost:.2f} — "
+                            f"{session.task[:80]}")
+            if session.status == "done":
+                bodies.append(session.result or "(no result text)")
+            elif session.status in _FINISHED:
+                stderr = session.get_stderr_tail()
+                bodies.append(session.result or (stderr[-1] if stderr else "(no output)"))
+            else:
+                bodies.append(f"({session.status}, {round(session.age_seconds())}s so far)")
+        fixed = len(header) + sum(len(h) + 2 for h in headings)
+        bodies = _fair_share(bodies, max_chars - fixed)
+        parts = [header]
+        for heading, body in zip(headings, bodies):
+            parts.extend(["", heading, body])
+        return "\n".join(parts)
+
+    def _find_duplicate_locked(self, fingerprint: str) -> Session | None:
+        """The session a dispatch with `fingerprint` should reuse. Caller holds _lock."""
+        if DISPATCH_DEDUP_WINDOW_S <= 0:
+            return None
+        session = self.sessions.get(self._fingerprints.get(fingerprint, ""))
+        if session is None:
+            return None
+        if session.status in ("queued", "running"):
+            return session
+        finished = session.finished_at or session.started_at
+        if (session.status == "done"
+                and (datetime.now(timezone.utc) - finished).total_seconds() < DISPATCH_DEDUP_WINDOW_S):
+            return session
+        return None
+
+    def _schedule_locked(self) -> list[Session]:
+        """Start queued sessions while slots are free. Caller holds _lock."""
+        started = []
+        while self._queue:
+            with self._index_lock:
+                running = [self.sessions[i] for i in self._by_status["running"]]
+            if len(running) >= self.concurrency.slots(MAX_CONCURRENT_SESSIONS):
+                break
+            browsers = sum(1 for s in running if s.use_browser)
+            per_user: dict[str | None, int] = {}
+            for s in running:
+                per_user[s.user] = per_user.get(s.user, 0) + 1
+
+            waiting = sum(1 for s in self._queue if s.worktree)
+            worktree_free = bool(waiting) and self.worktrees.available(waiting)
+            eligible = [s for s in self._queue
+                        if not (s.use_browser and browsers >= MAX_BROWSER_SESSIONS)
+                        and not (s.worktree and not worktree_free)]
+            if not eligible:
+                break
+            # Interactive first, then the least-served user, then FIFO
+            # (min() keeps queue order among equals).
+            session = min(eligible, key=lambda s: (
+                _PRIORITY_RANK.get(s.priority, 0), per_user.get(s.user, 0)))
+            if session.worktree:
+                # Only takes an idle, already-clean worktree; no git here.
+                path = self.worktrees.lease(session.worktree, prefer=session._worktree_path)
+                if path is None:
+                    continue  # stays queued; on_available reschedules
+                session._worktree_path = path
+            self._queue.remove(session)
+            self._start_locked(session)
+            started.append(session)
+        return started
+
+    def _start_locked(self, session: Session):
+        now = datetime.now(timezone.utc)
+        session.queue_wait_s = round((now - session.queued_at).total_seconds(), 2)
+        session.started_at = now
+        logger.info("Dispatching session %s: %s", session.internal_id, session.task[:100])
+        process = self._start_warm(session) if session._prompt else None
+        try:
+            process = process or resource_limits.spawn(
+                session._cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                cwd=session._worktree_path if session.worktree else SANDBOX_DIR,
+            )
+        except OSError as e:
+            logger.error("Failed to start session %s: %s", session.internal_id, e)
+            self._release_worktree(session)
+            session.result = f"Failed to start: {e}"
+            session._ready.set()
+            session._set_status("failed")
+            return
+        session._set_status("running")
+        session.attach(process)
+
+    def _start_warm(self, session: Session) -> subprocess.Popen | None:
+        """Hand the task to an idle warm worker, if there is one."""
+        process = self.warm_pool.take()
+        if process is None:
+            return None
+        self.warm_pool.fill_async()
+        try:
+            process.stdin.write(_stream_json_prompt(session._prompt))
+            process.stdin.close()
+        except OSError as e:
+            logger.warning("Warm worker for %s died, starting cold: %s", session.internal_id, e)
+            process.kill()
+            return None
+        session.start_mode = "warm"
+        return process
+
+    def _emit_started(self, sessions: list[Session]):
+        for session in sessions:
+            event_log.emit("session", "session_dispatch",
+                           session_id=session.internal_id,
+                           task=session.task[:200],
+                           use_browser=session.use_browser,
+                           isolate=session.worktree is not None,
+                           priority=session.priority,
+                           start_mode=session.start_mode,
+                           queue_wait_s=session.queue_wait_s)
+
+    def _adapt_concurrency(self):
+        """Periodic ConcurrencyController step; starts queued work if slots grew."""
+        with self._lock:
+            with self._index_lock:
+                running = len(self._by_status["running"])
+            self.concurrency.evaluate(MAX_CONCURRENT_SESSIONS, running, backlog=bool(self._queue))
+            started = self._schedule_locked()
+        self._emit_started(started)
+
+    def _release_worktree(self, session: Session):
+        if session.worktree and session._worktree_path:
+            self.worktrees.release_async(session._worktree_path, session.worktree,
+                                         label=session.task)
+
+    def _on_worktree_available(self):
+        """A worktree was reset or created; start any isolated session waiting for one."""
+        with self._lock:
+            started = self._schedule_locked()
+        self._emit_started(started)
+
+    def _on_session_exit(self, session: Session):
+        """A session's process exited — hand its slot to the queue."""
+        self._release_worktree(session)
+        if session.status == "done":
+            self.concurrency.record_duration(time.monotonic() - session._run_started)
+        with self._lock:
+            started = self._schedule_locked()
+            self._archive_locked()
+        self._emit_started(started)
+
+    def _register_locked(self, session: Session):
+        """Track `session` in memory and in the status index. Caller holds _lock."""
+        session.on_exit = self._on_session_exit
+        session.on_status = self._on_status_change
+        self.sessions[session.internal_id] = session
+        if session.group_id:
+            # Rebuilds groups after a restart (their quorum becomes "all").
+            group = self.groups.setdefault(session.group_id, TaskGroup(session.group_id))
+            if session.internal_id not in group.session_ids:
+                group.session_ids.append(session.internal_id)
+            self._group_counter = max(self._group_counter,
+                                      int(session.group_id.rsplit("-", 1)[-1]))
+        if session.fingerprint:
+            # An unarchived older session must not shadow a newer duplicate.
+            latest = self.sessions.get(self._fingerprints.get(session.fingerprint, ""))
+            if latest is None or latest.queued_at <= session.queued_at:
+                self._fingerprints[session.fingerprint] = session.internal_id
+        with self._index_lock:
+            self._by_status.setdefault(session.status, set()).add(session.internal_id)
+
+    def _unregister_locked(self, session: Session):
+        self.sessions.pop(session.internal_id, None)
+        if self._fingerprints.get(session.fingerprint) == session.internal_id:
+            del self._fingerprints[session.fingerprint]
+        session.on_status = None
+        with self._index_lock:
+            self._by_status.get(session.status, set()).discard(session.internal_id)
+        transcript_store.release(session.internal_id)
+
+    def _on_status_change(self, session: Session, old: str):
+        with self._index_lock:
+            self._by_status.get(old, set()).discard(session.internal_id)
+            self._by_status.setdefault(session.status, set()).add(session.internal_id)
+        if session.status in _FINISHED:
+            with self._finished:
+                self._finished.notify_all()
+            # Not just session.group_id: a deduplicated session can also be
+            # a member of groups dispatched after the one it started in.
+            for group in list(self.groups.values()):
+                if session.internal_id in group.session_ids:
+                    self._check_group(group)
+            if self._shutting_down:
+                return
+            for listener in self._completion_listeners:
+                try:
+                    listener(session)
+                except Exception:
+                    logger.exception("Completion listener failed for %s", session.internal_id)
+
+    def add_completion_listener(self, listener: Callable[[Session], None]):
+        """Call `listener(session)` whenever a session finishes (done or failed)."""
+        self._completion_listeners.append(listener)
+
+    def _archive_locked(self):
+        """Move old finished sessions out of memory. Caller holds _lock."""
+        with self._index_lock:
+            finished = [self.sessions[i] for status in _FINISHED for i in self._by_status[status]]
+        finished.sort(key=lambda s: s.finished_at or s.started_at)
+        cutoff = datetime.now(timezone.utc).timestamp() - ARCHIVE_AFTER_S
+        excess = len(finished) - MAX_FINISHED_SESSIONS
+        archived = 0
+        for i, session in enumerate(finished):
+            if i >= excess and (session.finished_at or session.started_at).timestamp() > cutoff:
+                break
+            session.archived = True
+            session._save()
+            self._unregister_locked(session)
+            archived += 1
+        if archived:
+            for group_id, group in list(self.groups.items()):
+                if not any(i in self.sessions for i in group.session_ids):
+                    del self.groups[group_id]
+            event_log.emit("system", "sessions_archived",
+                           archived=archived, remaining=len(self.sessions))
+
+    def get_session(self, internal_id: str) -> Session | None:
+        """A tracked session by id, bringing it back from the archive if needed."""
+        session = self.sessions.get(internal_id)
+        if session or not internal_id.startswith("task-"):
+            return session
+        row = self.registry.load_one(internal_id)
+        if row is None:
+            return None
+        with self._lock:
+            if internal_id in self.sessions:
+                return self.sessions[internal_id]
+            session = Session.from_record(row, registry=self.registry)
+            session.archived = False
+            self._register_locked(session)
         return session
 
-    def list_sessions(self) -> list[dict]:
-        """Return all tracked sessions with their current status."""
+    def wait_for_tasks(self, internal_ids: list[str], mode: str = "any",
+                       timeout: float = 60, quorum: int | None = None) -> dict:
+        """Block until any (or all) of the sessions finish, or `timeout`.
+
+        With `quorum`, waits for at least that many instead of `mode`.
+        Wakes on the status transition itself, so there's no polling.
+        Returns which sessions finished, which are still pending, and
+        whether the wait timed out.
+        """
+        if mode not in ("any", "all"):
+            raise ValueError("mode must be 'any' or 'all'")
+        sessions = {}
+        for internal_id in dict.fromkeys(internal_ids):
+            session = self.get_session(internal_id)
+            if session is None:
+                raise ValueError(f"No session found with id '{internal_id}'.")
+            sessions[internal_id] = session
+        if not sessions:
+            raise ValueError("session_ids must not be empty")
+        timeout = max(0.0, min(timeout, WAIT_FOR_TASKS_MAX_S))
+
+        def finished() -> list[str]:
+            return [i for i, s in sessions.items() if s.status in _FINISHED]
+
+        needed = quorum if quorum is not None else (len(sessions) if mode == "all" else 1)
+
+        def met() -> bool:
+            return len(finished()) >= needed
+
+        start = time.time()
+        with self._finished:
+            satisfied = self._finished.wait_for(met, timeout=timeout)
+        done = finished()
+        waited = round(time.time() - start, 2)
+        event_log.emit("session", "tasks_waited",
+                       session_ids=list(sessions), mode=mode, waited_s=waited,
+                       finished=len(done), timed_out=not satisfied)
+        return {
+            "finished": done,
+            "pending": [i for i in sessions if i not in done],
+            "timed_out": not satisfied,
+            "waited_s": waited,
+        }
+
+    def status_counts(self) -> dict[str, int]:
+        """Number of in-memory sessions per status."""
+        with self._index_lock:
+            return {status: len(ids) for status, ids in self._by_status.items()}
+
+    def shutdown(self):
+        """Drop queued sessions and stop running ones (bot exit)."""
+        self.warm_pool.close()
+        self.concurrency.close()
+        with self._lock:
+            self._queue.clear()
+            running = [s for s in self.sessions.values() if s.status == "running"]
+            # Sessions failed by the shutdown aren't reported to their threads.
+            self._shutting_down = True
+        for session in running:
+            logger.info("Terminating session %s", session.internal_id)
+            session.process.terminate()
+            session.result = "Interrupted by bot shutdown."
+            session.cost = session.cost_estimate
+            session._set_status("failed")
+        self.registry.close()
+
+    def list_sessions(self, status: str | None = None, limit: int | None = None,
+                      offset: int = 0) -> list[dict]:
+        """Tracked (non-archived) sessions, newest first.
+
+        `status` filters through the status index; `limit`/`offset` page
+        through the result.
+        """
+        with self._lock:
+            self._archive_locked()
+            if status is None:
+                ids = list(self.sessions)
+            else:
+                if status not in STATUSES:
+                    raise ValueError(f"status must be one of {', '.join(STATUSES)}")
+                with self._index_lock:
+                    ids = list(self._by_status[status])
+            ids.sort(key=lambda i: int(i.rsplit("-", 1)[-1]), reverse=True)
+            end = None if limit is None else offset + limit
+            page = [self.sessions[i] for i in ids[offset:end]]
+
         result = []
-        for sid, session in self.sessions.items():
-            session.poll()
+        for session in page:
             result.append({
-                "id": sid,
+                "id": session.internal_id,
                 "session_id": session.session_id,
                 "task": session.task[:120],
                 "status": session.status,
                 "age_seconds": round(session.age_seconds()),
                 "use_browser": session.use_browser,
+                "priority": session.priority,
+                "queue_wait_s": session.queue_wait_s,
                 "cost": session.cost,
+                "dedup_hits": session.dedup_hits,
+                "group_id": session.group_id,
             })
         return result
 
-    def read_output(self, internal_id: str) -> str:
-        """Read the stream-json output captured so far. Passive, no interaction."""
-        session = self.sessions.get(internal_id)
+    def read_output(self, internal_id: str, since: int | None = None,
+                    max_chars: int = READ_OUTPUT_MAX_CHARS) -> str:
+        """Summarize a session's activity. Passive, no interaction.
+
+        Without `since`, shows the final result of a finished session or
+        the most recent activity. With `since` (the cursor returned by a
+        previous read), shows only what happened after it. Output is capped
+        at about `max_chars`, dropping the oldest events first.
+        """
+        session = self.get_session(internal_id)
         if not session:
             return f"No session found with id '{internal_id}'."
 
         session.poll()
-        lines = session.get_output_lines()
-        if not lines:
-            return f"Session {internal_id} ({session.status}): no output yet."
+        events, start, cursor = session.get_events(since or 0)
+        lines = len(session.transcript) if session.transcript else 0
+        header = (f"Session {internal_id} — status: {session.status} — "
+                  f"{round(session.age_seconds())}s, {lines} output lines, ${session.cost:.2f}")
+        footer = f"(cursor: {cursor} — pass since={cursor} to see only newer activity)"
 
-        summary_parts = [f"Session {internal_id} — status: {session.status}"]
+        tail = []
         if session.status == "done" and session.result:
-            summary_parts.append(f"\n**Final result:**\n{session.result}")
-            return "\n".join(summary_parts)
+            result = session.result
+            if len(result) > max_chars:
+                result = result[:max_chars] + "… [truncated]"
+            tail.append(f"\n**Final result:**\n{result}")
+            if since is None:
+                return "\n".join([header, *tail, footer])
+        stderr_tail = session.get_stderr_tail() if session.status == "failed" else []
+        if stderr_tail:
+            tail.append("stderr:\n" + "\n".join(stderr_tail[-10:]))
 
-        for line in lines:
-            try:
-                data = json.loads(line)
-                msg_type = data.get("type")
-
-                if msg_type == "assistant":
-                    message = data.get("message", {})
-                    for block in message.get("content", []):
-                        if block.get("type") == "text" and block.get("text"):
-                            summary_parts.append(f"Assistant: {block['text'][:500]}")
-                        elif block.get("type") == "tool_use":
-                            summary_parts.append(
-                                f"Tool call: {block.get('name', '?')} "
-                                f"({json.dumps(block.get('input', {}))[:200]})"
-                            )
-
-                elif msg_type == "tool_result":
-                    content = data.get("content", "")
-                    if isinstance(content, str) and content:
-                        summary_parts.append(f"Tool result: {content[:300]}")
-
-            except json.JSONDecodeError:
-                continue
+        budget = max_chars - sum(len(t) for t in tail)
+        body = []
+        for event in reversed(events):
+            text = event.render()
+            if body and len(text) > budget:
+                break
+            body.append(text)
+            budget -= len(text)
+        body.reverse()
 
-        if len(summary_parts) == 1:
-            summary_parts.append("(processing, no content captured yet)")
-
-        return "\n".join(summary_parts)
+        skipped = (start - since if since else start) + len(events) - len(body)
+        parts = [header]
+        if skipped:
+            parts.append(f"({skipped} earlier events omitted)")
+        if body:
+            parts.extend(body)
+        elif since is not None:
+            parts.append(f"(no new activity since cursor {since})")
+        elif not tail:
+            parts.append("(processing, no content captured yet)")
+        parts.extend(tail)
+        parts.append(footer)
+        return "\n".join(parts)
 
     def send_followup(self, internal_id: str, message: str) -> str:
         """Resume a session with a follow-up prompt. Spawns a new subprocess."""
-        session = self.sessions.get(internal_id)
+        session = self.get_session(internal_id)
         if not session:
             return f"No session found with id '{internal_id}'."
-        if not session.session_id:
+        if session.status == "queued":
+            return f"Session {internal_id} is still queued and hasn't started yet."
+        if not session.session_id and not session.wait_ready(SESSION_READY_TIMEOUT_S):
             return f"Session {internal_id} hasn't produced a session_id yet. Try again shortly."
+        if not session.session_id:
+            return f"Session {internal_id} exited without reporting a session_id, so it can't be resumed."
         if session.status == "running":
             return f"Session {internal_id} is still running. Wait for it to finish or read its output."
 
@@ -310,27 +1603,42 @@ class SessionManager:
         if session.use_browser:
             cmd.append("--chrome")
 
+        cwd = SANDBOX_DIR
+        if session.worktree:
+            # Prefer the worktree it ran in before: claude keys resumable
+            # sessions by working directory.
+            path = self.worktrees.lease(session.worktree, prefer=session._worktree_path)
+            if path is None:
+                return (f"No worktree is free for {internal_id} right now (one is being "
+                        "prepared). Try again shortly.")
+            session._worktree_path = cwd = path
+            try:
+                self.worktrees.checkout(path, session.worktree)
+            except OSError as e:
+                self._release_worktree(session)
+                return f"Couldn't restore {internal_id}'s changes into a worktree: {e}"
+
         logger.info("Sending follow-up to session %s: %s", internal_id, message[:100])
         event_log.emit("session", "session_followup",
                        session_id=internal_id, message=message[:200])
 
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            cwd=SANDBOX_DIR,
-        )
+        try:
+            process = resource_limits.spawn(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                cwd=cwd,
+            )
+        except OSError:
+            self._release_worktree(session)
+            raise
 
-        session.process = process
-        session.status = "running"
         session.result = None
-        session._output_lines = []
-        session._reader_thread = threading.Thread(
-            target=session._read_stdout, daemon=True
-        )
-        session._reader_thread.start()
-        time.sleep(0.5)
+        session._set_status("running")
+        with session._lock:
+            session._stderr_tail.clear()
+        session.add_event("followup", message[:300])
+        session.attach(process)
 
         return f"Follow-up sent to session {internal_id}. Check back for results."
 
@@ -339,10 +1647,15 @@ class SessionManager:
         session = self.sessions.get(internal_id)
         if not session:
             return f"No session found with id '{internal_id}'."
-        if session.status == "running":
-            session.process.terminate()
-            session.status = "failed"
-        del self.sessions[internal_id]
+        with self._lock:
+            if session in self._queue:
+                self._queue.remove(session)
+            session.origin = None  # stopped on request; no completion notice
+            if session.status == "running":
+                session.process.terminate()
+                session._set_status("failed")
+            self._unregister_locked(session)
+        self.registry.delete(internal_id)
         return f"Session {internal_id} cleaned up."
 
 
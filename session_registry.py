@@ -0,0 +1,186 @@
+"""On-disk registry of dispatched sessions, so a restart keeps them.
+
+One SQLite row per session: ids, task, status, cost, result, pid and the
+transcript path. Writes are coalesced per session and flushed in a single
+transaction every SESSION_DB_FLUSH_S by a background thread, so a chatty
+session costs one row update per interval rather than one per change.
+A batch that fails to write is kept and retried with the next flush.
+"""
+
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+from config import logger
+from event_log import LOG_DIR
+
+SESSION_DB_PATH = Path(os.environ.get("SESSION_DB_PATH", str(LOG_DIR / "sessions.db")))
+SESSION_DB_FLUSH_S = float(os.environ.get("SESSION_DB_FLUSH_S", "1.0"))
+
+COLUMNS = (
+    "internal_id", "seq", "task", "session_id", "status", "result", "cost",
+    "use_browser", "worktree", "priority", "user", "pid", "started_at",
+    "queued_at", "transcript_path", "archived", "origin_channel", "origin_thread_ts",
+    "fingerprint", "dedup_hits", "group_id",
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    internal_id TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL,
+    task TEXT NOT NULL,
+    session_id TEXT,
+    status TEXT NOT NULL,
+    result TEXT,
+    cost REAL NOT NULL DEFAULT 0,
+    use_browser INTEGER NOT NULL DEFAULT 0,
+    worktree TEXT,
+    priority TEXT,
+    user TEXT,
+    pid INTEGER,
+    started_at TEXT,
+    queued_at TEXT,
+    transcript_path TEXT,
+    archived INTEGER NOT NULL DEFAULT 0,
+    origin_channel TEXT,
+    origin_thread_ts TEXT,
+    fingerprint TEXT,
+    dedup_hits INTEGER NOT NULL DEFAULT 0,
+    group_id TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+"""
+
+
+class SessionRegistry:
+    """Batched, thread-safe persistence for session metadata."""
+
+    def __init__(self, path: Path = SESSION_DB_PATH, flush_interval: float = SESSION_DB_FLUSH_S):
+        self.path = Path(path)
+        self.flush_interval = flush_interval
+        self._conn: sqlite3.Connection | None = None
+        self._pending: dict[str, dict | None] = {}  # internal_id -> row, or None to delete
+        self._pending_counter: int | None = None
+        self._lock = threading.Lock()  # guards _pending
+        self._db_lock = threading.Lock()  # serializes use of the connection
+        self._wake = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._closed = False
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(_SCHEMA)
+        return self._conn
+
+    def load(self) -> list[dict]:
+        """Every stored session, oldest first."""
+        with self._db_lock:
+            cursor = self._connect().execute(
+                f"SELECT {', '.join(COLUMNS)} FROM sessions ORDER BY seq"
+            )
+            return [dict(zip(COLUMNS, row)) for row in cursor]
+
+    def load_one(self, internal_id: str) -> dict | None:
+        """One stored session (archived or not), or None."""
+        self.flush()
+        with self._db_lock:
+            row = self._connect().execute(
+                f"SELECT {', '.join(COLUMNS)} FROM sessions WHERE internal_id = ?",
+                (internal_id,),
+            ).fetchone()
+        return dict(zip(COLUMNS, row)) if row else None
+
+    def load_counter(self) -> int:
+        """Highest task number ever assigned, including deleted sessions."""
+        with self._db_lock:
+            conn = self._connect()
+            stored = conn.execute("SELECT value FROM meta WHERE key = 'counter'").fetchone()
+            max_seq = conn.execute("SELECT MAX(seq) FROM sessions").fetchone()
+        return max(stored[0] if stored else 0, max_seq[0] or 0)
+
+    def record_counter(self, counter: int):
+        with self._lock:
+            self._pending_counter = counter
+        self._queue_flush()
+
+    def record(self, row: dict):
+        """Queue an upsert; later records for the same session replace it."""
+        self._queue(row["internal_id"], row)
+
+    def delete(self, internal_id: str):
+        self._queue(internal_id, None)
+
+    def _queue(self, internal_id: str, row: dict | None):
+        with self._lock:
+            self._pending[internal_id] = row
+        self._queue_flush()
+
+    def _queue_flush(self):
+        """Make sure the flusher thread is running."""
+        with self._lock:
+            if self._closed:
+                return
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="session-registry", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        """Write all queued changes in one transaction.
+
+        The batch is taken and committed under the connection lock, so once
+        flush() returns, nothing queued before it is still in flight on the
+        flusher thread.
+        """
+        with self._db_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                counter, self._pending_counter = self._pending_counter, None
+            if not pending and counter is None:
+                return
+            upserts = [tuple(row[c] for c in COLUMNS) for row in pending.values() if row]
+            deletes = [(key,) for key, row in pending.items() if row is None]
+            placeholders = ", ".join("?" for _ in COLUMNS)
+            updates = ", ".join(f"{c}=excluded.{c}" for c in COLUMNS[1:])
+            try:
+                conn = self._connect()
+                with conn:
+                    conn.executemany(
+                        f"INSERT INTO sessions ({', '.join(COLUMNS)}) VALUES ({placeholders}) "
+                        f"ON CONFLICT(internal_id) DO UPDATE SET {updates}",
+                        upserts,
+                    )
+                    conn.executemany("DELETE FROM sessions WHERE internal_id = ?", deletes)
+                    if counter is not None:
+                        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('counter', ?)",
+                                     (counter,))
+            except sqlite3.Error as e:
+                logger.error("Failed to write %d session rows to %s, will retry: %s",
+                             len(pending), self.path, e)
+                with self._lock:
+                    # Changes queued since this batch was taken are newer.
+                    self._pending = {**pending, **self._pending}
+                    if self._pending_counter is None:
+                        self._pending_counter = counter
+
+    def close(self):
+        """Flush outstanding writes and close the database."""
+        self.flush()
+        with self._lock:
+            self._closed = True
+        self._wake.set()
+        with self._db_lock:
+            if self._conn:
+                self._conn.close()
+                self._conn = None
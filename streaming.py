@@ -0,0 +1,133 @@
+"""Progressive Slack replies while the model is still generating.
+
+A `SlackReplyStream` posts a placeholder message as soon as work starts,
+then edits it with `chat.update` as text deltas arrive, at most once per
+STREAM_UPDATE_INTERVAL_S. Markdown → mrkdwn conversion is incremental:
+finished blocks (split on blank lines outside code fences) are converted
+once and reused, and only the trailing block is re-converted per update.
+"""
+
+import os
+import threading
+import time
+
+from slack_sdk.errors import SlackApiError
+
+from config import app, logger, mrkdwn_converter
+
+STREAM_REPLIES = os.environ.get("STREAM_REPLIES", "true").lower() in ("1", "true", "yes")
+STREAM_UPDATE_INTERVAL_S = float(os.environ.get("STREAM_UPDATE_INTERVAL_S", "1.0"))
+PLACEHOLDER_TEXT = "_Thinking…_"
+
+# SlackMarkdownConverter keeps per-call state (e.g. code block tracking),
+# so calls from different worker threads must not interleave.
+_converter_lock = threading.Lock()
+
+
+def to_mrkdwn(text: str) -> str:
+    """Convert Markdown to Slack mrkdwn with the shared converter."""
+    with _converter_lock:
+        return mrkdwn_converter.convert(text)
+
+
+class _IncrementalMrkdwn:
+    """Converts a growing Markdown buffer, reusing finished blocks."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._done_upto = 0  # buffer index just past the last converted block
+        self._done: list[str] = []  # mrkdwn for each converted chunk
+
+    def render(self, text: str) -> str:
+        boundary = self._last_block_boundary(text)
+        if boundary > self._done_upto:
+            chunk = text[self._done_upto:boundary]
+            if chunk.strip():
+                self._done.append(to_mrkdwn(chunk))
+            self._done_upto = boundary + 2
+
+        tail = text[self._done_upto:]
+        if tail.count("```") % 2:
+            # Close a still-open code fence so the partial block renders.
+            tail += "\n```"
+        parts = list(self._done)
+        if tail.strip():
+            parts.append(to_mrkdwn(tail))
+        return "\n\n".join(parts)
+
+    def _last_block_boundary(self, text: str) -> int:
+        """Index of the last blank line not inside a code fence, or -1."""
+        idx = text.rfind("\n\n")
+        while idx >= self._done_upto:
+            if text.count("```", 0, idx) % 2 == 0:
+                return idx
+            idx = text.rfind("\n\n", 0, idx)
+        return -1
+
+
+class SlackReplyStream:
+    """A Slack message that is progressively updated with streamed text."""
+
+    def __init__(self, channel: str, thread_ts: str | None = None,
+                 interval: float = STREAM_UPDATE_INTERVAL_S):
+        self.channel = channel
+        self.thread_ts = thread_ts
+        self.interval = interval
+        self.ts: str | None = None
+        self.first_visible_at: float | None = None  # time.time() of first real text
+        self._buffer = ""
+        self._next_update = 0.0  # monotonic time the throttle allows the next update
+        self._failures = 0  # consecutive failed updates
+        self._renderer = _IncrementalMrkdwn()
+
+    def start(self):
+        """Post the placeholder message."""
+        result = app.client.chat_postMessage(
+            channel=self.channel, thread_ts=self.thread_ts, text=PLACEHOLDER_TEXT,
+        )
+        self.ts = result["ts"]
+
+    def reset(self):
+        """Start a new model turn; text from an earlier turn is discarded."""
+        self._buffer = ""
+        self._renderer.reset()
+
+    def append(self, delta: str):
+        """Add streamed text, pushing an update if the throttle allows."""
+        self._buffer += delta
+        if time.monotonic() >= self._next_update:
+            self._push(self._renderer.render(self._buffer))
+
+    def finish(self, text: str):
+        """Replace the message with the fully converted final reply."""
+        mrkdwn = to_mrkdwn(text)
+        if not self._push(mrkdwn):
+            # Don't leave the user with a placeholder — post it fresh.
+            app.client.chat_postMessage(
+                channel=self.channel, thread_ts=self.thread_ts, text=mrkdwn,
+            )
+
+    def _push(self, mrkdwn: str) -> bool:
+        if not mrkdwn.strip():
+            return False
+        # The throttle counts from the attempt, so failing updates don't
+        # turn every delta into another API call.
+        self._next_update = time.monotonic() + self.interval
+        try:
+            app.client.chat_update(channel=self.channel, ts=self.ts, text=mrkdwn)
+        except SlackApiError as e:
+            logger.warning("chat.update failed for %s: %s", self.ts, e)
+            self._failures += 1
+            backoff = self.interval * 2 ** min(self._failures, 5)
+            try:
+                backoff = max(backoff, float(e.response.headers.get("Retry-After", 0)))
+            except (AttributeError, TypeError, ValueError):
+                pass
+            self._next_update = time.monotonic() + backoff
+            return False
+        self._failures = 0
+        if self.first_visible_at is None:
+            self.first_visible_at = time.time()
+        return True
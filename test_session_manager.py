@@ -5,11 +5,75 @@ Run: conda run --prefix .conda python -m pytest test_session_manager.py -v
 
 import json
 import os
+import signal
+import sqlite3
+import subprocess
+import sys
+import threading
 import time
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
 
 import pytest
 
+import tools
 from session_manager import SessionManager, SANDBOX_DIR
+import context_builder
+from conversation_state import ConversationStateStore
+from dispatcher import EventDispatcher
+from router import route
+import streaming
+from event_log import event_log
+from idempotency import IdempotencyCache
+from notifier import CompletionNotifier
+from resource_limits import ConcurrencyController, spawn
+from session_registry import SessionRegistry
+from transcripts import TranscriptStore
+
+# Stand-in for the claude CLI. Directives embedded in the task text control
+# its behavior: SLEEP:<seconds>, STDERR:<bytes>, FAIL. With --input-format
+# it reads the task from stdin, like a warm worker.
+FAKE_CLAUDE_SCRIPT = """\
+#!{python}
+import json, re, signal, sys, time, uuid
+
+if "--input-format" in sys.argv:
+    # Warm worker: wait for one stream-json user message on stdin.
+    line = sys.stdin.readline()
+    prompt = json.loads(line)["message"]["content"] if line else ""
+else:
+    prompt = sys.argv[sys.argv.index("-p") + 1] if "-p" in sys.argv else ""
+
+def emit(obj):
+    print(json.dumps(obj), flush=True)
+
+if "IGNORETERM" in prompt:
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+emit({{"type": "system", "subtype": "init", "session_id": str(uuid.uuid4())}})
+if "NONOBJECT" in prompt:
+    print("123", flush=True)
+    print('["not", "a", "message"]', flush=True)
+m = re.search(r"TOKENS:(\\d+)", prompt)
+if m:
+    usage = {{"input_tokens": 0, "output_tokens": int(m.group(1))}}
+    emit({{"type": "assistant", "message": {{"id": "msg_1", "usage": usage, "content": []}}}})
+m = re.search(r"STDERR:(\\d+)", prompt)
+if m:
+    sys.stderr.write("e" * int(m.group(1)))
+    sys.stderr.flush()
+m = re.search(r"WRITE:(\\S+)", prompt)
+if m:
+    with open(m.group(1), "w") as f:
+        f.write("written by " + prompt[-20:])
+m = re.search(r"SLEEP:([\\d.]+)", prompt)
+if m:
+    time.sleep(float(m.group(1)))
+emit({{"type": "assistant", "message": {{"content": [{{"type": "text", "text": "working"}}]}}}})
+failed = "FAIL" in prompt
+emit({{"type": "result", "result": "fake result", "is_error": failed, "total_cost_usd": 0.01}})
+sys.exit(1 if failed else 0)
+"""
 
 
 @pytest.fixture
@@ -17,7 +81,18 @@ def sm(tmp_path, monkeypatch):
     """Create a SessionManager with a temp sandbox directory."""
     sandbox = str(tmp_path / "sandbox")
     monkeypatch.setattr("session_manager.SANDBOX_DIR", sandbox)
-    return SessionManager()
+    monkeypatch.setattr("transcripts.transcript_store.directory", tmp_path / "transcripts")
+    return SessionManager(registry=SessionRegistry(tmp_path / "sessions.db"))
+
+
+@pytest.fixture
+def fake_claude(tmp_path, monkeypatch):
+    """Point CLAUDE_CODE_PATH at the stand-in script."""
+    path = tmp_path / "fake_claude"
+    path.write_text(FAKE_CLAUDE_SCRIPT.format(python=sys.executable))
+    path.chmod(0o755)
+    monkeypatch.setattr("session_manager.CLAUDE_CODE_PATH", str(path))
+    return path
 
 
 def wait_for_session(session, timeout=30):
@@ -25,7 +100,7 @@ def wait_for_session(session, timeout=30):
     start = time.time()
     while time.time() - start < timeout:
         session.poll()
-        if session.status != "running":
+        if session.status not in ("queued", "running"):
             return
         time.sleep(1)
     raise TimeoutError(f"Session still running after {timeout}s")
@@ -111,9 +186,12 @@ class TestSessionLifecycle:
 
     def test_max_concurrent_sessions(self, sm, monkeypatch):
         monkeypatch.setattr("session_manager.MAX_CONCURRENT_SESSIONS", 1)
-        sm.dispatch("respond with hello")
-        with pytest.raises(RuntimeError, match="Already running"):
-            sm.dispatch("respond with world")
+        first = sm.dispatch("respond with hello")
+        second = sm.dispatch("respond with world")
+        assert second.status == "queued"
+        wait_for_session(first)
+        wait_for_session(second)
+        assert second.status == "done"
 
     def test_session_id_parsed(self, sm):
         session = sm.dispatch("respond with just the word hello")
@@ -121,3 +199,880 @@ class TestSessionLifecycle:
         assert session.session_id is not None
         # Should be a UUID format
         assert len(session.session_id) == 36
+
+
+class TestIOLoop:
+    """Session output is multiplexed on one I/O thread (uses the stand-in CLI)."""
+
+    def test_stderr_flood_does_not_hang(self, sm, fake_claude):
+        session = sm.dispatch("STDERR:1000000 respond with hello")
+        wait_for_session(session, timeout=10)
+        assert session.status == "done"
+        assert session.result == "fake result"
+        assert session.get_stderr_tail()
+
+    def test_many_sessions_use_fixed_threads(self, sm, fake_claude, monkeypatch):
+        monkeypatch.setattr("session_manager.MAX_CONCURRENT_SESSIONS", 20)
+        baseline = threading.active_count()
+        sessions = [sm.dispatch(f"SLEEP:1 task {i}") for i in range(6)]
+        # At most the shared I/O thread is added, however many sessions run.
+        assert threading.active_count() <= baseline + 1
+        for session in sessions:
+            wait_for_session(session, timeout=10)
+            assert session.status == "done"
+            assert session.session_id is not None
+
+    def test_failed_exit_sets_failed(self, sm, fake_claude):
+        session = sm.dispatch("FAIL please")
+        wait_for_session(session, timeout=10)
+        assert session.status == "failed"
+
+    def test_non_object_json_is_ignored(self, sm, fake_claude):
+        session = sm.dispatch("NONOBJECT respond with hello")
+        wait_for_session(session, timeout=10)
+        assert session.status == "done"
+        assert session.result == "fake result"
+
+    def test_handler_error_does_not_stop_the_io_thread(self, sm, fake_claude, monkeypatch):
+        import session_manager as sm_module
+        real_parse = sm_module._parse_activity
+        calls = []
+
+        def parse(data):
+            calls.append(data)
+            if len(calls) == 1:
+                raise RuntimeError("boom")
+            return real_parse(data)
+
+        monkeypatch.setattr("session_manager._parse_activity", parse)
+        first = sm.dispatch("respond with hello")
+        wait_for_session(first, timeout=10)
+        second = sm.dispatch("respond with world")
+        wait_for_session(second, timeout=10)
+        assert (first.status, second.status) == ("done", "done")
+
+
+class TestTranscripts:
+    """Session output keeps a bounded tail in memory and the rest on disk."""
+
+    def test_older_lines_read_back_from_disk(self, tmp_path):
+        store = TranscriptStore(tmp_path, tail_lines=10, memory_cap=1_000_000)
+        transcript = store.open("task-1")
+        for i in range(100):
+            transcript.append(f"line {i}")
+        assert len(transcript) == 100
+        assert store.memory_bytes == sum(len(f"line {i}") for i in range(90, 100))
+        assert transcript.read(5, 3) == ["line 5", "line 6", "line 7"]
+        assert transcript.read(88, 4) == ["line 88", "line 89", "line 90", "line 91"]
+        assert transcript.read() == [f"line {i}" for i in range(100)]
+
+    def test_global_memory_cap(self, tmp_path):
+        store = TranscriptStore(tmp_path, tail_lines=1000, memory_cap=2000)
+        transcripts = [store.open(f"task-{n}") for n in range(3)]
+        for i in range(200):
+            for transcript in transcripts:
+                transcript.append(f"{i:09d}")
+        assert store.memory_bytes <= 2000
+        assert all(len(t) == 200 for t in transcripts)
+        assert transcripts[0].read(0, 1) == ["000000000"]
+
+    def test_session_output_goes_to_transcript(self, sm, fake_claude):
+        session = sm.dispatch("respond with hello")
+        wait_for_session(session, timeout=10)
+        lines = session.get_output_lines()
+        assert json.loads(lines[0])["subtype"] == "init"
+        assert json.loads(lines[-1])["type"] == "result"
+        assert session.transcript.path.read_text().splitlines() == lines
+
+
+class TestReadOutput:
+    """read_task_output returns pre-parsed activity from a cursor, within a budget."""
+
+    def test_cursor_returns_only_new_activity(self, sm, fake_claude):
+        session = sm.dispatch("respond with hello")
+        wait_for_session(session, timeout=10)
+        first = sm.read_output(session.internal_id, since=0)
+        assert "Assistant: working" in first
+        assert "fake result" in first
+        assert "since=1" in first
+
+        again = sm.read_output(session.internal_id, since=1)
+        assert "Assistant: working" not in again
+        assert "no new activity since cursor 1" in again
+
+    def test_output_is_size_bounded(self, sm, fake_claude):
+        session = sm.dispatch("SLEEP:5 respond with hello")
+        for i in range(200):
+            session.add_event("assistant", f"step {i} " + "x" * 100)
+        out = sm.read_output(session.internal_id, max_chars=1000)
+        assert len(out) < 1500
+        assert "step 199" in out
+        assert "earlier events omitted" in out
+        sm.cleanup(session.internal_id)
+
+
+class TestScheduler:
+    """Dispatches beyond the slot limit queue up and start as slots free."""
+
+    def test_queued_session_starts_when_slot_frees(self, sm, fake_claude, monkeypatch):
+        monkeypatch.setattr("session_manager.MAX_CONCURRENT_SESSIONS", 1)
+        first = sm.dispatch("SLEEP:1 first")
+        second = sm.dispatch("second")
+        assert first.status == "running"
+        assert second.status == "queued" and second.process is None
+        wait_for_session(first, timeout=10)
+        wait_for_session(second, timeout=10)
+        assert second.status == "done"
+        assert second.queue_wait_s > 0
+
+    def test_queue_order_priority_then_fairness(self, sm, fake_claude, monkeypatch):
+        monkeypatch.setattr("session_manager.MAX_CONCURRENT_SESSIONS", 1)
+        blocker = sm.dispatch("SLEEP:5 blocker", user="ann")
+        background = sm.dispatch("background", priority="background", user="bob")
+        ann_again = sm.dispatch("SLEEP:1 ann again", user="ann")
+        bob = sm.dispatch("SLEEP:1 bob", user="bob")
+        assert sm._queue == [background, ann_again, bob]
+
+        # With ann's blocker still running, bob's interactive task goes first.
+        with sm._lock:
+            assert sm._schedule_locked() == []
+            blocker._set_status("done")
+            assert sm._schedule_locked() == [ann_again]
+            ann_again._set_status("done")
+            assert sm._schedule_locked() == [bob]
+            bob._set_status("done")
+            assert sm._schedule_locked() == [background]
+        for session in (blocker, ann_again, bob, background):
+            wait_for_session(session, timeout=10)
+
+    def test_browser_slots(self, sm, fake_claude, monkeypatch):
+        monkeypatch.setattr("session_manager.MAX_CONCURRENT_SESSIONS", 3)
+        monkeypatch.setattr("session_manager.MAX_BROWSER_SESSIONS", 1)
+        first = sm.dispatch("SLEEP:3 browse a", use_browser=True)
+        second = sm.dispatch("browse b", use_browser=True)
+        plain = sm.dispatch("no browser")
+        assert first.status == "running"
+        assert second.status == "queued"
+        assert plain.status != "queued"
+        for session in (first, second, plain):
+            wait_for_session(session, timeout=10)
+        assert second.status == "done"
+
+
+class TestReadiness:
+    """dispatch returns at once; wait_ready() signals when the session id is known."""
+
+    def test_dispatch_does_not_block(self, sm, fake_claude):
+        start = time.time()
+        session = sm.dispatch("SLEEP:2 respond with hello")
+        assert time.time() - start < 0.4
+        assert session.wait_ready(timeout=5)
+        assert session.session_id is not None
+        assert session.status == "running"
+        wait_for_session(session, timeout=10)
+
+    def test_early_exit_sets_ready(self, sm, fake_claude, monkeypatch):
+        monkeypatch.setattr("session_manager.CLAUDE_CODE_PATH", "false")
+        session = sm.dispatch("anything")
+        assert session.wait_ready(timeout=5)
+        assert session.session_id is None
+        wait_for_session(session, timeout=5)
+        assert session.status == "failed"
+
+
+class TestBudgets:
+    """Sessions over their time, cost or output budget are stopped."""
+
+    def test_timeout(self, sm, fake_claude):
+        session = sm.dispatch("SLEEP:30 respond with hello", timeout_s=1)
+        wait_for_session(session, timeout=10)
+        assert session.status == "timeout"
+        assert "1s" in session.result
+
+    def test_cost_limit(self, sm, fake_claude):
+        # 100k output tokens at $15/MTok is an estimated $1.50.
+        session = sm.dispatch("TOKENS:100000 SLEEP:30 respond", max_cost_usd=1.0)
+        wait_for_session(session, timeout=10)
+        assert session.status == "budget_exceeded"
+        assert session.cost_estimate == pytest.approx(1.5)
+
+    def test_output_limit(self, sm, fake_claude):
+        session = sm.dispatch("STDERR:5000 SLEEP:30 respond", max_output_bytes=1000)
+        wait_for_session(session, timeout=10)
+        assert session.status == "budget_exceeded"
+        assert session.output_bytes > 1000
+
+    def test_kill_after_grace(self, sm, fake_claude, monkeypatch):
+        monkeypatch.setattr("session_manager.KILL_GRACE_S", 1)
+        session = sm.dispatch("IGNORETERM SLEEP:30 respond", timeout_s=1)
+        wait_for_session(session, timeout=10)
+        assert session.status == "timeout"
+        assert session.process.returncode == -signal.SIGKILL
+
+
+class TestResourceLimits:
+    """rlimits on spawned processes and the adaptive slot controller."""
+
+    def test_spawn_applies_rlimits(self, monkeypatch):
+        monkeypatch.setattr("resource_limits.SESSION_RLIMIT_NOFILE", 64)
+        process = spawn(
+            [sys.executable, "-c", "import resource; print(resource.getrlimit(resource.RLIMIT_NOFILE)[0])"],
+            stdout=subprocess.PIPE,
+        )
+        assert process.communicate(timeout=10)[0].strip() == b"64"
+
+    def test_process_joins_cgroup_before_exec(self, monkeypatch, tmp_path):
+        # A plain directory stands in for the cgroup v2 root.
+        monkeypatch.setattr("resource_limits.SESSION_CGROUP_ROOT", str(tmp_path))
+        process = spawn(
+            [sys.executable, "-c", "import glob, os; "
+             f"print(open(glob.glob({str(tmp_path)!r} + '/*/cgroup.procs')[0]).read().strip(), os.getpid())"],
+            stdout=subprocess.PIPE,
+        )
+        written, pid = process.communicate(timeout=10)[0].split()
+        assert written == pid == str(process.pid).encode()
+
+    def test_controller_follows_load(self):
+        controller = ConcurrencyController(enabled=True, min_slots=1)
+        assert controller.slots(4) == 4
+        assert controller.evaluate(4, running=4, backlog=True, load=3.0, mem_mb=8000) == 3
+        assert controller.evaluate(4, running=3, backlog=True, load=3.0, mem_mb=100) == 2
+        # Recovers one step at a time, only while there is a backlog.
+        assert controller.evaluate(4, running=2, backlog=False, load=0.1, mem_mb=8000) == 2
+        assert controller.evaluate(4, running=2, backlog=True, load=0.1, mem_mb=8000) == 3
+        # No growth while recent sessions run much slower than usual.
+        controller.record_duration(10)
+        controller.record_duration(100)
+        assert controller.evaluate(4, running=3, backlog=True, load=0.1, mem_mb=8000) == 3
+        events = event_log.get_events(event_type="concurrency_adjust")
+        assert [(e.data["old"], e.data["new"]) for e in events[-3:]] == [(4, 3), (3, 2), (2, 3)]
+
+
+class TestWarmPool:
+    """Plain tasks go to pre-started workers when the warm pool is on."""
+
+    def test_task_runs_on_warm_worker(self, sm, fake_claude):
+        sm.warm_pool.size = 2
+        sm.warm_up()
+        deadline = time.time() + 10
+        while sm.warm_pool.idle_count() < 2 and time.time() < deadline:
+            time.sleep(0.05)
+        assert sm.warm_pool.idle_count() == 2
+
+        session = sm.dispatch("respond with hello")
+        wait_for_session(session, timeout=10)
+        assert session.start_mode == "warm"
+        assert session.status == "done"
+        assert session.session_id is not None
+        assert session.startup_s is not None
+        # The pool is topped back up in the background.
+        deadline = time.time() + 10
+        while sm.warm_pool.idle_count() < 2 and time.time() < deadline:
+            time.sleep(0.05)
+        assert sm.warm_pool.idle_count() == 2
+        sm.shutdown()
+
+    def test_browser_and_empty_pool_start_cold(self, sm, fake_claude):
+        plain = sm.dispatch("respond with hello")
+        sm.warm_pool.size = 1
+        sm.warm_up()
+        deadline = time.time() + 10
+        while sm.warm_pool.idle_count() < 1 and time.time() < deadline:
+            time.sleep(0.05)
+        browser = sm.dispatch("open a page", use_browser=True)
+        for session in (plain, browser):
+            wait_for_session(session, timeout=10)
+            assert session.start_mode == "cold"
+        assert sm.warm_pool.idle_count() == 1
+        sm.shutdown()
+
+
+class TestRegistry:
+    """Sessions survive a bot restart via the on-disk registry."""
+
+    def test_failed_flush_is_retried(self, sm, fake_claude, tmp_path, monkeypatch):
+        session = sm.dispatch("respond with hello")
+        wait_for_session(session, timeout=10)
+        registry = SessionRegistry(tmp_path / "retry.db", flush_interval=60)
+        connect = registry._connect
+
+        def locked():
+            raise sqlite3.OperationalError("database is locked")
+        monkeypatch.setattr(registry, "_connect", locked)
+        registry.record(session.to_record())
+        registry.flush()
+        monkeypatch.setattr(registry, "_connect", connect)
+        assert registry.load_one("task-1")["status"] == "done"
+        registry.close()
+
+    def test_restore_after_restart(self, sm, fake_claude, tmp_path):
+        session = sm.dispatch("respond with hello")
+        wait_for_session(session, timeout=10)
+        sm.registry.flush()
+
+        restarted = SessionManager(registry=SessionRegistry(tmp_path / "sessions.db"))
+        restarted.restore()
+        restored = restarted.sessions["task-1"]
+        assert restored.status == "done"
+        assert restored.session_id == session.session_id
+        assert restored.result == "fake result"
+        assert "Assistant: working" in restarted.read_output("task-1", since=0)
+        assert restarted.dispatch("another").internal_id == "task-2"
+        restarted.shutdown()
+
+    def test_orphaned_process_is_reaped(self, sm, fake_claude, tmp_path):
+        orphan = subprocess.Popen([str(fake_claude), "-p", "SLEEP:30 orphan"],
+                                  stdout=subprocess.DEVNULL)
+        session = sm.dispatch("SLEEP:30 still running")
+        record = session.to_record()
+        record["pid"] = orphan.pid
+        sm.registry.record(record)
+        sm.registry.flush()
+
+        restarted = SessionManager(registry=SessionRegistry(tmp_path / "sessions.db"))
+        restarted.restore()
+        assert orphan.wait(timeout=5) != 0
+        assert restarted.sessions["task-1"].status == "failed"
+        sm.cleanup("task-1")
+
+
+class TestDedup:
+    """Repeated dispatches of the same task reuse the existing session."""
+
+    def test_duplicate_of_running_task(self, sm, fake_claude):
+        first, created = sm.find_or_dispatch("SLEEP:2 Check the disk usage.")
+        assert created
+        again, created = sm.find_or_dispatch("  sleep:2 check the   DISK usage ")
+        assert not created and again is first
+        assert first.dedup_hits == 1 and sm.dedup_hits == 1
+        # Different flags are a different task.
+        assert sm.dispatch("SLEEP:2 check the disk usage", isolate=True) is not first
+        wait_for_session(first, timeout=10)
+        assert sm.dispatch("SLEEP:2 check the disk usage") is first
+
+    def test_other_users_and_threads_get_their_own_session(self, sm, fake_claude):
+        first = sm.dispatch("SLEEP:2 check the disk usage", user="alice", origin=("C1", "1.0"))
+        assert sm.dispatch("SLEEP:2 check the disk usage",
+                           user="alice", origin=("C1", "1.0")) is first
+        other_thread = sm.dispatch("SLEEP:2 check the disk usage", user="alice", origin=("C2", "1.0"))
+        other_user = sm.dispatch("SLEEP:2 check the disk usage", user="bob", origin=("C1", "1.0"))
+        assert len({first.internal_id, other_thread.internal_id, other_user.internal_id}) == 3
+        assert other_thread.origin == ("C2", "1.0") and other_user.user == "bob"
+        for session in (first, other_thread, other_user):
+            wait_for_session(session, timeout=10)
+
+    def test_failed_or_expired_tasks_run_again(self, sm, fake_claude, monkeypatch):
+        failed = sm.dispatch("FAIL respond")
+        wait_for_session(failed, timeout=10)
+        retry = sm.dispatch("FAIL respond")
+        assert retry is not failed
+        wait_for_session(retry, timeout=10)
+
+        monkeypatch.setattr("session_manager.DISPATCH_DEDUP_WINDOW_S", 0)
+        done = sm.dispatch("respond with hello")
+        wait_for_session(done, timeout=10)
+        assert sm.dispatch("respond with hello") is not done
+
+    def test_fingerprint_survives_restart(self, sm, fake_claude, tmp_path):
+        session = sm.dispatch("respond with hello")
+        wait_for_session(session, timeout=10)
+        sm.registry.flush()
+
+        restarted = SessionManager(registry=SessionRegistry(tmp_path / "sessions.db"))
+        restarted.restore()
+        assert restarted.dispatch("Respond with hello!").internal_id == "task-1"
+        restarted.shutdown()
+
+
+def wait_for_idle_worktrees(sm, count, timeout=10):
+    deadline = time.time() + timeout
+    while sm.worktrees.idle_count() < count and time.time() < deadline:
+        time.sleep(0.05)
+    assert sm.worktrees.idle_count() == count
+
+
+class TestWorktreePool:
+    """Isolated sessions lease pooled worktrees and leave their work on a branch."""
+
+    def test_lease_commit_and_reset(self, sm, fake_claude, tmp_path):
+        sm.worktrees.size = 1
+        session = sm.dispatch("WRITE:out.txt edit a file", isolate=True)
+        wait_for_session(session, timeout=10)
+        assert session.status == "done"
+        assert session._worktree_path.startswith(str(tmp_path / "sandbox" / ".worktrees"))
+        wait_for_idle_worktrees(sm, 1)
+
+        # The work is on the task branch; the pool holds one clean worktree.
+        sandbox = tmp_path / "sandbox"
+        assert not list(sandbox.glob(".worktrees/*/out.txt"))
+        shown = subprocess.run(["git", "show", "task/task-1:out.txt"], cwd=sandbox,
+                               capture_output=True, text=True)
+        assert shown.stdout.startswith("written by")
+
+        again = sm.dispatch("WRITE:other.txt another edit", isolate=True)
+        wait_for_session(again, timeout=10)
+        leases = event_log.get_events(event_type="worktree_lease")
+        assert leases[-1].data["session_id"] == "task-2"
+
+    def test_worktree_starts_from_a_sandbox_snapshot(self, sm, fake_claude, tmp_path):
+        sandbox = tmp_path / "sandbox"
+        sandbox.mkdir(exist_ok=True)
+        (sandbox / "notes.txt").write_text("before")
+        sm.worktrees.size = sm.worktrees.max_worktrees = 1
+        sm.warm_up()
+        wait_for_idle_worktrees(sm, 1)
+        path = Path(sm.worktrees.lease("task-1"))
+        assert (path / "notes.txt").read_text() == "before"
+        (path / "edit.txt").write_text("task work")
+
+        # The sandbox moves on while the task runs; its own files are untouched.
+        (sandbox / "notes.txt").write_text("after")
+        (sandbox / "new.txt").write_text("new")
+        sm.worktrees.release_async(str(path), "task-1")
+        wait_for_idle_worktrees(sm, 1)
+        assert not (sandbox / "edit.txt").exists()
+        status = subprocess.run(["git", "status", "--porcelain"], cwd=sandbox,
+                                capture_output=True, text=True).stdout
+        assert status.split() == ["M", "notes.txt", "??", "new.txt"]
+
+        # The next lease sees the sandbox as of the reset, without task-1's work
+        # (that stays on its task branch).
+        again = Path(sm.worktrees.lease("task-2"))
+        assert (again / "notes.txt").read_text() == "after"
+        assert (again / "new.txt").exists() and not (again / "edit.txt").exists()
+        shown = subprocess.run(["git", "show", "task/task-1:edit.txt"], cwd=sandbox,
+                               capture_output=True, text=True)
+        assert shown.stdout == "task work"
+
+    def test_lease_never_runs_git(self, sm, fake_claude, monkeypatch):
+        sm.worktrees.size = sm.worktrees.max_worktrees = 1
+        sm.warm_up()
+        wait_for_idle_worktrees(sm, 1)
+
+        def no_git(*args, **kwargs):
+            raise AssertionError("git ran during lease")
+        monkeypatch.setattr("worktree_pool._git", no_git)
+        path = sm.worktrees.lease("task-9")
+        assert path is not None
+        assert sm.worktrees.lease("task-10") is None  # nothing idle
+
+    def test_isolated_tasks_wait_for_a_worktree(self, sm, fake_claude):
+        sm.worktrees.size = 0
+        sm.worktrees.max_worktrees = 1
+        first = sm.dispatch("SLEEP:1 first edit", isolate=True)
+        second = sm.dispatch("SLEEP:1 second edit", isolate=True)
+        assert second.status == "queued"
+        wait_for_session(second, timeout=15)
+        assert (first.status, second.status) == ("done", "done")
+        assert second.started_at >= first.finished_at
+
+    def test_abandoned_worktrees_are_collected(self, sm, fake_claude, tmp_path):
+        session = sm.dispatch("SLEEP:30 WRITE:half.txt edit", isolate=True)
+        deadline = time.time() + 10
+        while not (session._worktree_path
+                   and os.path.exists(os.path.join(session._worktree_path, "half.txt"))):
+            assert time.time() < deadline
+            time.sleep(0.05)
+        # Simulate a crash: a new manager finds the worktree with its owner file.
+        restarted = SessionManager(registry=SessionRegistry(tmp_path / "other.db"))
+        restarted.worktrees.collect()
+        assert not os.path.exists(session._worktree_path)
+        shown = subprocess.run(["git", "show", "task/task-1:half.txt"], cwd=tmp_path / "sandbox",
+                               capture_output=True, text=True)
+        assert shown.returncode == 0
+        sm.cleanup("task-1")
+
+
+class TestLifecycle:
+    """Status index, list filtering/paging, and archiving of finished sessions."""
+
+    def test_status_index_and_paging(self, sm, fake_claude, monkeypatch):
+        monkeypatch.setattr("session_manager.MAX_CONCURRENT_SESSIONS", 1)
+        sessions = [sm.dispatch(f"SLEEP:1 task {i}") for i in range(3)]
+        assert sm.status_counts() == {"queued": 2, "running": 1, "done": 0, "failed": 0,
+                                      "timeout": 0, "budget_exceeded": 0}
+        assert [s["id"] for s in sm.list_sessions(status="queued")] == ["task-3", "task-2"]
+        assert [s["id"] for s in sm.list_sessions(limit=2, offset=1)] == ["task-2", "task-1"]
+        for session in sessions:
+            wait_for_session(session, timeout=15)
+        assert sm.status_counts()["done"] == 3
+
+    def test_finished_sessions_are_archived(self, sm, fake_claude, monkeypatch):
+        monkeypatch.setattr("session_manager.MAX_FINISHED_SESSIONS", 1)
+        first = sm.dispatch("respond with hello")
+        wait_for_session(first, timeout=10)
+        second = sm.dispatch("respond with world")
+        wait_for_session(second, timeout=10)
+        sm.list_sessions()
+        assert list(sm.sessions) == ["task-2"]
+        assert sm.status_counts()["done"] == 1
+        # Archived sessions are still readable by id.
+        assert "fake result" in sm.read_output("task-1")
+
+
+class TestWaitForTasks:
+    """wait_for_tasks blocks until sessions finish, without polling."""
+
+    def test_any_and_all(self, sm, fake_claude):
+        fast = sm.dispatch("respond quickly")
+        slow = sm.dispatch("SLEEP:2 respond slowly")
+        result = sm.wait_for_tasks([fast.internal_id, slow.internal_id], mode="any", timeout=10)
+        assert result["finished"] == [fast.internal_id]
+        assert result["pending"] == [slow.internal_id]
+        assert not result["timed_out"]
+
+        result = sm.wait_for_tasks([fast.internal_id, slow.internal_id], mode="all", timeout=10)
+        assert sorted(result["finished"]) == [fast.internal_id, slow.internal_id]
+        assert result["waited_s"] < 5
+
+    def test_timeout(self, sm, fake_claude):
+        session = sm.dispatch("SLEEP:5 respond slowly")
+        result = sm.wait_for_tasks([session.internal_id], timeout=0.5)
+        assert result["timed_out"]
+        assert result["pending"] == [session.internal_id]
+        with pytest.raises(ValueError):
+            sm.wait_for_tasks(["task-99"])
+        sm.cleanup(session.internal_id)
+
+
+class TestTaskGroups:
+    """Batch dispatch under a group id, quorum waits and merged results."""
+
+    def test_quorum_and_merged_result(self, sm, fake_claude):
+        group = sm.dispatch_group(
+            [{"task": "respond with one"}, {"task": "respond with two"},
+             {"task": "SLEEP:30 respond with three"}],
+            quorum=2,
+        )
+        assert group.session_ids == ["task-1", "task-2", "task-3"]
+        waited = sm.wait_for_group(group.group_id, timeout=10)
+        assert not waited["timed_out"]
+        progress = sm.group_progress(group.group_id)
+        assert progress["quorum_met"] and progress["finished"] == 2
+        report = sm.read_group(group.group_id)
+        assert report.startswith("Group group-1 — 2/3 finished (quorum 2 met)")
+        assert report.count("fake result") == 2
+        assert "### task-3 — running" in report
+        quorum_events = event_log.get_events(event_type="group_quorum")
+        assert quorum_events[-1].data["group_id"] == "group-1"
+        sm.cleanup("task-3")
+
+    def test_shared_member_completes_every_group(self, sm, fake_claude):
+        first = sm.dispatch_group([{"task": "SLEEP:1 respond with shared"}])
+        second = sm.dispatch_group([{"task": "SLEEP:1 respond with shared"},
+                                    {"task": "SLEEP:1 respond with shared"}], quorum=2)
+        assert second.session_ids == first.session_ids == ["task-1"]
+        assert second.needed() == 1  # lowered: duplicates left one member
+        sm.wait_for_group(second.group_id, timeout=10)
+        deadline = time.time() + 5
+        while [e.data["group_id"] for e in event_log.get_events(
+                event_type="group_quorum")[-2:]] != ["group-1", "group-2"]:
+            assert time.time() < deadline
+            time.sleep(0.05)
+
+    def test_merged_result_is_size_bounded(self, sm, fake_claude):
+        group = sm.dispatch_group([{"task": f"respond {i}"} for i in range(3)])
+        sm.wait_for_group(group.group_id, timeout=10)
+        for i, internal_id in enumerate(group.session_ids):
+            sm.sessions[internal_id].result = ("x" if i else "short") * (5000 if i else 1)
+        report = sm.read_group(group.group_id, max_chars=2000)
+        assert len(report) < 2100
+        assert "short" in report and report.count("… [truncated]") == 2
+
+    def test_invalid_batches(self, sm, fake_claude):
+        with pytest.raises(ValueError):
+            sm.dispatch_group([])
+        with pytest.raises(ValueError):
+            sm.dispatch_group([{"task": "respond"}], quorum=2)
+        with pytest.raises(ValueError):
+            sm.read_group("group-9")
+
+
+class TestIdempotency:
+    """Completed events stay deduplicated across restarts; in-flight ones don't."""
+
+    def test_restart_keeps_only_completed_events(self, tmp_path):
+        path = tmp_path / "seen.log"
+        cache = IdempotencyCache(path)
+        assert cache.begin(["event:done"]) is None
+        cache.complete(["event:done"])
+        assert cache.begin(["event:crashed"]) is None  # never completed
+        assert cache.begin(["event:done"]) == "completed"
+        cache.close()
+
+        restarted = IdempotencyCache(path)
+        assert restarted.begin(["event:done"]) == "completed"
+        assert restarted.begin(["event:crashed"]) is None
+        restarted.close()
+
+
+class TestContextBudget:
+    """History compaction and chaining measure tokens the same way for every model."""
+
+    @staticmethod
+    def history(n, chars=400):
+        return [{"role": "user" if i % 2 == 0 else "assistant", "content": f"{i} " + "x" * chars}
+                for i in range(n)]
+
+    def test_summary_split_ignores_the_routed_model(self, monkeypatch):
+        monkeypatch.setattr(context_builder, "CONTEXT_TOKEN_BUDGETS",
+                            {context_builder.OPENAI_MODEL: 2000, "small": 500})
+        calls = []
+        monkeypatch.setattr(context_builder, "summarize",
+                            lambda previous, messages: calls.append(len(messages)) or "summary")
+        builder = context_builder.ContextBuilder(keep_messages=50)
+        messages = self.history(40)
+        full = builder.build("C1:1", messages, context_builder.OPENAI_MODEL)
+        small = builder.build("C1:1", messages, "small")
+        again = builder.build("C1:1", messages, context_builder.OPENAI_MODEL)
+        assert len(calls) == 1  # one summary, reused across models
+        assert again == full and len(small) < len(full)
+        assert small[0] == full[0] and small[-1] == messages[-1]
+        assert context_builder.estimate_tokens(small[1:]) <= 500
+
+    def test_chain_budget_counts_history_only(self):
+        store = ConversationStateStore()
+        sent = self.history(3, chars=40)
+        store.save("C1:1", sent, "resp-1", chain_tokens=context_builder.estimate_tokens(sent))
+        messages = sent + [{"role": "assistant", "content": "reply"},
+                           {"role": "user", "content": "and then?"}]
+        state = store.lookup("C1:1", messages, max_chain_tokens=100)
+        assert state.hit and state.chain_tokens == context_builder.estimate_tokens(sent)
+
+
+class TestRouting:
+    """Only thanks and greetings take the ack route; confirmations never do."""
+
+    @pytest.mark.parametrize("text", ["thanks!", "Thank you", "lol", "hey", "bye."])
+    def test_acknowledgements(self, text):
+        assert route([{"role": "user", "content": text}]).route == "ack"
+
+    @pytest.mark.parametrize("text", ["yes", "ok", "sure", "sounds good", "perfect",
+                                      "great", "got it", "👍", ":+1:"])
+    def test_confirmations_are_not_acks(self, text):
+        messages = [{"role": "assistant", "content": "Shall I dispatch this as a task?"},
+                    {"role": "user", "content": text}]
+        assert route(messages).route != "ack"
+
+
+class TestReplyStream:
+    """Streamed replies update Slack at most once per interval, and back off on errors."""
+
+    class FakeClient:
+        def __init__(self, fail):
+            self.fail = fail
+            self.updates = 0
+
+        def chat_update(self, **kwargs):
+            self.updates += 1
+            if self.fail:
+                raise streaming.SlackApiError(
+                    "ratelimited", SimpleNamespace(status_code=429, headers={"Retry-After": "3"}))
+
+    @pytest.mark.parametrize("fail", [False, True])
+    def test_updates_are_throttled(self, monkeypatch, fail):
+        client = self.FakeClient(fail)
+        monkeypatch.setattr(streaming, "app", SimpleNamespace(client=client))
+        stream = streaming.SlackReplyStream("C1", interval=0.2)
+        stream.ts = "1.0"
+        for _ in range(50):
+            stream.append("word ")
+            time.sleep(0.01)
+        # ~0.5s of deltas: a few updates when they succeed; one attempt, then
+        # Retry-After, when they fail.
+        if fail:
+            assert client.updates == 1
+        else:
+            assert 2 <= client.updates <= 4
+
+
+class TestEventDispatcher:
+    """Jobs run in order per key and in parallel across keys."""
+
+    def test_order_per_key_and_parallel_keys(self):
+        dispatcher = EventDispatcher(workers=4)
+        ran = []
+        done = threading.Event()
+
+        def job(key, i):
+            time.sleep(0.2)
+            ran.append((key, i))
+            if len(ran) == 6:
+                done.set()
+        start = time.monotonic()
+        for i in range(3):
+            for key in ("C1:1700000000.000100", "C2:1700000000.000100"):
+                assert dispatcher.submit(key, job, key, i)
+        assert done.wait(5)
+        dispatcher.shutdown()
+        # Same thread_ts in two channels: two keys, so they overlap.
+        assert time.monotonic() - start < 1.0
+        for key in ("C1:1700000000.000100", "C2:1700000000.000100"):
+            assert [i for k, i in ran if k == key] == [0, 1, 2]
+
+    def test_full_queue_drops_jobs(self):
+        dispatcher = EventDispatcher(workers=1, max_queued=1)
+        release = threading.Event()
+        assert dispatcher.submit("a", release.wait)
+        deadline = time.time() + 5
+        while dispatcher.stats()["busy_workers"] < 1:
+            assert time.time() < deadline
+            time.sleep(0.01)
+        assert dispatcher.submit("b", lambda: None)
+        assert not dispatcher.submit("c", lambda: None)
+        release.set()
+        dispatcher.shutdown()
+
+
+class TestToolCalls:
+    """Tool calls run concurrently, keep their order, and time out from when they start."""
+
+    @staticmethod
+    def response(*names):
+        return SimpleNamespace(output=[
+            SimpleNamespace(type="function_call", name=name, arguments="{}", call_id=f"call-{i}")
+            for i, name in enumerate(names)])
+
+    @pytest.fixture
+    def fake_tools(self, monkeypatch):
+        """Tools named like 'sleep_0.5' sleep that long and return their name."""
+        def dispatch(name, arguments, username, origin=None):
+            time.sleep(float(name.split("_")[1]))
+            return name
+        monkeypatch.setattr(tools, "dispatch_function_call", dispatch)
+
+    def test_concurrent_and_in_order(self, fake_tools):
+        start = time.monotonic()
+        outputs = tools.handle_function_calls(
+            self.response("sleep_0.6", "sleep_0.1", "sleep_0.6"), "alice")
+        assert time.monotonic() - start < 1.1
+        assert [o["call_id"] for o in outputs] == ["call-0", "call-1", "call-2"]
+        assert [o["output"] for o in outputs] == ["sleep_0.6", "sleep_0.1", "sleep_0.6"]
+
+    def test_timeout_counts_from_start(self, fake_tools, monkeypatch):
+        monkeypatch.setattr(tools, "_executor", ThreadPoolExecutor(max_workers=1))
+        monkeypatch.setattr(tools, "DEFAULT_TOOL_TIMEOUT_S", 1.0)
+        # The second call waits 0.7s for the worker, then runs 0.7s: within its 1s.
+        outputs = tools.handle_function_calls(self.response("sleep_0.7", "sleep_0.7"), "alice")
+        assert [o["output"] for o in outputs] == ["sleep_0.7", "sleep_0.7"]
+
+    def test_timed_out_and_not_started(self, fake_tools, monkeypatch):
+        monkeypatch.setattr(tools, "_executor", ThreadPoolExecutor(max_workers=1))
+        monkeypatch.setattr(tools, "DEFAULT_TOOL_TIMEOUT_S", 0.5)
+        outputs = tools.handle_function_calls(self.response("sleep_2", "sleep_0"), "alice")
+        assert outputs[0]["output"] == "Error: sleep_2 timed out after 0.5s"
+        assert "not started" in outputs[1]["output"]
+
+    def test_waits_leave_event_workers_free(self, sm, fake_claude, monkeypatch):
+        monkeypatch.setattr(tools, "session_manager", sm)
+        session = sm.dispatch("SLEEP:30 respond slowly")
+        dispatcher = EventDispatcher(workers=4)
+        outputs = {}
+
+        def wait(key):
+            outputs[key] = json.loads(tools.dispatch_function_call(
+                "wait_for_tasks", json.dumps({"session_ids": [session.internal_id],
+                                              "timeout_s": 3}), "alice"))
+        for i in range(4):
+            dispatcher.submit(f"C{i}:1.0", wait, f"C{i}:1.0")
+        other = threading.Event()
+        dispatcher.submit("C9:1.0", other.set)
+        # Only TOOL_MAX_BLOCKING_WAITS of the four block; another thread still gets a worker.
+        assert other.wait(2)
+        deadline = time.time() + 10
+        while len(outputs) < 4:
+            assert time.time() < deadline
+            time.sleep(0.05)
+        dispatcher.shutdown()
+        busy = [o for o in outputs.values() if "note" in o]
+        assert len(busy) == 4 - tools.TOOL_MAX_BLOCKING_WAITS
+        assert all(o["waited_s"] < 1 for o in busy)
+        sm.cleanup(session.internal_id)
+
+    def test_model_limits_are_clamped(self, monkeypatch):
+        seen = []
+
+        def find_or_dispatch(**kwargs):
+            seen.append(kwargs)
+            return SimpleNamespace(internal_id="task-1", status="running"), True
+        monkeypatch.setattr(tools.session_manager, "find_or_dispatch", find_or_dispatch)
+        for timeout_s, cost in ((0, -1), (1e9, 1e9), (60, 0.5)):
+            tools.dispatch_function_call("dispatch_computer_task", json.dumps(
+                {"task": "x", "timeout_s": timeout_s, "max_cost_usd": cost}), "alice")
+        assert [(k["timeout_s"], k["max_cost_usd"]) for k in seen] == [
+            (None, None),
+            (tools.SESSION_TIMEOUT_CAP_S, tools.SESSION_MAX_COST_CAP_USD),
+            (60, 0.5),
+        ]
+
+
+class TestCompletionNotifier:
+    """Finished sessions post a notice back to the Slack thread they came from."""
+
+    class FakeSlack:
+        def __init__(self):
+            self.posts = []
+
+        def chat_postMessage(self, **kwargs):
+            self.posts.append(kwargs)
+
+    def test_stopped_session_notice_shows_estimated_cost(self, sm, fake_claude):
+        slack = self.FakeSlack()
+        notifier = CompletionNotifier(slack, min_interval_s=0)
+        notifier.start()
+        sm.add_completion_listener(notifier.notify)
+        session = sm.dispatch("TOKENS:100000 SLEEP:30 respond", max_cost_usd=1.0,
+                              origin=("C123", "1.0"))
+        wait_for_session(session, timeout=10)
+        notifier.shutdown()
+        assert session.cost == pytest.approx(1.5)
+        assert "budget_exceeded — $1.50" in slack.posts[0]["text"]
+
+    def test_no_notices_for_sessions_stopped_by_shutdown(self, sm, fake_claude):
+        slack = self.FakeSlack()
+        notifier = CompletionNotifier(slack, min_interval_s=0)
+        notifier.start()
+        sm.add_completion_listener(notifier.notify)
+        session = sm.dispatch("SLEEP:30 respond", origin=("C123", "1.0"))
+        session.wait_ready(timeout=10)
+        sm.shutdown()
+        notifier.shutdown()
+        assert session.status == "failed"
+        assert slack.posts == []
+
+    def test_post_error_does_not_stop_the_notifier(self):
+        slack = self.FakeSlack()
+        calls = []
+
+        def post(**kwargs):
+            calls.append(kwargs)
+            if len(calls) == 1:
+                raise ConnectionError("network down")
+            slack.posts.append(kwargs)
+        slack.chat_postMessage = post
+        notifier = CompletionNotifier(slack, min_interval_s=0)
+        notifier.start()
+        for i in (1, 2):
+            notifier.notify(SimpleNamespace(internal_id=f"task-{i}", origin=("C1", None),
+                                            status="done", result="ok", task="t",
+                                            cost=0.0, age_seconds=lambda: 1.0))
+        notifier.shutdown()
+        assert len(slack.posts) == 1
+
+    def test_notice_posted_to_origin_thread(self, sm, fake_claude):
+        slack = self.FakeSlack()
+        notifier = CompletionNotifier(slack, min_interval_s=0)
+        notifier.start()
+        sm.add_completion_listener(notifier.notify)
+
+        session = sm.dispatch("respond with hello", origin=("C123", "1700000000.000100"))
+        sm.dispatch("no origin")
+        wait_for_session(session, timeout=10)
+        sm.wait_for_tasks(["task-2"], timeout=10)
+        notifier.shutdown()
+
+        assert len(slack.posts) == 1
+        post = slack.posts[0]
+        assert post["channel"] == "C123"
+        assert post["thread_ts"] == "1700000000.000100"
+        assert "task-1" in post["text"] and "fake result" in post["text"]
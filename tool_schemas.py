@@ -6,6 +6,8 @@ To add a new tool: define a schema here, add it to TOOLS, then add a
 dispatch branch in tools.py.
 """
 
+WEB_SEARCH_TOOL = {"type": "web_search_preview"}
+
 SAVE_MEMORY_TOOL = {
     "type": "function",
     "name": "save_memory",
@@ -47,14 +49,15 @@ DISPATCH_COMPUTER_TASK_TOOL = {
     "description": (
         "Dispatch a task to a Claude Code session running on this computer. "
         "This runs in the background — acknowledge the dispatch to the user and move on. "
-        "Do NOT poll or wait for results. Only check on it later if the user asks.\n\n"
+        "Do NOT poll. If the user needs the result in this reply, call wait_for_tasks once.\n\n"
         "Use this for tasks that require interacting with the computer: "
         "running shell commands, editing files, or browser actions.\n\n"
-        "For multiple independent tasks, call this multiple times — they run in parallel.\n"
+        "For multiple independent tasks, use dispatch_task_batch instead.\n"
         "Set use_browser=true ONLY for tasks that require real browser interaction "
         "(logging into websites, clicking buttons, filling forms, taking screenshots). "
         "Do NOT use browser for simple information lookups — Claude Code has web search built in.\n"
-        "Set isolate=true for file-editing tasks that might conflict with each other."
+        "Set isolate=true for file-editing tasks that might conflict with each other.\n"
+        "If all slots are busy the task is queued and starts on its own — never retry a queued task."
     ),
     "parameters": {
         "type": "object",
@@ -74,9 +77,35 @@ DISPATCH_COMPUTER_TASK_TOOL = {
             },
             "isolate": {
                 "type": "boolean",
-                "description": "Whether to use a git worktree for file isolation.",
+                "description": (
+                    "Whether to run in a separate git worktree for file isolation. "
+                    "The session's changes are committed to the branch task/<session id>."
+                ),
                 "default": False,
             },
+            "priority": {
+                "type": "string",
+                "enum": ["interactive", "background"],
+                "description": (
+                    "'interactive' when the user is waiting on the result, "
+                    "'background' for long-running or fire-and-forget work. "
+                    "Queued interactive tasks start first."
+                ),
+                "default": "interactive",
+            },
+            "timeout_s": {
+                "type": "number",
+                "description": (
+                    "Stop the session after this many seconds (default 1800, "
+                    "capped at the bot's configured maximum). "
+                    "Raise it only for tasks known to take longer."
+                ),
+            },
+            "max_cost_usd": {
+                "type": "number",
+                "description": ("Stop the session once its estimated cost passes this many dollars "
+                                "(default 2, capped at the bot's configured maximum)."),
+            },
         },
         "required": ["task"],
         "additionalProperties": False,
@@ -87,14 +116,32 @@ LIST_COMPUTER_TASKS_TOOL = {
     "type": "function",
     "name": "list_computer_tasks",
     "description": (
-        "List all Claude Code sessions (running, completed, or failed) "
-        "with their status, age, and task description. "
+        "List Claude Code sessions, newest first, with their status, age, and task "
+        "description, plus a count of sessions per status. "
         "Call this when the user asks about the status of their tasks, "
-        "or before dispatching to see what's already running."
+        "or before dispatching to see what's already running. "
+        "Older finished sessions are archived and not listed, but can still be "
+        "read or followed up by id."
     ),
     "parameters": {
         "type": "object",
-        "properties": {},
+        "properties": {
+            "status": {
+                "type": "string",
+                "enum": ["queued", "running", "done", "failed", "timeout", "budget_exceeded"],
+                "description": "Only list sessions with this status. Omit to list all.",
+            },
+            "limit": {
+                "type": "integer",
+                "description": "Max sessions to return (default 10, max 50).",
+                "default": 10,
+            },
+            "offset": {
+                "type": "integer",
+                "description": "Skip this many sessions; use next_offset from a previous call.",
+                "default": 0,
+            },
+        },
         "required": [],
         "additionalProperties": False,
     },
@@ -108,7 +155,9 @@ READ_TASK_OUTPUT_TOOL = {
         "This is a FREE passive peek — it reads captured stdout without "
         "interacting with the session or costing any tokens.\n\n"
         "Use this to check on progress, see what tool calls were made, "
-        "or get the final result of a completed session."
+        "or get the final result of a completed session.\n\n"
+        "Each read ends with a cursor. When checking the same session again, "
+        "pass it as `since` to get only the activity that happened after it."
     ),
     "parameters": {
         "type": "object",
@@ -117,6 +166,10 @@ READ_TASK_OUTPUT_TOOL = {
                 "type": "string",
                 "description": "The session ID returned by dispatch_computer_task (e.g. 'task-1').",
             },
+            "since": {
+                "type": "integer",
+                "description": "Cursor from a previous read_task_output of this session. Omit to read from the start.",
+            },
         },
         "required": ["session_id"],
         "additionalProperties": False,
@@ -150,13 +203,159 @@ SEND_FOLLOWUP_TO_TASK_TOOL = {
     },
 }
 
+WAIT_FOR_TASKS_TOOL = {
+    "type": "function",
+    "name": "wait_for_tasks",
+    "description": (
+        "Wait until dispatched sessions finish, instead of checking on them repeatedly. "
+        "Returns as soon as any (or all) of the given sessions are done or failed, or "
+        "when the timeout expires, with a preview of each finished session's result.\n\n"
+        "Call this at most once per reply, only when the user is waiting on the result. "
+        "If sessions are still pending after it returns, tell the user they're still running."
+    ),
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "session_ids": {
+                "type": "array",
+                "items": {"type": "string"},
+                "description": "Session IDs to wait for (e.g. ['task-1', 'task-2']).",
+            },
+            "mode": {
+                "type": "string",
+                "enum": ["any", "all"],
+                "description": "Return when 'any' one finishes, or only when 'all' have.",
+                "default": "any",
+            },
+            "timeout_s": {
+                "type": "integer",
+                "description": "Max seconds to wait (default 60, capped at 120).",
+                "default": 60,
+            },
+        },
+        "required": ["session_ids"],
+        "additionalProperties": False,
+    },
+}
+
+DISPATCH_TASK_BATCH_TOOL = {
+    "type": "function",
+    "name": "dispatch_task_batch",
+    "description": (
+        "Dispatch several independent computer tasks at once under one group id. "
+        "Prefer this over several dispatch_computer_task calls when the user asks for "
+        "more than one job. Then call read_task_group once (with wait_s if the user is "
+        "waiting) to get all results merged into one reply."
+    ),
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "tasks": {
+                "type": "array",
+                "description": "The tasks to run in parallel (at most 10).",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "task": {
+                            "type": "string",
+                            "description": "A clear description of what to do on the computer.",
+                        },
+                        "use_browser": {
+                            "type": "boolean",
+                            "description": "Whether this task needs a real Chrome browser.",
+                            "default": False,
+                        },
+                        "isolate": {
+                            "type": "boolean",
+                            "description": "Whether to run it in its own git worktree.",
+                            "default": False,
+                        },
+                    },
+                    "required": ["task"],
+                    "additionalProperties": False,
+                },
+            },
+            "quorum": {
+                "type": "integer",
+                "description": (
+                    "How many tasks must finish for the batch to count as complete "
+                    "(default: all). Use when any few results are enough."
+                ),
+            },
+            "priority": {
+                "type": "string",
+                "enum": ["interactive", "background"],
+                "description": "'interactive' when the user is waiting, else 'background'.",
+                "default": "interactive",
+            },
+        },
+        "required": ["tasks"],
+        "additionalProperties": False,
+    },
+}
+
+READ_TASK_GROUP_TOOL = {
+    "type": "function",
+    "name": "read_task_group",
+    "description": (
+        "Progress and merged results of a batch started with dispatch_task_batch, "
+        "in one size-bounded report. With wait_s, first blocks until the batch's "
+        "quorum has finished or wait_s passes. Call it once, not in a loop."
+    ),
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "group_id": {
+                "type": "string",
+                "description": "The group id returned by dispatch_task_batch (e.g. 'group-1').",
+            },
+            "wait_s": {
+                "type": "number",
+                "description": "Max seconds to wait for the quorum first (default 0, capped at 120).",
+                "default": 0,
+            },
+        },
+        "required": ["group_id"],
+        "additionalProperties": False,
+    },
+}
+
+# ---------------------------------------------------------------------------
+# Routing (fast-path only — see router.py)
+# ---------------------------------------------------------------------------
+
+ESCALATE_TOOL = {
+    "type": "function",
+    "name": "escalate_to_full_agent",
+    "description": (
+        "Hand this request to the full assistant. Call this instead of answering if "
+        "the request needs a tool you don't have here (saving memory, computer tasks, "
+        "checking or following up on dispatched tasks) or needs careful multi-step "
+        "reasoning. Do not write a reply when you call this."
+    ),
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "reason": {
+                "type": "string",
+                "description": "A few words on why the full assistant is needed.",
+            },
+        },
+        "required": ["reason"],
+        "additionalProperties": False,
+    },
+}
+
 # Master list passed to the OpenAI Responses API.
 # Hosted tools (like web_search_preview) go here alongside function tools.
 TOOLS = [
-    {"type": "web_search_preview"},
+    WEB_SEARCH_TOOL,
     SAVE_MEMORY_TOOL,
     DISPATCH_COMPUTER_TASK_TOOL,
     LIST_COMPUTER_TASKS_TOOL,
     READ_TASK_OUTPUT_TOOL,
+    WAIT_FOR_TASKS_TOOL,
+    DISPATCH_TASK_BATCH_TOOL,
+    READ_TASK_GROUP_TOOL,
     SEND_FOLLOWUP_TO_TASK_TOOL,
 ]
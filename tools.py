@@ -2,22 +2,71 @@
 
 To add a new tool: define its schema in tool_schemas.py, add it to TOOLS
 there, then add a dispatch branch in `dispatch_function_call` below.
+Give it an entry in TOOL_TIMEOUTS if the default doesn't fit, and in
+TOOL_CONFLICT_KEYS if some calls to it must not run at the same time.
+
+A wait (wait_for_tasks, read_task_group with wait_s) holds a tool worker
+and the event worker running its conversation for as long as it blocks,
+so at most TOOL_MAX_BLOCKING_WAITS block at once; any more report the
+current status right away.
 """
 
 import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from typing import Callable, Iterator
 
 from config import logger
+from dispatcher import EVENT_WORKERS
 from memory import save_memory
-from session_manager import session_manager
+from notifier import NOTIFY_ON_COMPLETION
+from session_manager import (
+    SESSION_MAX_COST_CAP_USD, SESSION_TIMEOUT_CAP_S, WAIT_FOR_TASKS_MAX_S, session_manager,
+)
 from tool_schemas import TOOLS  # noqa: F401  re-exported for bot.py
 
+TOOL_MAX_WORKERS = int(os.environ.get("TOOL_MAX_WORKERS", "8"))
+DEFAULT_TOOL_TIMEOUT_S = float(os.environ.get("DEFAULT_TOOL_TIMEOUT_S", "30"))
+TOOL_MAX_BLOCKING_WAITS = int(os.environ.get("TOOL_MAX_BLOCKING_WAITS",
+                                             str(max(1, EVENT_WORKERS // 2))))
+
+# Per-tool timeouts (seconds), overriding DEFAULT_TOOL_TIMEOUT_S.
+TOOL_TIMEOUTS: dict[str, float] = {
+    "save_memory": 10,
+    "wait_for_tasks": WAIT_FOR_TASKS_MAX_S + 5,
+    "read_task_group": WAIT_FOR_TASKS_MAX_S + 5,
+}
+
+# Calls that return the same (non-None) key never run concurrently.
+# Each entry maps a tool name to fn(args, username) -> key.
+TOOL_CONFLICT_KEYS: dict[str, Callable[[dict, str], str | None]] = {
+    "save_memory": lambda args, username: f"memory:{username}",
+    "send_followup_to_task": lambda args, username: f"session:{args.get('session_id')}",
+}
+
+_executor = ThreadPoolExecutor(max_workers=TOOL_MAX_WORKERS, thread_name_prefix="tool")
+_conflict_locks: dict[str, threading.Lock] = {}
+_conflict_locks_guard = threading.Lock()
+_wait_slots = threading.BoundedSemaphore(TOOL_MAX_BLOCKING_WAITS)
+
+_WAIT_BUSY_NOTE = ("Too many waits are already in progress, so this returned the current "
+                   "status without waiting. Tell the user the tasks are still running.")
+
 # ---------------------------------------------------------------------------
 # Dispatch
 # ---------------------------------------------------------------------------
 
 
-def dispatch_function_call(name: str, arguments: str, username: str) -> str:
-    """Execute a function tool by name and return the result string."""
+def dispatch_function_call(name: str, arguments: str, username: str,
+                           origin: tuple[str, str | None] | None = None) -> str:
+    """Execute a function tool by name and return the result string.
+
+    `origin` is the Slack (channel, thread_ts) the request came from;
+    dispatched tasks report back there when they finish.
+    """
     try:
         args = json.loads(arguments) if arguments else {}
     except json.JSONDecodeError as e:
@@ -30,24 +79,105 @@ def dispatch_function_call(name: str, arguments: str, username: str) -> str:
             logger.info("Memory saved for %s: %s", username, args["fact"])
             return result
         if name == "dispatch_computer_task":
-            session = session_manager.dispatch(
+            session, created = session_manager.find_or_dispatch(
                 task=args["task"],
                 use_browser=args.get("use_browser", False),
                 isolate=args.get("isolate", False),
+                priority=args.get("priority", "interactive"),
+                user=username,
+                origin=origin,
+                timeout_s=_limit_arg(args.get("timeout_s"), SESSION_TIMEOUT_CAP_S),
+                max_cost_usd=_limit_arg(args.get("max_cost_usd"), SESSION_MAX_COST_CAP_USD),
             )
+            if not created:
+                return json.dumps({
+                    "session_id": session.internal_id,
+                    "status": session.status,
+                    "duplicate": True,
+                    "message": (f"This task is already {session.status} as {session.internal_id}, "
+                                "so no new session was started. Use that session's id "
+                                "(read_task_output, wait_for_tasks) instead."),
+                })
             logger.info("Dispatched session %s for: %s", session.internal_id, args["task"][:80])
+            if session.status == "queued":
+                return json.dumps({
+                    "session_id": session.internal_id,
+                    "status": "queued",
+                    "message": (f"All slots are busy, so {session.internal_id} is queued and will "
+                                "start automatically when one frees up. Do not re-dispatch it."),
+                })
             return json.dumps({
                 "session_id": session.internal_id,
                 "status": "dispatched",
-                "message": f"Task dispatched as {session.internal_id}. Use read_task_output to check progress.",
+                "message": (f"Task dispatched as {session.internal_id}. The result will be posted "
+                            "here automatically when it finishes."
+                            if origin and NOTIFY_ON_COMPLETION else
+                            f"Task dispatched as {session.internal_id}. Use read_task_output to check progress."),
             })
         if name == "list_computer_tasks":
-            sessions = session_manager.list_sessions()
-            if not sessions:
+            status = args.get("status")
+            limit = min(int(args.get("limit", 10)), 50)
+            offset = int(args.get("offset", 0))
+            counts = session_manager.status_counts()
+            sessions = session_manager.list_sessions(status=status, limit=limit, offset=offset)
+            if not sessions and not any(counts.values()):
                 return "No computer tasks have been dispatched yet."
-            return json.dumps(sessions, indent=2)
+            total = counts[status] if status else sum(counts.values())
+            return json.dumps({
+                "counts": counts,
+                "sessions": sessions,
+                "next_offset": offset + limit if offset + limit < total else None,
+            }, indent=2)
         if name == "read_task_output":
-            return session_manager.read_output(args["session_id"])
+            return session_manager.read_output(args["session_id"], since=args.get("since"))
+        if name == "wait_for_tasks":
+            requested = float(args.get("timeout_s", 60))
+            with _wait_slot(requested) as timeout:
+                waited = session_manager.wait_for_tasks(
+                    args["session_ids"],
+                    mode=args.get("mode", "any"),
+                    timeout=timeout,
+                )
+            if requested > 0 and not timeout and waited["pending"]:
+                waited["note"] = _WAIT_BUSY_NOTE
+            for internal_id in waited["finished"]:
+                session = session_manager.get_session(internal_id)
+                waited.setdefault("results", {})[internal_id] = {
+                    "status": session.status,
+                    "result_preview": (session.result or "")[:500],
+                }
+            return json.dumps(waited, indent=2)
+        if name == "dispatch_task_batch":
+            group = session_manager.dispatch_group(
+                args["tasks"],
+                quorum=args.get("quorum"),
+                priority=args.get("priority", "interactive"),
+                user=username,
+                origin=origin,
+            )
+            progress = session_manager.group_progress(group.group_id)
+            logger.info("Dispatched batch %s (%d tasks)", group.group_id, progress["total"])
+            message = (f"Batch dispatched as {group.group_id}. Call read_task_group once "
+                       "to get the merged results; do not read each task separately.")
+            if args.get("quorum") and group.needed() < args["quorum"]:
+                message += (f" Duplicate tasks left only {progress['total']} sessions, so the "
+                            f"quorum was lowered from {args['quorum']} to {group.needed()}.")
+            return json.dumps({
+                "group_id": group.group_id,
+                "session_ids": group.session_ids,
+                "quorum": group.needed(),
+                "counts": progress["counts"],
+                "message": message,
+            })
+        if name == "read_task_group":
+            requested = float(args.get("wait_s", 0))
+            with _wait_slot(requested) as wait_s:
+                if wait_s > 0:
+                    session_manager.wait_for_group(args["group_id"], timeout=wait_s)
+            report = session_manager.read_group(args["group_id"])
+            if requested > 0 and not wait_s:
+                report = f"{_WAIT_BUSY_NOTE}\n\n{report}"
+            return report
         if name == "send_followup_to_task":
             return session_manager.send_followup(args["session_id"], args["message"])
     except KeyError as e:
@@ -63,13 +193,108 @@ def dispatch_function_call(name: str, arguments: str, username: str) -> str:
     return f"Unknown function: {name}"
 
 
-def handle_function_calls(response, username: str) -> list[dict]:
-    """Process function-call items in a response and return tool outputs."""
+def _limit_arg(value, cap: float) -> float | None:
+    """A model-supplied session limit clamped to (0, cap]; None keeps the default.
+
+    0 means "no limit" to the session manager, so it (and anything else
+    that isn't a positive number) is never passed through from the model.
+    """
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    if not value > 0:  # also rejects NaN
+        return None
+    return min(value, cap)
+
+
+@contextmanager
+def _wait_slot(timeout: float) -> Iterator[float]:
+    """How long a wait may block: `timeout`, or 0 if no wait slot is free."""
+    if timeout > 0 and _wait_slots.acquire(blocking=False):
+        try:
+            yield timeout
+        finally:
+            _wait_slots.release()
+    else:
+        yield 0.0
+
+
+def _conflict_lock(name: str, arguments: str, username: str) -> "threading.Lock | None":
+    """Lock shared by calls that must not overlap, or None if unconstrained."""
+    key_fn = TOOL_CONFLICT_KEYS.get(name)
+    if key_fn is None:
+        return None
+    try:
+        args = json.loads(arguments) if arguments else {}
+    except json.JSONDecodeError:
+        return None  # dispatch_function_call reports the parse error
+    key = key_fn(args, username)
+    if key is None:
+        return None
+    with _conflict_locks_guard:
+        return _conflict_locks.setdefault(key, threading.Lock())
+
+
+def _run_function_call(name: str, arguments: str, username: str,
+                       origin: tuple[str, str | None] | None, started: list[float]) -> str:
+    """Run one tool call on an executor thread, honoring its conflict key.
+
+    Appends the time it began running to `started`.
+    """
+    started.append(time.monotonic())
+    lock = _conflict_lock(name, arguments, username)
+    if lock is None:
+        return dispatch_function_call(name, arguments, username, origin)
+    with lock:
+        return dispatch_function_call(name, arguments, username, origin)
+
+
+def handle_function_calls(response, username: str,
+                          origin: tuple[str, str | None] | None = None) -> list[dict]:
+    """Process function-call items in a response and return tool outputs.
+
+    Calls run concurrently on a bounded executor; outputs keep the order
+    of the calls in the response. A call's timeout counts from when it
+    starts running. One still waiting for a worker after its timeout is
+    cancelled; one that runs past it gets an error output (its thread is
+    left to finish in the background).
+    """
+    calls = [item for item in response.output if item.type == "function_call"]
+    submitted = []
+    for item in calls:
+        timeout = TOOL_TIMEOUTS.get(item.name, DEFAULT_TOOL_TIMEOUT_S)
+        started: list[float] = []
+        future = _executor.submit(_run_function_call, item.name, item.arguments,
+                                  username, origin, started)
+        submitted.append((item, future, started, time.monotonic(), timeout))
+
     tool_outputs = []
-    for item in response.output:
-        if item.type != "function_call":
-            continue
-        result = dispatch_function_call(item.name, item.arguments, username)
+    for item, future, started, submitted_at, timeout in submitted:
+        deadline = submitted_at + timeout
+        try:
+            while True:
+                try:
+                    result = future.result(timeout=max(0.0, deadline - time.monotonic()))
+                    break
+                except FutureTimeoutError:
+                    if future.cancel():
+                        raise
+                    # Running: give it its full timeout from when it started.
+                    run_deadline = (started[0] if started else time.monotonic()) + timeout
+                    if run_deadline <= deadline:
+                        raise
+                    deadline = run_deadline
+        except FutureTimeoutError:
+            if future.cancelled():
+                logger.error("Tool %s not started: no free worker within %ss", item.name, timeout)
+                result = f"Error: {item.name} not started — no free worker within {timeout:g}s"
+            else:
+                logger.error("Tool %s timed out after %ss", item.name, timeout)
+                result = f"Error: {item.name} timed out after {timeout:g}s"
+        except Exception as e:
+            logger.exception("Tool %s failed", item.name)
+            result = f"Error: {item.name} failed — {e}"
         tool_outputs.append({
             "type": "function_call_output",
             "call_id": item.call_id,
@@ -0,0 +1,195 @@
+"""Session transcripts: bounded in-memory tail, full stream on disk.
+
+Every stdout line of a Claude Code session is appended to a per-session
+JSONL file under TRANSCRIPT_DIR, with its byte offset recorded so any line
+can be read back later. Only the most recent lines stay in memory — at
+most TRANSCRIPT_TAIL_LINES per session, and TRANSCRIPT_MEMORY_CAP_BYTES
+across all sessions (the largest tails are trimmed first).
+"""
+
+import os
+import threading
+from array import array
+from collections import deque
+from pathlib import Path
+
+from config import logger
+from event_log import LOG_DIR
+
+TRANSCRIPT_DIR = Path(os.environ.get("TRANSCRIPT_DIR", str(LOG_DIR / "transcripts")))
+TRANSCRIPT_TAIL_LINES = int(os.environ.get("TRANSCRIPT_TAIL_LINES", "500"))
+TRANSCRIPT_MEMORY_CAP_BYTES = int(
+    os.environ.get("TRANSCRIPT_MEMORY_CAP_BYTES", str(32 * 1024 * 1024))
+)
+
+
+class Transcript:
+    """One session's output lines. Use through TranscriptStore."""
+
+    def __init__(self, store: "TranscriptStore", path: Path, tail_lines: int):
+        self._store = store
+        self.path = path
+        self._offsets = array("q")  # byte offset of each line in the file
+        self._size = 0  # bytes written so far
+        self._tail: deque[str] = deque()  # the last lines, in memory
+        self._tail_lines = tail_lines
+        self.tail_bytes = 0
+        self._writer = None
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    @property
+    def _tail_start(self) -> int:
+        """Index of the first line still held in memory."""
+        return len(self._offsets) - len(self._tail)
+
+    def _append(self, line: str) -> int:
+        data = (line + "\n").encode("utf-8")
+        if self._writer is None:
+            self._writer = open(self.path, "ab")
+        self._writer.write(data)
+        self._offsets.append(self._size)
+        self._size += len(data)
+
+        self._tail.append(line)
+        self.tail_bytes += len(line)
+        freed = 0
+        while len(self._tail) > self._tail_lines:
+            freed += len(self._tail.popleft())
+        self.tail_bytes -= freed
+        return len(line) - freed
+
+    def _index(self) -> int:
+        """Rebuild offsets and tail from an existing file; returns tail bytes."""
+        with open(self.path, "rb") as f:
+            for raw in f:
+                line = raw.decode("utf-8", errors="replace").rstrip("\n")
+                self._offsets.append(self._size)
+                self._size += len(raw)
+                self._tail.append(line)
+                self.tail_bytes += len(line)
+                if len(self._tail) > self._tail_lines:
+                    self.tail_bytes -= len(self._tail.popleft())
+        return self.tail_bytes
+
+    def _trim(self, nbytes: int) -> int:
+        """Drop at least `nbytes` of the oldest in-memory lines."""
+        freed = 0
+        while self._tail and freed < nbytes:
+            freed += len(self._tail.popleft())
+        self.tail_bytes -= freed
+        return freed
+
+    def _read(self, start: int, limit: int | None) -> list[str]:
+        end = len(self._offsets) if limit is None else min(len(self._offsets), start + limit)
+        start = max(0, start)
+        if start >= end:
+            return []
+        tail_start = self._tail_start
+        lines = []
+        if start < tail_start:
+            lines = self._read_disk(start, min(end, tail_start))
+        if end > tail_start:
+            tail = list(self._tail)
+            lines.extend(tail[max(start, tail_start) - tail_start:end - tail_start])
+        return lines
+
+    def _read_disk(self, start: int, end: int) -> list[str]:
+        if self._writer:
+            self._writer.flush()
+        lines = []
+        with open(self.path, "rb") as f:
+            f.seek(self._offsets[start])
+            for _ in range(start, end):
+                lines.append(f.readline().decode("utf-8", errors="replace").rstrip("\n"))
+        return lines
+
+    def _close(self):
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+
+    # Public, thread-safe API (locking lives in the store).
+
+    def append(self, line: str):
+        self._store._append(self, line)
+
+    def read(self, start: int = 0, limit: int | None = None) -> list[str]:
+        """Lines [start, start + limit), from memory or disk as needed."""
+        with self._store._lock:
+            return self._read(start, limit)
+
+    def close(self):
+        """Release the file handle; a later append reopens it."""
+        with self._store._lock:
+            self._close()
+
+
+class TranscriptStore:
+    """Creates transcripts and enforces the global in-memory cap."""
+
+    def __init__(self, directory: Path = TRANSCRIPT_DIR,
+                 tail_lines: int = TRANSCRIPT_TAIL_LINES,
+                 memory_cap: int = TRANSCRIPT_MEMORY_CAP_BYTES):
+        self.directory = Path(directory)
+        self.tail_lines = tail_lines
+        self.memory_cap = memory_cap
+        self.memory_bytes = 0
+        self._transcripts: dict[str, Transcript] = {}
+        self._lock = threading.Lock()
+
+    def open(self, name: str, path: Path | None = None, resume: bool = False) -> Transcript:
+        """Start a fresh transcript file for `name`.
+
+        With `resume`, an existing file at `path` is indexed and appended
+        to instead (a session restored after a restart).
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = Path(path) if path else self.directory / f"{name}.jsonl"
+        with self._lock:
+            old = self._transcripts.pop(name, None)
+            if old:
+                old._close()
+                self.memory_bytes -= old.tail_bytes
+            transcript = Transcript(self, path, self.tail_lines)
+            if resume and path.exists():
+                self.memory_bytes += transcript._index()
+            else:
+                path.write_bytes(b"")
+            self._transcripts[name] = transcript
+            if self.memory_bytes > self.memory_cap:
+                self._enforce_cap()
+            return transcript
+
+    def release(self, name: str):
+        """Stop tracking `name` (session archived or removed); its file stays."""
+        with self._lock:
+            transcript = self._transcripts.pop(name, None)
+            if transcript:
+                transcript._close()
+                self.memory_bytes -= transcript.tail_bytes
+
+    def _append(self, transcript: Transcript, line: str):
+        with self._lock:
+            try:
+                self.memory_bytes += transcript._append(line)
+            except OSError as e:
+                logger.error("Failed to write transcript %s: %s", transcript.path, e)
+                return
+            if self.memory_bytes > self.memory_cap:
+                self._enforce_cap()
+
+    def _enforce_cap(self):
+        """Trim the largest tails until memory is back under 90% of the cap."""
+        target = int(self.memory_cap * 0.9)
+        while self.memory_bytes > target:
+            largest = max(self._transcripts.values(), key=lambda t: t.tail_bytes)
+            freed = largest._trim(max(self.memory_bytes - target, largest.tail_bytes // 2))
+            if not freed:
+                break
+            self.memory_bytes -= freed
+
+
+# Module-level singleton
+transcript_store = TranscriptStore()
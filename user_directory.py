@@ -0,0 +1,131 @@
+"""Slack user directory: user id -> lowercased first name.
+
+Warmed at startup from a paginated `users.list`, kept fresh by `user_change`
+events, and refreshed in the background once an entry is older than
+USER_DIRECTORY_TTL_S (the stale name is served meanwhile). Unknown authors
+in a thread are resolved with one batch of concurrent `users.info` calls.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from slack_sdk.errors import SlackApiError
+
+from config import app, logger
+from event_log import event_log
+
+USER_DIRECTORY_TTL_S = float(os.environ.get("USER_DIRECTORY_TTL_S", "21600"))
+USER_LOOKUP_WORKERS = int(os.environ.get("USER_LOOKUP_WORKERS", "8"))
+
+
+def first_name_from_user(user: dict) -> str:
+    """Pick a Slack user's first name (or best fallback), lowercased."""
+    profile = user.get("profile", {})
+    first_name = profile.get("first_name", "").strip()
+    if not first_name:
+        # Fall back to display name or real name if first_name is empty
+        first_name = (
+            profile.get("display_name")
+            or profile.get("real_name")
+            or user.get("id", "")
+        )
+    return first_name.lower()
+
+
+class UserDirectory:
+    """Thread-safe TTL cache of Slack user names."""
+
+    def __init__(self, client, ttl_s: float = USER_DIRECTORY_TTL_S,
+                 workers: int = USER_LOOKUP_WORKERS):
+        self.client = client
+        self.ttl_s = ttl_s
+        self._names: dict[str, tuple[str, float]] = {}  # user_id -> (name, fetched_at)
+        self._refreshing: set[str] = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="users")
+
+    def warm(self):
+        """Load every workspace member via paginated users.list."""
+        start = time.time()
+        count = 0
+        cursor = None
+        try:
+            while True:
+                result = self.client.users_list(cursor=cursor, limit=200)
+                now = time.monotonic()
+                with self._lock:
+                    for user in result.get("members", []):
+                        self._names[user["id"]] = (first_name_from_user(user), now)
+                        count += 1
+                cursor = (result.get("response_metadata") or {}).get("next_cursor")
+                if not cursor:
+                    break
+        except SlackApiError as e:
+            logger.warning("users.list failed while warming user directory: %s", e)
+        event_log.emit("system", "user_directory_warm",
+                       users=count, latency_s=round(time.time() - start, 2))
+
+    def warm_async(self):
+        """Warm in the background so startup isn't blocked on pagination."""
+        threading.Thread(target=self.warm, name="users-warm", daemon=True).start()
+
+    def first_name(self, user_id: str) -> str:
+        """Cached first name; looks the user up synchronously only if unknown."""
+        with self._lock:
+            cached = self._names.get(user_id)
+        if cached is None:
+            return self._lookup(user_id)
+        name, fetched_at = cached
+        if time.monotonic() - fetched_at > self.ttl_s:
+            self._refresh_async(user_id)
+        return name
+
+    def resolve_many(self, user_ids) -> None:
+        """Look up all unknown `user_ids` concurrently, in one batch."""
+        with self._lock:
+            unknown = {uid for uid in user_ids if uid and uid not in self._names}
+        if not unknown:
+            return
+        start = time.time()
+        list(self._executor.map(self._lookup, unknown))
+        event_log.emit("system", "user_directory_batch",
+                       users=len(unknown), latency_s=round(time.time() - start, 2))
+
+    def update_from_user(self, user: dict):
+        """Apply a user object from a `user_change` / `team_join` event."""
+        with self._lock:
+            self._names[user["id"]] = (first_name_from_user(user), time.monotonic())
+
+    def _lookup(self, user_id: str) -> str:
+        try:
+            result = self.client.users_info(user=user_id)
+        except SlackApiError as e:
+            logger.warning("users.info failed for %s: %s", user_id, e)
+            with self._lock:
+                cached = self._names.get(user_id)
+            return cached[0] if cached else user_id.lower()
+        name = first_name_from_user(result["user"])
+        with self._lock:
+            self._names[user_id] = (name, time.monotonic())
+        return name
+
+    def _refresh_async(self, user_id: str):
+        with self._lock:
+            if user_id in self._refreshing:
+                return
+            self._refreshing.add(user_id)
+
+        def refresh():
+            try:
+                self._lookup(user_id)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(user_id)
+
+        self._executor.submit(refresh)
+
+
+# Module-level singleton
+user_directory = UserDirectory(app.client)
@@ -0,0 +1,310 @@
+"""Pool of reusable git worktrees for isolate=True sessions.
+
+Isolated sessions used to pass `--worktree task-N` to claude, which made a
+new worktree per task and never removed it. Instead, each isolated session
+now leases a worktree under <sandbox>/.worktrees and runs with it as its
+cwd. On release, whatever the session changed is committed to the branch
+`task/<task id>` (so it can be reviewed or merged later), and the worktree is
+reset and cleaned for the next lease.
+
+A worktree starts from a snapshot of the sandbox's files (committed or
+not) taken when it was created or last reset, so an idle worktree can
+lag the sandbox by however long it sat idle. The snapshot is a commit
+built with a separate index, so the sandbox's own HEAD, index and files
+are untouched. Work other isolated tasks left on their task branches is
+not merged in.
+
+All git work (setup, creating, resetting, collecting) runs on the pool's own
+threads. lease() only hands out a worktree that is already clean, so callers
+may hold their own locks around it. When none is idle, lease() returns None,
+the pool creates one in the background (up to MAX_WORKTREES), and
+`on_available` fires once it is ready. The pool keeps WORKTREE_POOL_SIZE
+clean worktrees ready.
+
+A leased worktree has a `<slot>.owner` file next to it naming the session
+and the snapshot it started from, so after a crash the next start can tell whose work an abandoned worktree
+holds. It salvages that work onto the owner's task branch and then removes
+the worktree.
+"""
+
+import os
+import shutil
+import subprocess
+import threading
+import time
+from pathlib import Path
+from typing import Callable
+
+from config import logger
+from event_log import event_log
+
+WORKTREE_POOL_SIZE = int(os.environ.get("WORKTREE_POOL_SIZE", "2"))  # clean worktrees kept ready
+MAX_WORKTREES = int(os.environ.get("MAX_WORKTREES", "6"))  # leased + idle
+
+# Commits made on behalf of sessions, which may run where git has no identity.
+_GIT_IDENTITY = ["-c", "user.name=not-jarvis", "-c", "user.email=not-jarvis@localhost"]
+
+
+def _git(cwd: Path, *args: str, check: bool = True, env: dict | None = None) -> str:
+    result = subprocess.run(
+        ["git", *_GIT_IDENTITY, *args], cwd=cwd,
+        capture_output=True, text=True, timeout=60,
+        env={**os.environ, **env} if env else None,
+    )
+    if check and result.returncode != 0:
+        raise OSError(f"git {' '.join(args)} failed: {result.stderr.strip()}")
+    return result.stdout.strip()
+
+
+class WorktreePool:
+    """Leases clean git worktrees of the sandbox to isolated sessions."""
+
+    def __init__(self, sandbox_dir: str, size: int = WORKTREE_POOL_SIZE,
+                 max_worktrees: int = MAX_WORKTREES):
+        self.sandbox = Path(sandbox_dir)
+        self.root = self.sandbox / ".worktrees"
+        self.size = size
+        self.max_worktrees = max_worktrees
+        self.on_available: Callable[[], None] | None = None  # a worktree became idle
+        self._idle: list[Path] = []
+        self._demand = 0  # leases waiting for a worktree to be created
+        self._leased: dict[Path, str] = {}  # path -> owner
+        self._bases: dict[Path, str] = {}  # path -> snapshot commit it was reset to
+        self._pending = 0  # being created or reset
+        self._next_slot = 0
+        self._ready = False
+        self._filling = False
+        self._lock = threading.Lock()
+        self._setup_lock = threading.Lock()
+        self._snapshot_lock = threading.Lock()  # one temporary index
+
+    def _ensure_ready(self):
+        """Make the sandbox a git repo and collect worktrees left by a previous run."""
+        with self._setup_lock:
+            if self._ready:
+                return
+            if not (self.sandbox / ".git").exists():
+                _git(self.sandbox, "init", "-q")
+                _git(self.sandbox, "add", "-A")
+                _git(self.sandbox, "commit", "-q", "--allow-empty", "-m", "Sandbox")
+            exclude = self.sandbox / ".git" / "info" / "exclude"
+            exclude.parent.mkdir(parents=True, exist_ok=True)
+            if ".worktrees/" not in (exclude.read_text() if exclude.exists() else ""):
+                with open(exclude, "a") as f:
+                    f.write("\n.worktrees/\n")
+            self.root.mkdir(exist_ok=True)
+            self.collect()
+            self._ready = True
+
+    def _snapshot(self) -> str:
+        """A commit of the sandbox's current files, on top of its HEAD."""
+        env = {"GIT_INDEX_FILE": str(self.sandbox / ".git" / "worktree-snapshot.index")}
+        with self._snapshot_lock:
+            head = _git(self.sandbox, "rev-parse", "HEAD")
+            _git(self.sandbox, "read-tree", head, env=env)
+            _git(self.sandbox, "add", "-A", env=env)
+            tree = _git(self.sandbox, "write-tree", env=env)
+            if tree == _git(self.sandbox, "rev-parse", f"{head}^{{tree}}"):
+                return head
+            return _git(self.sandbox, "commit-tree", tree, "-p", head,
+                        "-m", "Sandbox snapshot", env=env)
+
+    def available(self, waiting: int = 0) -> bool:
+        """Whether lease() would succeed right now.
+
+        `waiting` is how many leases are wanted; the pool prepares that many
+        in the background (within its cap) if they aren't idle already.
+        """
+        with self._lock:
+            self._demand = waiting
+            if self._idle:
+                return True
+        self.fill_async()
+        return False
+
+    def _total(self) -> int:
+        return len(self._idle) + len(self._leased) + self._pending
+
+    def lease(self, owner: str, prefer: str | None = None) -> str | None:
+        """An idle clean worktree for `owner`, or None if none is ready yet.
+
+        Never runs git. `prefer` asks for a specific idle worktree back (a
+        follow-up resuming in the directory its session ran in before).
+        """
+        with self._lock:
+            if not self._idle:
+                self._demand = max(self._demand, 1)
+                path = None
+            elif prefer and Path(prefer) in self._idle:
+                path = Path(prefer)
+                self._idle.remove(path)
+            else:
+                path = self._idle.pop(0)
+            if path is not None:
+                self._leased[path] = owner
+                self._demand = max(0, self._demand - 1)
+                idle = len(self._idle)
+        if path is None:
+            self.fill_async()
+            return None
+        try:
+            self._owner_file(path).write_text(f"{owner}\n{self._bases.get(path, '')}\n")
+        except OSError as e:
+            logger.warning("Could not record the owner of %s: %s", path, e)
+        event_log.emit("session", "worktree_lease",
+                       session_id=owner, path=str(path), idle=idle)
+        self.fill_async()
+        return str(path)
+
+    def _owner_file(self, path: Path) -> Path:
+        return path.with_name(path.name + ".owner")
+
+    def _new_slot_locked(self) -> Path:
+        while True:
+            path = self.root / f"wt-{self._next_slot}"
+            self._next_slot += 1
+            if not path.exists():
+                return path
+
+    def checkout(self, path: str, owner: str):
+        """Put `owner`'s task branch (from an earlier run) into a leased worktree."""
+        branch = f"task/{owner}"
+        if _git(Path(path), "rev-parse", "--verify", "-q", branch, check=False):
+            _git(Path(path), "checkout", "-q", "--detach", branch)
+
+    def release_async(self, path: str, owner: str, label: str = ""):
+        """Save `owner`'s changes and return the worktree to the pool."""
+        with self._lock:
+            if self._leased.get(Path(path)) != owner:
+                return  # not (or no longer) leased to them
+            del self._leased[Path(path)]
+            self._pending += 1
+        threading.Thread(target=self._release, args=(Path(path), owner, label),
+                         name="worktree-release", daemon=True).start()
+
+    def _release(self, path: Path, owner: str, label: str):
+        start = time.monotonic()
+        keep = False
+        try:
+            committed = self._save_work(path, owner, label, self._bases.get(path))
+            base = self._snapshot()
+            _git(path, "reset", "-q", "--hard", base)
+            _git(path, "clean", "-q", "-fdx")
+            self._bases[path] = base
+            self._owner_file(path).unlink(missing_ok=True)
+            keep = True
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.error("Failed to reset worktree %s, removing it: %s", path, e)
+            committed = False
+            self._remove(path)
+        with self._lock:
+            self._pending -= 1
+            if keep and len(self._idle) < max(self.size, self._demand):
+                self._idle.append(path)
+                keep = False
+        if keep:
+            self._remove(path)  # more idle worktrees than the pool keeps
+        event_log.emit("session", "worktree_reset",
+                       session_id=owner, path=str(path), committed=committed,
+                       branch=f"task/{owner}", reset_s=round(time.monotonic() - start, 3))
+        if self.on_available:
+            self.on_available()
+
+    def _save_work(self, path: Path, owner: str, label: str, base: str | None) -> bool:
+        """Commit changes in `path` to task/<owner>; True if there was any work.
+
+        `base` is the snapshot the worktree started from.
+        """
+        if _git(path, "status", "--porcelain"):
+            _git(path, "add", "-A")
+            _git(path, "commit", "-q", "--no-verify", "-m", f"{owner}: {label[:72]}".rstrip(": "))
+        if _git(path, "rev-parse", "HEAD") == base:
+            return False
+        _git(path, "branch", "-f", f"task/{owner}", "HEAD")
+        return True
+
+    def _remove(self, path: Path):
+        _git(self.sandbox, "worktree", "remove", "--force", "--force", str(path), check=False)
+        if path.exists():
+            shutil.rmtree(path, ignore_errors=True)
+        self._owner_file(path).unlink(missing_ok=True)
+        self._bases.pop(path, None)
+        _git(self.sandbox, "worktree", "prune", check=False)
+
+    def collect(self):
+        """Remove worktrees under the pool root that the pool doesn't know about.
+
+        Work left in a leased worktree (one with an owner file) is committed
+        to its owner's task branch first.
+        """
+        with self._lock:
+            known = set(self._idle) | set(self._leased)
+        removed = 0
+        for entry in sorted(self.root.iterdir()) if self.root.exists() else []:
+            if entry in known or not entry.is_dir():
+                continue
+            owner_file = self._owner_file(entry)
+            owner, _, base = (owner_file.read_text() if owner_file.exists() else "").partition("\n")
+            if owner and (entry / ".git").exists():
+                try:
+                    self._save_work(entry, owner, "salvaged after restart", base.strip() or None)
+                except (OSError, subprocess.SubprocessError) as e:
+                    logger.warning("Could not salvage work in %s: %s", entry, e)
+            self._remove(entry)
+            removed += 1
+        if removed:
+            logger.info("Removed %d abandoned worktrees", removed)
+            event_log.emit("system", "worktrees_collected", removed=removed)
+
+    def start(self):
+        """Set up the repo, collect leftovers and fill the pool, in the background."""
+        with self._lock:
+            if self._filling:
+                return
+            self._filling = True
+        threading.Thread(target=self._fill, name="worktree-fill", daemon=True).start()
+
+    def fill_async(self):
+        """Top the idle list up to `size` (or current demand) in the background."""
+        with self._lock:
+            if self._filling or len(self._idle) >= max(self.size, self._demand):
+                return
+            self._filling = True
+        threading.Thread(target=self._fill, name="worktree-fill", daemon=True).start()
+
+    def _fill(self):
+        try:
+            self._ensure_ready()
+            while True:
+                with self._lock:
+                    if (len(self._idle) >= max(self.size, self._demand)
+                            or self._total() >= self.max_worktrees):
+                        return
+                    path = self._new_slot_locked()
+                    self._pending += 1
+                start = time.monotonic()
+                try:
+                    base = self._snapshot()
+                    _git(self.sandbox, "worktree", "add", "-q", "--detach", str(path), base)
+                except (OSError, subprocess.SubprocessError) as e:
+                    logger.error("Failed to create worktree %s: %s", path, e)
+                    with self._lock:
+                        self._pending -= 1
+                    return
+                with self._lock:
+                    self._pending -= 1
+                    self._bases[path] = base
+                    self._idle.append(path)
+                event_log.emit("system", "worktree_created",
+                               path=str(path), create_s=round(time.monotonic() - start, 3))
+                if self.on_available:
+                    self.on_available()
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.error("Worktree pool unavailable: %s", e)
+        finally:
+            with self._lock:
+                self._filling = False
+
+    def idle_count(self) -> int:
+        with self._lock:
+            return len(self._idle)